@@ -41,12 +41,14 @@ class ADS(I2C_Device):
                  address_table='../address_table/ADS1115.yaml',
                  register_size=2,
                  debug=False,
+                 cache=False,
                  ):
-        super().__init__(channel, address, address_table, register_size, debug)
+        super().__init__(channel, address, address_table, register_size, debug, cache)
 
     def set_default(self):
-        self.write("MODE", 0)
-        self.write("MUX", 0x4)
+        with self.stage():
+            self.write("MODE", 0)
+            self.write("MUX", 0x4)
 
     def get_gain(self):
         return gain[self.read("PGA")]
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+'''
+Parent class for all SCPI devices, asyncio version.
+Shares the protocol core (SCPI.py) with SkippyDevice, so that a single
+event loop can drive many instruments concurrently.
+'''
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+from collections import deque
+
+from . import SCPI
+from .GlobalLock import GlobalLock
+
+# owner of the GlobalLocks held by the current task, inherited by the tasks it starts (e.g. by asyncio.wait_for),
+# so that a helper task of the holder can take the lock again
+_lock_owner = contextvars.ContextVar('lock_owner', default=None)
+
+class AsyncSkippyDevice():
+    def __init__(self, ip: str, port: int, name: str = "", timeout: float = 1, wait: float = 0, cache: bool = False, sync: str = "sleep"):
+        '''
+        Initialize an asyncio SCPI device, with a default timeout for each transaction.
+        Nothing is connected here, use `await dev.connect()` or `async with dev:`.
+
+        Parameters:
+            ip (str): IP Address of the device
+            port (int): port to use for SCPI connection
+            name (str): arbitrary name used for the python instance of the device
+            timeout (float): default timeout of a single transaction in seconds
+            wait (float): wait time after sending a message
+            cache (bool): remember settings and skip writes that would not change them, see SkippyDevice.configure
+            sync (str): how to wait for the device after a command, see SkippyDevice.set_sync
+        '''
+
+        self.name       = name
+        self.ip         = ip
+        self.port       = port
+        self.reader     = None
+        self.writer     = None
+        self.timeout    = timeout
+        self.wait       = wait
+
+        self.logger     = logging.getLogger(__name__)
+        self.lock       = asyncio.Lock()
+        self.connect_lock = asyncio.Lock()  # serializes reconnects, which run outside of self.lock
+        self.connecting = None  # task that is running connect
+        self.pending    = deque()  # (future, reader) of submitted queries, in the order they were sent
+        self.reader_task = None
+        self.skip_terminator = False  # the terminator after a block response is consumed lazily
+        self.state      = SCPI.ShadowState(cache)
+        self.timing     = SCPI.AdaptiveSettle()
+        if sync not in SCPI.SYNC_MODES:
+            raise ValueError(f"Unknown sync mode {sync}, use one of {SCPI.SYNC_MODES}")
+        self.sync       = sync
+
+        self.lstr = f"{self.name} @ {self.ip}:{self.port}"
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def dev(self):
+        return self.writer
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    async def connect(self, timeout: float = None) -> bool:
+        '''
+        Stream based connection
+
+        Parameters:
+            timeout (float): connection timeout in seconds, defaults to the device timeout
+
+        Returns:
+            bool: True for a successful connection
+        '''
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port),
+            self._timeout(timeout),
+        )
+        self.state.invalidate()
+        self.timing.baseline = None
+        self.logger.info(f"{self.lstr}: Connected to SCPI Device")
+        return self.writer is not None
+
+    async def _ensure_connected(self):
+        '''
+        Reconnect if the connection was dropped or closed. Must not be called while holding self.lock,
+        since connect of the subclasses talks to the device (e.g. id, clear) and needs the lock itself.
+        '''
+        if self.writer:
+            return
+        if self.connecting is asyncio.current_task():
+            # the handshake in connect lost the connection again
+            raise ConnectionError(f"{self.lstr}: Connection was lost while connecting")
+        async with self.connect_lock:
+            if self.writer:
+                return
+            self.logger.debug(f"{self.lstr}: Reconnecting")
+            self.connecting = asyncio.current_task()
+            try:
+                await self.connect()
+            finally:
+                self.connecting = None
+
+    def _check_connected(self):
+        if not self.writer:
+            raise ConnectionError(f"{self.lstr}: Connection was dropped")
+
+    def _drop(self, exc: Exception = None):
+        '''
+        Drop the connection after a timeout or a transport error.
+        A late or partially read response would otherwise be returned for the next query.
+        '''
+        if self.writer:
+            self.logger.debug(f"{self.lstr}: Dropping connection to resynchronize.")
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+        self.skip_terminator = False
+        if self.reader_task and self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+        self.reader_task = None
+        self._fail_pending(exc or ConnectionError(f"{self.lstr}: Connection was dropped"))
+
+    def _fail_pending(self, exc: Exception):
+        while self.pending:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+    async def _write(self, msg: str, settle: bool):
+        self._check_connected()
+        self.logger.debug(f"{self.lstr}: Sending message: {msg}")
+        self.state.observe(msg)
+        self.writer.write(SCPI.encode(msg))
+        await self.writer.drain()
+        if settle and self.sync == 'sleep' and self.wait>0:
+            await asyncio.sleep(self.wait)
+
+    async def _read(self) -> str:
+        self.logger.debug(f"{self.lstr}: Reading message.")
+        res = SCPI.decode(await self.reader.readuntil(SCPI.TERMINATOR))
+        if self.skip_terminator:
+            self.skip_terminator = False
+            if not res:
+                res = SCPI.decode(await self.reader.readuntil(SCPI.TERMINATOR))
+        self.logger.debug(f"{self.lstr}: Received message: {res}")
+        return res
+
+    async def _read_block(self, out=None) -> memoryview:
+        self.logger.debug(f"{self.lstr}: Reading block.")
+        head = await self.reader.readexactly(1)
+        if self.skip_terminator:
+            self.skip_terminator = False
+            while head in (b'\r', SCPI.TERMINATOR):
+                head = await self.reader.readexactly(1)
+        head += await self.reader.readexactly(1)
+        header_len, _ = SCPI.parse_block_header(head)
+        if header_len == 2:
+            # indefinite length block, terminated by the terminator
+            data = (await self.reader.readuntil(SCPI.TERMINATOR))[:-len(SCPI.TERMINATOR)]
+        else:
+            head += await self.reader.readexactly(header_len-2)
+            _, length = SCPI.parse_block_header(head)
+            data = await self.reader.readexactly(length)
+            self.skip_terminator = True
+        self.logger.debug(f"{self.lstr}: Received block of {len(data)} bytes.")
+        if out is None:
+            return memoryview(data)
+        view = SCPI.as_bytes_view(out)
+        if len(view) < len(data):
+            raise ValueError(f"Output buffer of {len(view)} bytes is too small for block of {len(data)} bytes")
+        view[:len(data)] = data
+        return view[:len(data)]
+
+    async def _read_replies(self):
+        '''
+        Match newline terminated replies to the submitted queries in FIFO order.
+        Replies of queries whose caller was cancelled are read and discarded, so the order is kept.
+        '''
+        try:
+            while self.pending:
+                future, read = self.pending[0]
+                res = await read()
+                self.pending.popleft()
+                if not future.done():
+                    future.set_result(res)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.reader_task = None
+            self._drop(e)
+        finally:
+            if self.reader_task is asyncio.current_task():
+                self.reader_task = None
+
+    async def _guard(self, coro, timeout):
+        try:
+            return await asyncio.wait_for(coro, self._timeout(timeout))
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            self._drop()
+            raise
+
+    async def send(self, msg: str, timeout: float = None):
+        '''
+        Send a message to the device
+
+        Parameters:
+            msg (str): The message to be sent to the device
+            timeout (float): timeout in seconds, defaults to the device timeout
+        '''
+        if self.sync == 'adaptive' and self.timing.baseline is None and not SCPI.is_query(msg):
+            await self._calibrate(timeout)
+        await self._ensure_connected()
+        start = time.perf_counter()
+        async with self.lock:
+            await self._guard(self._write(msg, settle=True), timeout)
+        if self.sync != 'sleep' and not SCPI.is_query(msg):
+            await self._settle(msg, start, timeout)
+
+    async def _settle(self, msg: str, start: float, timeout: float = None):
+        '''
+        Wait for the device after msg was sent at start (time.perf_counter), in opc or adaptive mode.
+        See SkippyDevice._settle
+        '''
+        if self.sync == 'opc':
+            await self.query('*OPC?', timeout)
+            return
+        if self.timing.learning(msg):
+            await self.query('*OPC?', timeout)
+            self.timing.record(msg, time.perf_counter() - start)
+            return
+        delay = self.timing.delay(msg) - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _calibrate(self, timeout: float = None, n: int = 3):
+        times = []
+        for _ in range(n):
+            start = time.perf_counter()
+            await self.query('*OPC?', timeout)
+            times.append(time.perf_counter() - start)
+        self.timing.baseline = min(times)
+
+    async def read(self, timeout: float = None) -> str:
+        '''
+        Read an unsolicited message from the device, e.g. a welcome banner.
+        Replies to queries are read by query / submit.
+
+        Parameters:
+            timeout (float): timeout in seconds, defaults to the device timeout
+
+        Returns:
+            str: Response from the device
+        '''
+        await self._ensure_connected()
+        async with self.lock:
+            if self.pending:
+                raise RuntimeError(f"{self.lstr}: Can't read while queries are outstanding.")
+            self._check_connected()
+            return await self._guard(self._read(), timeout)
+
+    async def clear(self, expect: bool = False, quiet: float = 0.05):
+        '''
+        Discard everything the device sends until it has been quiet for a while, see SkippyDevice.clear
+
+        Parameters:
+            expect (bool): wait up to the device timeout for the first data to arrive
+            quiet (float): time in seconds without new data after which the input is considered clear
+        '''
+        await self._ensure_connected()
+        async with self.lock:
+            if self.pending:
+                raise RuntimeError(f"{self.lstr}: Can't clear while queries are outstanding.")
+            self._check_connected()
+            timeout = self.timeout if expect else quiet
+            try:
+                while await asyncio.wait_for(self.reader.read(4096), timeout):
+                    timeout = quiet
+            except asyncio.TimeoutError:
+                pass
+
+    async def submit(self, msg: str, timeout: float = None, settle: bool = False, block: bool = False, out=None) -> asyncio.Future:
+        '''
+        Send a query without waiting for the reply (pipelined mode).
+        Many queries can be outstanding, replies are matched to them in the order they were sent.
+
+        Parameters:
+            msg (str): The query to be sent to the device
+            timeout (float): timeout for sending in seconds, defaults to the device timeout
+            settle (bool): wait for the device after sending the query
+            block (bool): the response is an IEEE 488.2 block, see SkippyDevice.read_block
+            out (bytearray or numpy array): preallocated destination for a block response
+
+        Returns:
+            asyncio.Future: resolves to the response from the device, a memoryview for block responses
+        '''
+        read = functools.partial(self._read_block, out) if block else self._read
+        await self._ensure_connected()
+        async with self.lock:
+            await self._guard(self._write(msg, settle=settle), timeout)
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append((future, read))
+            if self.reader_task is None:
+                self.reader_task = asyncio.ensure_future(self._read_replies())
+        return future
+
+    async def query(self, msg: str, timeout: float = None) -> str:
+        '''
+        Submit a query to the device and wait for the reply.
+        Concurrent queries from several tasks are pipelined on the same connection.
+
+        Parameters:
+            msg (str): The message to be sent to the device
+            timeout (float): timeout for the whole transaction in seconds, defaults to the device timeout
+
+        Returns:
+            str: Response from the device
+        '''
+        async def transaction():
+            future = await self.submit(msg, settle=True)
+            return await future
+
+        return await self._guard(transaction(), timeout)
+
+    async def query_block(self, msg: str, out=None, timeout: float = None) -> memoryview:
+        '''
+        Submit a query with a binary block response, see SkippyDevice.read_block
+
+        Parameters:
+            msg (str): The message to be sent to the device
+            out (bytearray or numpy array): preallocated destination, allocated if None
+            timeout (float): timeout for the whole transaction in seconds, defaults to the device timeout
+
+        Returns:
+            memoryview: byte view on the received data
+        '''
+        async def transaction():
+            future = await self.submit(msg, settle=True, block=True, out=out)
+            return await future
+
+        return await self._guard(transaction(), timeout)
+
+    async def pipeline(self, msgs: list, timeout: float = None) -> list:
+        '''
+        Send several queries back-to-back and wait for all replies.
+
+        Parameters:
+            msgs (list): queries to be sent to the device
+            timeout (float): timeout for the whole set in seconds, defaults to the device timeout
+
+        Returns:
+            list: responses from the device, in the same order as msgs
+        '''
+        async def transaction():
+            futures = [await self.submit(msg) for msg in msgs]
+            return list(await asyncio.gather(*futures))
+
+        return await self._guard(transaction(), timeout)
+
+    async def write(self, cmd, value, strict=True) -> bool:
+        '''
+        Write a value and check the readback, see SkippyDevice.write
+
+        Parameters:
+            cmd (str): The command to send (i.e., message without the value to write)
+            value (any): The value to write
+            strict (bool): If true, raise a ValueError if readback does not agree with value
+
+        Returns:
+            bool: True if write and readback agree, False otherwise.
+        '''
+        if self.state.unchanged(cmd, value):
+            self.logger.debug(f"{self.lstr}: {cmd} is already set to {value}.")
+            return True
+        self.logger.debug(f"{self.lstr}: Writing {value} to {cmd}.")
+        await self.send(f"{cmd} {value}")
+        res = await self.query(f"{cmd}?")
+        if SCPI.compare(res, value):
+            self.logger.debug(f"{self.lstr}: Write successful.")
+            self.state.update(cmd, res)
+            return True
+        else:
+            self.logger.debug(f"{self.lstr}: Writing to {cmd} was not successful. Expected {value}, but got {res}.")
+            self.state.invalidate(cmd)
+            if strict:
+                raise ValueError(f"Writing to {cmd} was not successful. Expected {value}, but got {res}.")
+            return False
+
+    async def configure(self, cmd: str, value, sep: str = " ") -> bool:
+        '''
+        Set a parameter unless the cache knows it is already set, see SkippyDevice.configure
+
+        Returns:
+            bool: True if the command was sent
+        '''
+        if self.state.unchanged(cmd, value):
+            self.logger.debug(f"{self.lstr}: {cmd} is already set to {value}.")
+            return False
+        await self.send(f"{cmd}{sep}{value}")
+        self.state.update(cmd, value)
+        return True
+
+    def invalidate(self, *cmds):
+        '''
+        Forget cached settings, all of them if no command is given
+        '''
+        self.state.invalidate(*cmds)
+
+    async def refresh(self, *cmds):
+        '''
+        Read back settings into the cache, see SkippyDevice.refresh
+        '''
+        if not cmds:
+            self.state.invalidate()
+            return
+        for cmd, res in zip(cmds, await self.pipeline([f"{cmd}?" for cmd in cmds])):
+            self.state.update(cmd, res)
+
+    @contextlib.asynccontextmanager
+    async def global_lock(self, timeout: float = 30):
+        '''
+        Acquire the GlobalLock of this device without blocking the event loop.
+        The lock is tried without waiting and polled with a growing interval, so waiting tasks don't tie up threads.
+
+        Parameters:
+            timeout (float): raise a TimeoutError if the lock can't be acquired within this time, in s
+        '''
+        # owned by the task, not by the thread of the event loop
+        owner = _lock_owner.get() or asyncio.current_task()
+        lock = GlobalLock(self.ip, timeout=0, owner=owner, site=f"{type(self).__name__} {self.lstr}")
+        deadline = time.monotonic() + timeout
+        interval = 0.001
+        while True:
+            try:
+                lock.__enter__()
+                break
+            except TimeoutError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Could not acquire lock {lock.filename} within {timeout}s")
+            await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            interval = min(2*interval, 0.05)
+        token = _lock_owner.set(owner)
+        try:
+            yield lock
+        finally:
+            _lock_owner.reset(token)
+            lock.__exit__(None, None, None)
+
+    async def close(self):
+        '''
+        Close the connection to the device
+        '''
+        async with self.lock:
+            self.logger.info(f"{self.lstr}: Closing Connection.")
+            if self.reader_task:
+                self.reader_task.cancel()
+                self.reader_task = None
+            self._fail_pending(ConnectionError(f"{self.lstr}: Connection closed"))
+            if self.writer:
+                self.writer.close()
+                with contextlib.suppress(OSError):
+                    await self.writer.wait_closed()
+            self.reader = None
+            self.writer = None
+            self.logger.info(f"{self.lstr}: Connection to SCPI Device closed.")
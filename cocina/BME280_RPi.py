@@ -16,71 +16,106 @@ class BME280(I2C_Device):
                  address_table='../address_table/BME280.yaml',
                  register_size=1,
                  debug=False,
+                 cache=False,
                  ):
-        super().__init__(channel, address, address_table, register_size, debug)
+        super().__init__(channel, address, address_table, register_size, debug, cache)
         self.t_ready = False
         self.h_ready = False
         self.p_ready = False
         self.set_default()
 
     def set_default(self):
-        self.write("OSRS_T", 5)
-        self.write("OSRS_H", 5)
-        self.write("OSRS_P", 5)
-        self.write("MODE", 1)
+        # one write per register, ctrl_hum (OSRS_H) only takes effect after ctrl_meas is written, so it goes first
+        with self.stage():
+            self.write("OSRS_H", 5)
+            self.write("OSRS_T", 5)
+            self.write("OSRS_P", 5)
+            self.write("MODE", 1)
 
     def measure(self):
         self.write("MODE", 1)
 
+    def _signed(self, val):
+        return struct.unpack(">h", int.to_bytes(val, 2))[0]
+
     def read_temp_coeffs(self):
+        vals = self.read_many([f"T{i}_{b}" for i in range(1,4) for b in ["LSB", "MSB"]])
         for i in range(1,4):
-            val = self.read(f"T{i}_LSB") | (self.read(f"T{i}_MSB") << 8)
-            if self.regs[f"T{i}_LSB"]['type'] == 'h':  # take care of signed integers
-                val = struct.unpack(">h", int.to_bytes(val, 2))[0]
+            val = vals[f"T{i}_LSB"] | (vals[f"T{i}_MSB"] << 8)
+            if self.regs[f"T{i}_LSB"].type == 'h':  # take care of signed integers
+                val = self._signed(val)
             setattr(self, f"t{i}", val)
-        #self.t1 = self.read("T1_LSB") | (self.read("T1_MSB") << 8)
-        #self.t2 = self.read("T2_LSB") | (self.read("T2_MSB") << 8)
-        #self.t3 = self.read("T3_LSB") | (self.read("T3_MSB") << 8)
         self.t_ready = True
 
     def read_hum_coeffs(self):
-        self.h1 = self.read("H1")
-
-        val = self.read("H2_LSB") | (self.read("H2_MSB") << 8)
-        self.h2 = struct.unpack(">h", int.to_bytes(val, 2))[0]
-
-        self.h3 = self.read("H3")
-
-        val = self.read("H4_LSB") | (self.read("H4_MSB") << 4)
-        self.h4 = struct.unpack(">h", int.to_bytes(val, 2))[0]
-
-        val = self.read("H5_LSB") | (self.read("H5_MSB") << 4)
-        self.h5 = struct.unpack(">h", int.to_bytes(val, 2))[0]
-
-        self.h6 = self.read("H6")
+        vals = self.read_many(["H1", "H2_LSB", "H2_MSB", "H3", "H4_LSB", "H4_MSB", "H5_LSB", "H5_MSB", "H6"])
+        self.h1 = vals["H1"]
+        self.h2 = self._signed(vals["H2_LSB"] | (vals["H2_MSB"] << 8))
+        self.h3 = vals["H3"]
+        self.h4 = self._signed(vals["H4_LSB"] | (vals["H4_MSB"] << 4))
+        self.h5 = self._signed(vals["H5_LSB"] | (vals["H5_MSB"] << 4))
+        self.h6 = vals["H6"]
         self.h_ready = True
 
     def read_pres_coeffs(self):
+        vals = self.read_many([f"P{i}_{b}" for i in range(1,10) for b in ["LSB", "MSB"]])
         for i in range(1,10):
-            val = self.read(f"P{i}_LSB") | (self.read(f"P{i}_MSB") << 8)
-            if self.regs[f"P{i}_LSB"]['type'] == 'h':
-                val = struct.unpack(">h", int.to_bytes(val, 2))[0]
+            val = vals[f"P{i}_LSB"] | (vals[f"P{i}_MSB"] << 8)
+            if self.regs[f"P{i}_LSB"].type == 'h':
+                val = self._signed(val)
             setattr(self, f"p{i}", val)
         self.p_ready = True
 
+    def read_coeffs(self):
+        '''
+        Read all calibration coefficients
+        '''
+        self.read_temp_coeffs()
+        self.read_pres_coeffs()
+        self.read_hum_coeffs()
+
+    def read_raw(self, temp=True, pres=False, hum=False):
+        '''
+        Read the raw ADC values of the selected quantities with a single block transfer,
+        the data registers are consecutive (0xF7 to 0xFE)
+        '''
+        regs = []
+        if temp: regs += ["TEMP_XLSB", "TEMP_LSB", "TEMP_MSB"]
+        if pres: regs += ["PRESS_XLSB", "PRESS_LSB", "PRESS_MSB"]
+        if hum: regs += ["HUM_LSB", "HUM_MSB"]
+        vals = self.read_many(regs)
+        if temp:
+            self.t = vals["TEMP_XLSB"] | (vals["TEMP_LSB"] << 4) | (vals["TEMP_MSB"] << 12)
+        if pres:
+            self.p = vals["PRESS_XLSB"] | (vals["PRESS_LSB"] << 4) | (vals["PRESS_MSB"] << 12)
+        if hum:
+            self.h = vals["HUM_LSB"] | (vals["HUM_MSB"] << 8)
+
     def read_temp_raw(self):
-        self.t = self.read("TEMP_XLSB") | (self.read("TEMP_LSB") << 4) | (self.read("TEMP_MSB") << 12)
+        self.read_raw(temp=True)
 
     def read_hum_raw(self):
-        self.h = self.read("HUM_LSB") | (self.read("HUM_MSB") << 8)
+        self.read_raw(temp=False, hum=True)
 
     def read_pres_raw(self):
-        self.p = self.read("PRESS_XLSB") | (self.read("PRESS_LSB") << 4) | (self.read("PRESS_MSB") << 12)
+        self.read_raw(temp=False, pres=True)
+
+    def sample(self):
+        '''
+        Temperature (C), pressure (mbar) and humidity (%) from a single read of the data registers
+        '''
+        if not (self.t_ready and self.p_ready and self.h_ready):
+            self.read_coeffs()
+        self.read_raw(temp=True, pres=True, hum=True)
+        return self.compensate_temp(), self.compensate_pres(), self.compensate_hum()
 
     def get_temp(self):
         if not self.t_ready:
             self.read_temp_coeffs()
         self.read_temp_raw()
+        return self.compensate_temp()
+
+    def compensate_temp(self):
 # ((((adc_T>>3) – ((BME280_S32_t)dig_T1<<1))) * ((BME280_S32_t)dig_T2)) >> 11;
         var1 = (((self.t >> 3) - (self.t1<<1)) * self.t2) >> 11
 # (((((adc_T>>4) – ((BME280_S32_t)dig_T1)) * ((adc_T>>4) – ((BME280_S32_t)dig_T1))) >> 12) * ((BME280_S32_t)dig_T3)) >> 14;
@@ -92,9 +127,13 @@ class BME280(I2C_Device):
     def get_hum(self):
         if not self.h_ready:
             self.read_hum_coeffs()
-        self.read_hum_raw()
-        self.get_temp()
+        if not self.t_ready:
+            self.read_temp_coeffs()
+        self.read_raw(temp=True, hum=True)
+        self.compensate_temp()
+        return self.compensate_hum()
 
+    def compensate_hum(self):
         var = self.t_fine - 76800
         # ((((adc_H << 14) – (dig_H4 << 20) – (dig_H5 * v_x1_u32r)) + 16384) >> 15) * (((((((v_x1_u32r * dig_H6) >> 10) * (((v_x1_u32r * dig_H3) >> 11) + 32768)) >> 10) + 2097152) * dig_H2 + 8192) >> 14)
         var = ((((self.h << 14) - (self.h4 << 20) - (self.h5 * var)) + 16384) >> 15) * (((((((var * self.h6) >> 10) * ((( var * self.h3) >> 11) + 32768)) >> 10) + 2097152) * self.h2 + 8192) >> 14)  # wow what a mess
@@ -107,9 +146,13 @@ class BME280(I2C_Device):
     def get_pres(self):
         if not self.p_ready:
             self.read_pres_coeffs()
-        self.read_pres_raw()
-        self.get_temp()
+        if not self.t_ready:
+            self.read_temp_coeffs()
+        self.read_raw(temp=True, pres=True)
+        self.compensate_temp()
+        return self.compensate_pres()
 
+    def compensate_pres(self):
         var1 = self.t_fine - 128000
         var2 = var1 * var1 * self.p6
         var2 = var2 + ((var1*self.p5) << 17)
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+'''
+Local broker that keeps one persistent connection per instrument.
+Scripts send their commands to the broker over a Unix socket instead of connecting to the instruments themselves,
+so that they start instantly and never compete for the (few) TCP connections of an instrument.
+
+Start the broker with a YAML file describing the instruments:
+
+    python -m cocina.Broker instruments.yaml
+
+    Readout:
+        type: scpi
+        ip: 192.168.2.1
+        port: 5025
+    TDC:
+        type: zmq
+        ip: 192.168.2.10
+        port: 5555
+        wait: 0.01
+
+and talk to the instruments from a script:
+
+    from cocina.Broker import BrokerClient
+    with BrokerClient() as broker:
+        psu = broker.device('Readout')
+        print(psu.query('MEASURE:VOLTAGE? CH1'))
+
+or use the instrument classes on top of the broker connection:
+
+        psu = PowerSupply.from_broker(broker.device('Readout'))
+
+The wire protocol is one JSON object per line, e.g.
+{"id": 1, "op": "query", "device": "Readout", "msg": "*IDN?"} is answered with {"id": 1, "result": "..."}
+or {"id": 1, "error": "..."}.
+
+Requests for one instrument are served round-robin across clients, one request at a time,
+and identical queries that are waiting at the same time are sent to the instrument only once.
+Queries with side effects, or whose reply belongs to a single caller (error queue, *OPC?, data transfers, see NO_COALESCE),
+are always sent for every client.
+'''
+
+import os
+import re
+import json
+import socket
+import asyncio
+import logging
+import argparse
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import zmq
+from yaml import load
+from yaml import CLoader as Loader
+
+from .SkippyDevice import SkippyDevice
+from .ZeroMQDevice import ZeroMQDevice
+from .GlobalLock import GlobalLock
+from . import SCPI
+
+DEFAULT_SOCKET = '/tmp/cocina_broker.sock'
+
+DEVICE_TYPES = {
+    'scpi': SkippyDevice,
+    'zmq': ZeroMQDevice,
+}
+
+OPS = ['send', 'query', 'pipeline', 'write']
+
+# headers (regular expressions, matched at the start of the upper case header) of queries that are never shared:
+# they pop the error queue, wait for or clear status and event registers, trigger, or transfer readings
+NO_COALESCE = [r'\*OPC', r'\*ESR', r'\*TRG', r'SYST(EM)?:ERR', r'STAT(US)?:.*EVEN', r'TRAC(E)?:DATA', r'INIT']
+
+class Job:
+    def __init__(self, op: str, args: dict, key=None):
+        '''
+        A request for an instrument, with the futures of all clients waiting for its result
+        '''
+        self.op = op
+        self.args = args
+        self.key = key
+        self.futures = []
+
+class DeviceQueue:
+    def __init__(self, coalesce: bool = True, no_coalesce: list = NO_COALESCE):
+        '''
+        Requests for one instrument, queued per client and served round-robin.
+
+        Parameters:
+            coalesce (bool): answer identical queries that wait at the same time with a single transaction
+            no_coalesce (list): header patterns of queries that are never shared, see NO_COALESCE
+        '''
+        self.clients = OrderedDict()  # client -> deque of jobs, in the order the clients are served
+        self.queued = {}  # key -> job of queries that have not been sent yet
+        self.coalesce = coalesce
+        self.no_coalesce = re.compile('|'.join(f'(?:{pattern})' for pattern in no_coalesce)) if no_coalesce else None
+        self.executed = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.clients.values())
+
+    def shareable(self, msg: str) -> bool:
+        '''
+        A message can be answered for several clients if all its commands are queries without side effects
+        '''
+        for cmd in msg.split(';'):
+            if not SCPI.is_query(cmd):
+                return False
+            if self.no_coalesce and self.no_coalesce.match(SCPI.header(cmd)):
+                return False
+        return True
+
+    def put(self, client, op: str, args: dict, future) -> bool:
+        '''
+        Queue a request of client
+
+        Returns:
+            bool: True if the request was merged into an identical queued query
+        '''
+        key = ('query', args['msg']) if self.coalesce and op == 'query' and self.shareable(args['msg']) else None
+        # only when nothing else of this client is waiting, a reply must never be older than the client's previous commands
+        if key in self.queued and client not in self.clients:
+            self.queued[key].futures.append(future)
+            self.coalesced += 1
+            return True
+        job = Job(op, args, key)
+        job.futures.append(future)
+        self.clients.setdefault(client, deque()).append(job)
+        if key:
+            self.queued[key] = job
+        return False
+
+    def get(self) -> Job:
+        '''
+        Next job, taking turns between clients
+
+        Returns:
+            Job: the job, or None if nothing is queued
+        '''
+        if not self.clients:
+            return None
+        client, jobs = self.clients.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            self.clients[client] = jobs  # back of the line
+        if job.key and self.queued.get(job.key) is job:
+            del self.queued[job.key]
+        self.executed += 1
+        return job
+
+class Broker:
+    def __init__(self, config: dict, path: str = DEFAULT_SOCKET, coalesce: bool = True, no_coalesce: list = NO_COALESCE):
+        '''
+        Parameters:
+            config (dict): instruments by name, with type (scpi or zmq), ip, port and optionally timeout and wait
+            path (str): path of the Unix socket
+            coalesce (bool): answer identical queries that wait at the same time with a single transaction
+            no_coalesce (list): header patterns of queries that are never shared, see NO_COALESCE
+        '''
+        for name, cfg in config.items():
+            if cfg.get('type', 'scpi') not in DEVICE_TYPES:
+                raise ValueError(f"Unknown type {cfg['type']} of device {name}, use one of {list(DEVICE_TYPES)}")
+        self.config     = config
+        self.path       = path
+        self.logger     = logging.getLogger(__name__)
+        self.devices    = {}
+        self.queues     = {name: DeviceQueue(coalesce, no_coalesce) for name in config}
+        self.ready      = {}
+        self.executors  = {name: ThreadPoolExecutor(1, thread_name_prefix=f"Broker {name}") for name in config}
+        self.workers    = []
+        self.server     = None
+
+    @classmethod
+    def from_yaml(cls, f_in: str, **kwargs):
+        with open(f_in, 'r') as f:
+            return cls(load(f, Loader=Loader), **kwargs)
+
+    def make_device(self, name: str):
+        cfg = dict(self.config[name])
+        device_type = DEVICE_TYPES[cfg.pop('type', 'scpi')]
+        return device_type(cfg.pop('ip'), cfg.pop('port'), name, **cfg)
+
+    def execute(self, name: str, op: str, args: dict):
+        '''
+        Run a request on the instrument, in the thread of the instrument.
+        The connection is dropped after a transport error, and re-established with the next request.
+        '''
+        dev = self.devices.get(name)
+        if dev is None:
+            dev = self.devices[name] = self.make_device(name)
+        try:
+            with GlobalLock(dev.ip):
+                if op == 'send':
+                    return dev.send(args['msg'])
+                elif op == 'query':
+                    return dev.query(args['msg'])
+                elif op == 'pipeline':
+                    if hasattr(dev, 'pipeline'):
+                        return dev.pipeline(args['msgs'])
+                    return [dev.query(msg) for msg in args['msgs']]
+                elif op == 'write':
+                    return dev.write(args['cmd'], args['value'], args.get('strict', True))
+        except (OSError, zmq.ZMQError):
+            self.logger.warning(f"Broker: Dropping connection to {name} after an error.")
+            self.devices.pop(name)
+            try:
+                dev.close()
+            except Exception:
+                pass
+            raise
+
+    async def worker(self, name: str):
+        queue = self.queues[name]
+        ready = self.ready[name]
+        loop = asyncio.get_running_loop()
+        while True:
+            job = queue.get()
+            if job is None:
+                ready.clear()
+                await ready.wait()
+                continue
+            try:
+                res = await loop.run_in_executor(self.executors[name], self.execute, name, job.op, job.args)
+            except Exception as e:
+                for future in job.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in job.futures:
+                    if not future.done():
+                        future.set_result(res)
+
+    async def submit(self, client, name: str, op: str, args: dict):
+        if name not in self.queues:
+            raise KeyError(f"Unknown device {name}")
+        if op not in OPS:
+            raise ValueError(f"Unknown operation {op}, use one of {OPS}")
+        future = asyncio.get_running_loop().create_future()
+        self.queues[name].put(client, op, args, future)
+        self.ready[name].set()
+        return await future
+
+    def stats(self) -> dict:
+        return {name: {'connected': name in self.devices, 'queued': len(queue),
+                       'executed': queue.executed, 'coalesced': queue.coalesced}
+                for name, queue in self.queues.items()}
+
+    async def dispatch(self, client, request: dict) -> dict:
+        res = {'id': request.get('id')}
+        try:
+            op = request.get('op')
+            if op == 'devices':
+                res['result'] = list(self.config)
+            elif op == 'stats':
+                res['result'] = self.stats()
+            else:
+                args = {k: v for k, v in request.items() if k not in ('id', 'op', 'device')}
+                res['result'] = await self.submit(client, request.get('device'), op, args)
+        except Exception as e:
+            res['error'] = f"{type(e).__name__}: {e}"
+        return res
+
+    async def handle(self, reader, writer):
+        '''
+        Serve one client, requests are answered as soon as they are done, matched by id
+        '''
+        client = object()
+        tasks = set()
+
+        async def respond(request):
+            res = await self.dispatch(client, request)
+            writer.write(json.dumps(res).encode() + b'\n')
+            await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    writer.write(json.dumps({'id': None, 'error': f"ValueError: {e}"}).encode() + b'\n')
+                    continue
+                task = asyncio.ensure_future(respond(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.remove(self.path)  # left behind by a broker that died
+            else:
+                raise RuntimeError(f"A broker is already running on {self.path}")
+            finally:
+                probe.close()
+        self.ready = {name: asyncio.Event() for name in self.config}
+        self.workers = [asyncio.ensure_future(self.worker(name)) for name in self.config]
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        self.logger.info(f"Broker: Serving {list(self.config)} on {self.path}")
+
+    async def serve(self):
+        '''
+        Run the broker until cancelled
+        '''
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        loop = asyncio.get_running_loop()
+        for name, dev in list(self.devices.items()):
+            await loop.run_in_executor(self.executors[name], dev.close)
+        self.devices.clear()
+
+class RemoteDevice:
+    def __init__(self, client, name: str):
+        '''
+        An instrument behind the broker, with the basic interface of SkippyDevice.
+        The instrument classes use it as transport, e.g. PowerSupply.from_broker(client.device('Readout'))
+        '''
+        self.client = client
+        self.name = name
+
+    def send(self, msg: str):
+        self.client.request('send', device=self.name, msg=msg)
+
+    def query(self, msg: str) -> str:
+        return self.client.request('query', device=self.name, msg=msg)
+
+    def pipeline(self, msgs: list) -> list:
+        return self.client.request('pipeline', device=self.name, msgs=msgs)
+
+    def write(self, cmd, value, strict=True) -> bool:
+        return self.client.request('write', device=self.name, cmd=cmd, value=value, strict=strict)
+
+class BrokerClient:
+    def __init__(self, path: str = DEFAULT_SOCKET, timeout: float = None):
+        '''
+        Connection to the broker
+
+        Parameters:
+            path (str): path of the Unix socket of the broker
+            timeout (float): timeout of a single request in seconds, None waits forever
+        '''
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.buf = b''  # received data of replies that are not complete yet, kept across timeouts
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_line(self) -> bytes:
+        while b'\n' not in self.buf:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError(f"Broker on {self.path} closed the connection")
+            self.buf += data
+        line, self.buf = self.buf.split(b'\n', 1)
+        return line
+
+    def request(self, op: str, **args):
+        '''
+        Send a request to the broker and wait for the result.
+        Late replies to earlier requests that timed out are discarded.
+
+        Raises:
+            RuntimeError: if the request failed in the broker
+        '''
+        with self.lock:
+            request_id = next(self.ids)
+            self.sock.sendall(json.dumps({'id': request_id, 'op': op, **args}).encode() + b'\n')
+            while True:
+                res = json.loads(self._read_line())
+                if res.get('id') == request_id:
+                    break
+        if 'error' in res:
+            raise RuntimeError(f"{args.get('device', 'Broker')}: {res['error']}")
+        return res['result']
+
+    def devices(self) -> list:
+        return self.request('devices')
+
+    def stats(self) -> dict:
+        return self.request('stats')
+
+    def device(self, name: str) -> RemoteDevice:
+        return RemoteDevice(self, name)
+
+    def close(self):
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker that owns the connections to all instruments")
+    parser.add_argument('config', help="YAML file with the instruments")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="path of the Unix socket")
+    parser.add_argument('--no-coalesce', action='store_true', help="send every query to the instrument")
+    parser.add_argument('--never-coalesce', action='append', default=[], metavar='PATTERN',
+                        help="header pattern of queries that are never shared, in addition to the defaults")
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    broker = Broker.from_yaml(args.config, path=args.socket, coalesce=not args.no_coalesce,
+                                no_coalesce=NO_COALESCE + args.never_coalesce)
+    try:
+        asyncio.run(broker.serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
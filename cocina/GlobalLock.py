@@ -1,44 +1,289 @@
 #!/usr/bin/env python3
+'''
+Inter-process lock for shared instruments, based on flock(2) on /tmp/<name>_lock.
+The kernel wakes up a waiting process as soon as the lock is released,
+and releases the lock when the holding process dies, so there are no stale locks.
+Within a process the lock is reentrant for its owner (by default the current thread).
+
+Wait and hold times are recorded for every lock, see stats.
+Set COCINA_LOCK_STATS=<file> to dump them as JSON when the process exits.
+'''
 
 import os
+import sys
+import json
 import time
-import errno
+import fcntl
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class _ProcessLock:
+    def __init__(self, filename):
+        '''
+        State of one lock file, shared by all GlobalLock instances of this process.
+        Threads of this process queue up on the condition, only the owner holds the flock.
+        '''
+        self.filename = filename
+        self.cond = threading.Condition()
+        self.owner = None
+        self.depth = 0
+        self.fd = None
+        self.site = None
+        self.since = None
+
+    def acquire(self, owner, timeout, site=None):
+        start = time.monotonic()
+        deadline = start + timeout
+        with self.cond:
+            if self.owner == owner:
+                self.depth += 1
+                return
+            waited_for = f"{os.getpid()} {self.site}" if self.owner is not None else None
+            while self.owner is not None:
+                if not self.cond.wait(deadline - time.monotonic()) and self.owner is not None:
+                    raise TimeoutError(f"Could not acquire lock {self.filename} within {timeout}s, it is held by this process")
+            self.owner = owner  # reserve, the flock is taken outside of the condition
+        try:
+            self.fd, blocked_by = _flock(self.filename, deadline, timeout)
+        except BaseException:
+            with self.cond:
+                self.owner = None
+                self.cond.notify()
+            raise
+        self.depth = 1
+        self.site = site
+        self.since = time.monotonic()
+        # tell processes that have to wait for us who we are
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, f"{os.getpid()} {site}".encode(), 0)
+        _stats.acquired(self.filename, site, self.since - start, blocked_by or waited_for)
+
+    def release(self, owner):
+        with self.cond:
+            if self.owner != owner:
+                raise RuntimeError(f"Lock {self.filename} released by {owner}, but it is owned by {self.owner}")
+            self.depth -= 1
+            if self.depth:
+                return
+            _stats.released(self.filename, self.site, time.monotonic() - self.since)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+            self.owner = None
+            self.cond.notify()
+
+def _flock(filename, deadline, timeout):
+    '''
+    Open filename and take an exclusive flock, waiting until deadline (time.monotonic)
+
+    Returns:
+        tuple: (file descriptor holding the lock, "<pid> <call site>" of the process we had to wait for, or None)
+    '''
+    fd = os.open(filename, os.O_CREAT | os.O_RDWR, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd, None
+    except BlockingIOError:
+        blocked_by = os.pread(fd, 1024, 0).decode(errors='replace') or 'unknown'
+    except BaseException:
+        os.close(fd)
+        raise
+    if deadline <= time.monotonic():
+        os.close(fd)
+        raise TimeoutError(f"Could not acquire lock {filename} within {timeout}s")
+
+    # flock can't time out, so block in a helper thread that gives the lock back if nobody is waiting anymore
+    guard = threading.Lock()
+    state = {'abandoned': False, 'error': None}
+
+    def wait():
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            state['error'] = e
+        with guard:
+            if state['abandoned']:
+                os.close(fd)  # also releases the flock
+
+    waiter = threading.Thread(target=wait, name=f"GlobalLock {filename}", daemon=True)
+    waiter.start()
+    waiter.join(max(deadline - time.monotonic(), 0))
+    with guard:
+        if waiter.is_alive():
+            state['abandoned'] = True
+            raise TimeoutError(f"Could not acquire lock {filename} within {timeout}s")
+    if state['error']:
+        os.close(fd)
+        raise state['error']
+    return fd, blocked_by
+
+class LockStats:
+    def __init__(self):
+        '''
+        Wait and hold times of all GlobalLocks of this process, per lock file and per call site
+        '''
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @staticmethod
+    def _new():
+        return {'count': 0, 'contended': 0, 'wait': 0., 'wait_max': 0., 'hold': 0., 'hold_max': 0.}
+
+    def _entry(self, filename):
+        if filename not in self.locks:
+            self.locks[filename] = {**self._new(), 'holder': None, 'sites': {}, 'blocked_by': {}}
+        return self.locks[filename]
+
+    def acquired(self, filename, site, wait, blocked_by=None):
+        with self.lock:
+            entry = self._entry(filename)
+            site_entry = entry['sites'].setdefault(str(site), self._new())
+            for e in (entry, site_entry):
+                e['count'] += 1
+                e['contended'] += blocked_by is not None
+                e['wait'] += wait
+                e['wait_max'] = max(e['wait_max'], wait)
+            if blocked_by is not None:
+                entry['blocked_by'][blocked_by] = entry['blocked_by'].get(blocked_by, 0.) + wait
+            entry['holder'] = {'pid': os.getpid(), 'site': site, 'since': time.time()}
+
+    def released(self, filename, site, hold):
+        with self.lock:
+            entry = self._entry(filename)
+            site_entry = entry['sites'].setdefault(str(site), self._new())
+            for e in (entry, site_entry):
+                e['hold'] += hold
+                e['hold_max'] = max(e['hold_max'], hold)
+            entry['holder'] = None
+
+    def get(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps(self.locks))
+
+    def reset(self):
+        with self.lock:
+            self.locks.clear()
+
+_stats = LockStats()
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+def _get(filename):
+    with _locks_lock:
+        if filename not in _locks:
+            _locks[filename] = _ProcessLock(filename)
+        return _locks[filename]
+
+def _reset_after_fork():
+    # the child shares the open file descriptions (and with them the flocks) of the parent, drop them
+    global _locks_lock
+    _locks_lock = threading.Lock()
+    for lock in _locks.values():
+        if lock.fd is not None:
+            os.close(lock.fd)
+    _locks.clear()
+    _stats.lock = threading.Lock()
+    _stats.locks.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 class GlobalLock:
-    def __init__(self, name, key=False, timeout=30):
+    def __init__(self, name, key=False, timeout=30, owner=None, site=None):
+        '''
+        Lock a shared resource (e.g. an instrument, by IP) across processes.
+
+            with GlobalLock(self.ip):
+                self.query(...)
+
+        Parameters:
+            name (str): name of the resource, the lock file is /tmp/<name>_lock
+            key (bool): the caller already holds the lock, don't lock again.
+                        Not needed anymore since the lock is reentrant, kept for compatibility.
+            timeout (float): raise a TimeoutError if the lock can't be acquired within this time, in s
+            owner (hashable): owner of the lock within this process, defaults to the current thread.
+                              Use e.g. an asyncio task to hold the lock across threads.
+            site (str): call site for the statistics, defaults to file:line (function) of the with statement
+        '''
+        self.name = name
         self.timeout = timeout
         self.filename = f'/tmp/{name}_lock'
         self.have_key = key  # indicates that the instance has obtained the key
+        self.owner = owner
+        self.site = site
+        self.acquired = []  # owners this instance has acquired the lock for, for nested use of one instance
 
     def __enter__(self):
-        first_timeout = False
-        start_time = time.time()
-        while not self.have_key:
-            #print("Waiting for lock")
-            try:
-                f = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                os.close(f)
-                self.have_key = True
-            except OSError as e:
-                if e.errno == errno.EEXIST:  # Failed as the file already exists.
-                    print("Locked")
-                    time.sleep(0.1)
-                else:  # Something unexpected went wrong
-                    raise
-                    #logger.error( "Problem acquiring the lock" )
-                    exit(1)
-
-                if (time.time() - start_time) > self.timeout and not first_timeout:
-                    print(f"Could not aquire a lock, please check lock file {self.filename}")
-                    print(f"Will timeout in {self.timeout}s")
-                    first_timeout = True
-                if (time.time() - start_time) > 2*self.timeout:
-                    print(f"Timeout: Could not aquire a lock, please check lock file {self.filename}")
-                    raise
+        if self.have_key:
+            return self
+        owner = threading.get_ident() if self.owner is None else self.owner
+        site = self.site
+        if site is None:
+            frame = sys._getframe(1)
+            site = f"{frame.f_code.co_filename}:{frame.f_lineno} ({frame.f_code.co_name})"
+        _get(self.filename).acquire(owner, self.timeout, site)
+        self.acquired.append(owner)
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            os.remove(self.filename)
-        except OSError:
-            #print("Tried to delete key but didn't exist")
-            pass
+        if self.acquired:
+            _get(self.filename).release(self.acquired.pop())
+
+def stats(name: str = None) -> dict:
+    '''
+    Lock statistics of this process. Times are in seconds.
+
+        {'/tmp/<name>_lock': {
+            'count', 'contended', 'wait', 'wait_max', 'hold', 'hold_max',  # totals
+            'holder': {'pid', 'site', 'since'} or None,  # current holder in this process
+            'sites': {<call site>: {'count', 'contended', 'wait', ...}},
+            'blocked_by': {'<pid> <call site>': total wait},  # who we had to wait for
+        }}
+
+    Parameters:
+        name (str): only return the statistics of this lock
+
+    Returns:
+        dict: statistics per lock file
+    '''
+    res = _stats.get()
+    if name is None:
+        return res
+    return res.get(f'/tmp/{name}_lock', {})
+
+def reset_stats():
+    '''
+    Forget all lock statistics of this process
+    '''
+    _stats.reset()
+
+def dump_stats(path: str = None) -> str:
+    '''
+    Write the lock statistics as JSON
+
+    Parameters:
+        path (str): output file, the JSON is only returned if None
+
+    Returns:
+        str: JSON with the pid of this process and the statistics, see stats
+    '''
+    res = json.dumps({'pid': os.getpid(), 'argv': sys.argv, 'locks': stats()}, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(res)
+    return res
+
+def log_stats(level: int = logging.INFO):
+    '''
+    Log a summary line per lock
+    '''
+    for filename, entry in stats().items():
+        logger.log(level, f"{filename}: {entry['count']} times, {entry['contended']} contended, "
+                          f"waited {entry['wait']:.3f}s (max {entry['wait_max']:.3f}s), "
+                          f"held {entry['hold']:.3f}s (max {entry['hold_max']:.3f}s)")
+
+if os.environ.get('COCINA_LOCK_STATS'):
+    atexit.register(lambda: dump_stats(os.environ['COCINA_LOCK_STATS'].replace('{pid}', str(os.getpid()))))
@@ -2,44 +2,56 @@
 #
 # User manual: https://siglentna.com/wp-content/uploads/dlm_uploads/2022/11/SPD3303X_QuickStart_E02A.pdf
 #
+import asyncio
 import time
 
 from .colors import green, red, yellow, dummy
 from .SkippyDevice import SkippyDevice
+from .AsyncSkippyDevice import AsyncSkippyDevice
 from .GlobalLock import GlobalLock
 
 topline = "┏━" + "━"*20 + "━┓"
 botline = "┗━" + "━"*20 + "━┛"
 
+def print_monitor(res, states):
+    for channel in res:
+        if states[channel] == 1: colored = green
+        elif states[channel] == 0: colored = red
+        print(colored(topline))
+        print(colored( "┃ {:10}{:10} ┃".format("Channel", channel) ))
+        print(colored( "┃ {:10}{:10} ┃".format("Voltage", res[channel]["Voltage"]) ))
+        print(colored( "┃ {:10}{:10} ┃".format("Current", res[channel]["Current"]) ))
+        print(colored(botline))
+
 class PowerSupply(SkippyDevice):
     def __init__(self,
                  name,
                  ip,
                  port=5025,
                  timeout=1,
+                 cache=False,
+                 sync='sleep',
+                 transport=None,
                  ):
 
-        self.key = False
-        with GlobalLock(ip, key=self.key):
-            super().__init__(ip, port, name, timeout)
+        with GlobalLock(ip):
+            super().__init__(ip, port, name, timeout, cache=cache, sync=sync, transport=transport)
             self.channels = ['CH1', 'CH2', 'CH3']
             self.mon_channels = ['CH1', 'CH2'] # CH3 not working
             self.timeout = timeout
-            self.key = True
             try:
                 self.id()
                 self.status()
             except:
                 print("Couldn't query ID or status")
                 raise
-            self.key=False
             #print(f"Connected to PSU@{self.ip}")
             #print(f" - ID: {self.model}, {self.sn}")
 
 
     def id(self):
         # identical to "echo "*IDN?" | netcat -q 1 {IP} {PORT}"
-        with GlobalLock(self.ip, key=self.key):
+        with GlobalLock(self.ip):
             res = self.query('*IDN?').split(',')
             try:
                 self.model = res[1]
@@ -52,7 +64,7 @@ class PowerSupply(SkippyDevice):
                 self.sn = '0.815'
 
     def status(self):
-        with GlobalLock(self.ip, key=self.key):
+        with GlobalLock(self.ip):
             res = int(self.query('SYSTEM:STATUS?'), 16)
             self.CH1 = (res >> 4) & 0x1
             self.CH2 = (res >> 5) & 0x1
@@ -67,25 +79,34 @@ class PowerSupply(SkippyDevice):
             cmd = f"MEASURE:{parameter}? {channel}"
             return float(self.query(cmd))
 
+    def snapshot(self, parameters=('VOLTAGE', 'CURRENT')):
+        '''
+        Measure several parameters on all monitored channels.
+        The queries are pipelined, so the whole snapshot costs about one round trip.
+
+        Parameters:
+            parameters (tuple): parameters to measure, any of VOLTAGE, CURRENT, POWER
+
+        Returns:
+            dict: {channel: {'Voltage': float, 'Current': float, ...}}
+        '''
+        parameters = [parameter.upper() for parameter in parameters]
+        keys = [(channel, parameter) for channel in self.mon_channels for parameter in parameters]
+        with GlobalLock(self.ip):
+            values = self.pipeline([f"MEASURE:{parameter}? {channel}" for channel, parameter in keys])
+
+        res = {channel: {} for channel in self.mon_channels}
+        for (channel, parameter), value in zip(keys, values):
+            res[channel][parameter.capitalize()] = float(value)
+        return res
+
     def monitor(self):
 
         status = self.status()
 
-        res = {}
-        for channel in self.mon_channels:
-            res[channel] = {}
-            res[channel]['Voltage'] = self.measure(channel = channel, parameter = 'VOLTAGE')
-            res[channel]['Current'] = self.measure(channel = channel, parameter = 'CURRENT')
-
+        res = self.snapshot()
 
-        for channel in self.mon_channels:
-            if getattr(self, channel) == 1: colored = green
-            elif getattr(self, channel) == 0: colored = red
-            print(colored(topline))
-            print(colored( "┃ {:10}{:10} ┃".format("Channel", channel) ))
-            print(colored( "┃ {:10}{:10} ┃".format("Voltage", res[channel]["Voltage"]) ))
-            print(colored( "┃ {:10}{:10} ┃".format("Current", res[channel]["Current"]) ))
-            print(colored(botline))
+        print_monitor(res, {channel: getattr(self, channel) for channel in self.mon_channels})
 
     def power_down(self, channel):
         assert channel.upper() in self.channels, "Selected channel does not exist"
@@ -104,7 +125,112 @@ class PowerSupply(SkippyDevice):
 
     def set_voltage(self, channel, value):
         with GlobalLock(self.ip):
-            self.send(f"{channel}:VOLT {value}")
+            self.configure(f"{channel}:VOLT", value)
 
     def set_current(self, channel, value):
-        self.send(f"{channel}:CURR {value}")
+        self.configure(f"{channel}:CURR", value)
+
+
+class AsyncPowerSupply(AsyncSkippyDevice):
+    '''
+    asyncio version of PowerSupply. Use as
+
+        async with AsyncPowerSupply("PSU", "192.168.2.1") as psu:
+            await psu.monitor()
+    '''
+    def __init__(self,
+                 name,
+                 ip,
+                 port=5025,
+                 timeout=1,
+                 cache=False,
+                 sync='sleep',
+                 ):
+        super().__init__(ip, port, name, timeout, cache=cache, sync=sync)
+        self.channels = ['CH1', 'CH2', 'CH3']
+        self.mon_channels = ['CH1', 'CH2'] # CH3 not working
+
+    async def connect(self, timeout: float = None) -> bool:
+        res = await super().connect(timeout)
+        async with self.global_lock():
+            await self.id()
+            await self.status()
+        return res
+
+    async def id(self):
+        res = (await self.query('*IDN?')).split(',')
+        try:
+            self.model = res[1]
+            self.sn = res[2]
+            self.firmware = res[3]
+            self.hardware = res[4]
+        except IndexError:
+            print("Unexpected ID", res)
+            self.model = "Default"
+            self.sn = '0.815'
+
+    async def status(self):
+        res = int(await self.query('SYSTEM:STATUS?'), 16)
+        self.CH1 = (res >> 4) & 0x1
+        self.CH2 = (res >> 5) & 0x1
+
+    async def measure(self, channel='CH1', parameter='VOLTAGE', timeout: float = None):
+        parameter = parameter.upper()
+        channel = channel.upper()
+        assert parameter in ['VOLTAGE', 'CURRENT', 'POWER'], f"Don't know what to do with parameter {parameter}"
+        assert channel in self.mon_channels, f"Don't know what to do with channel {channel}"
+        async with self.global_lock():
+            return float(await self.query(f"MEASURE:{parameter}? {channel}", timeout=timeout))
+
+    async def snapshot(self, parameters=('VOLTAGE', 'CURRENT')):
+        '''
+        Measure several parameters on all monitored channels with pipelined queries, see PowerSupply.snapshot
+        '''
+        parameters = [parameter.upper() for parameter in parameters]
+        keys = [(channel, parameter) for channel in self.mon_channels for parameter in parameters]
+        async with self.global_lock():
+            values = await self.pipeline([f"MEASURE:{parameter}? {channel}" for channel, parameter in keys])
+
+        res = {channel: {} for channel in self.mon_channels}
+        for (channel, parameter), value in zip(keys, values):
+            res[channel][parameter.capitalize()] = float(value)
+        return res
+
+    async def monitor(self, show: bool = True):
+        '''
+        Measure voltage and current of all monitored channels.
+
+        Parameters:
+            show (bool): print the result like PowerSupply.monitor
+
+        Returns:
+            dict: {channel: {'Voltage': float, 'Current': float}}
+        '''
+        async with self.global_lock():
+            await self.status()
+        res = await self.snapshot()
+        if show:
+            print_monitor(res, {channel: getattr(self, channel) for channel in self.mon_channels})
+        return res
+
+    async def power_down(self, channel):
+        assert channel.upper() in self.channels, "Selected channel does not exist"
+        await self.send(f"OUTPUT {channel.upper()},OFF")
+
+    async def power_up(self, channel):
+        assert channel.upper() in self.channels, "Selected channel does not exist"
+        await self.send(f"OUTPUT {channel.upper()},ON")
+
+    async def cycle(self, channel=None, wait=2):
+        print(f"Turning OFF channel {channel}.")
+        await self.power_down(channel)
+        await asyncio.sleep(wait)
+        print(f"Turning ON channel {channel}.")
+        await self.power_up(channel)
+
+    async def set_voltage(self, channel, value):
+        async with self.global_lock():
+            await self.configure(f"{channel}:VOLT", value)
+
+    async def set_current(self, channel, value):
+        await self.configure(f"{channel}:CURR", value)
@@ -2,51 +2,89 @@
 
 from smbus import SMBus
 import os
+import contextlib
 from yaml import load, dump
 from yaml import CLoader as Loader, CDumper as Dumper
-
-def ffs(x):
-    '''
-    Returns the index, counting from 0, of the
-    least significant set bit in `x`.
-    from https://stackoverflow.com/questions/5520655/return-index-of-least-significant-bit-in-python
-    There really is no better way!
-    '''
-    return (x&-x).bit_length()-1
+from .RegisterMap import RegisterMap, ffs
 
 def load_yaml(f_in):
     with open(f_in, 'r') as f:
         res = load(f, Loader=Loader)
     return res
 
+def plan_spans(addresses, max_length=32, max_gap=0):
+    '''
+    Group register addresses into spans of consecutive addresses that can be read with a single block transfer.
+
+    Parameters:
+        addresses (iterable): register addresses, duplicates are fine
+        max_length (int): maximum number of registers per span (32 for SMBus block transfers)
+        max_gap (int): number of unneeded registers that may be read to join two spans
+
+    Returns:
+        list: (start address, number of registers) per span, sorted by address
+    '''
+    spans = []
+    for adr in sorted(set(addresses)):
+        if spans:
+            start, length = spans[-1]
+            if adr - (start + length) <= max_gap and adr - start < max_length:
+                spans[-1] = (start, adr - start + 1)
+                continue
+        spans.append((adr, 1))
+    return spans
+
 here = os.path.dirname(os.path.abspath(__file__))
 
 class I2C_Device():
+    max_block = 32  # SMBus limit of a block transfer
+
     def __init__(self,
                  channel=1,
                  address=0x40,
                  address_table='../address_table/dummy.yaml',
                  register_size=1,
                  debug=False,
+                 cache=False,
                  ):
+        '''
+        Parameters:
+            cache (bool): keep an image of the registers that were read or written,
+                          read-modify-write cycles then use the image instead of reading the register.
+                          Only for devices that don't change their configuration registers themselves.
+        '''
         self.channel = channel
         self.i2c_adr = address
         self.reg_size = register_size
         self.bus = SMBus(channel)
-        self.regs = load_yaml(os.path.join(here, address_table))
+        self.regs = RegisterMap.load(os.path.join(here, address_table))  # compiled once, see RegisterMap
         self.debug = debug
+        self.cache = cache
+        self.image = {}  # address -> register content
+        self.staged = None  # address -> (mask, bits) while staging
 
     def _swap_endiness(self, word):
         return ((word & 0xFF) << 8) | ((word & 0xFF00) >> 8)  # swap the bytes
 
     def _read_address(self, adr):
         if self.reg_size == 1:
-            return self.bus.read_byte_data(self.i2c_adr, adr)
+            res = self.bus.read_byte_data(self.i2c_adr, adr)
         elif self.reg_size == 2:
             res = self.bus.read_word_data(self.i2c_adr, adr)
-            return self._swap_endiness(res)  # NOTE: swapping is currently hardcoded
+            res = self._swap_endiness(res)  # NOTE: swapping is currently hardcoded
         else:
             raise NotImplementedError("Can't read more than 2 bytes currently")
+        if self.cache:
+            self.image[adr] = res
+        return res
+
+    def _register_content(self, adr):
+        '''
+        Current content of a register, from the image if the cache is enabled
+        '''
+        if self.cache and adr in self.image:
+            return self.image[adr]
+        return self._read_address(adr)
 
     def _write_address(self, adr, val):
         if self.debug:
@@ -58,30 +96,105 @@ class I2C_Device():
             self.bus.write_word_data(self.i2c_adr, adr, val)
         else:
             raise NotImplementedError("Can't write more than 2 bytes currently")
+        if self.cache:
+            self.image[adr] = val if self.reg_size == 1 else self._swap_endiness(val)
 
     def get_adr(self, reg):
-        return self.regs[reg]['address']
+        return self.regs[reg].address
 
     def get_mask(self, reg):
-        return self.regs[reg]['mask']
+        return self.regs[reg].mask
 
     def get_shift(self, reg):
-        return ffs(self.get_mask(reg))
+        return self.regs[reg].shift
+
+    def _read_span(self, start, length):
+        '''
+        Read length consecutive registers, with a single block transfer for 8 bit registers
+        '''
+        if self.reg_size == 1 and length > 1:
+            res = self.bus.read_i2c_block_data(self.i2c_adr, start, length)
+            if self.cache:
+                self.image.update(zip(range(start, start + length), res))
+            return res
+        return [self._read_address(adr) for adr in range(start, start + length)]
+
+    def read_registers(self, addresses, max_gap=0):
+        '''
+        Read the full content of several registers, with as few bus transactions as possible.
+        Registers wider than 8 bit are read one by one, since their address pointer does not auto-increment.
+
+        Parameters:
+            addresses (iterable): register addresses
+            max_gap (int): number of unneeded registers that may be read to join two block transfers
+
+        Returns:
+            dict: {address: register content}
+        '''
+        if self.reg_size == 1:
+            spans = plan_spans(addresses, self.max_block, max_gap)
+        else:
+            spans = [(adr, 1) for adr in sorted(set(addresses))]
+        res = {}
+        for start, length in spans:
+            res.update(zip(range(start, start + length), self._read_span(start, length)))
+        return res
+
+    def read_many(self, regs, max_gap=0):
+        '''
+        Read several fields, see read_registers. Fields that share a register are decoded from a single read.
+
+        Parameters:
+            regs (iterable): field names
+            max_gap (int): number of unneeded registers that may be read to join two block transfers
+
+        Returns:
+            dict: {field name: value}
+        '''
+        fields = [self.regs[reg] for reg in regs]
+        content = self.read_registers([field.address for field in fields], max_gap)
+        return {field.name: (content[field.address] & field.mask) >> field.shift for field in fields}
 
     def read(self, reg):
-        # NOTE get the address here
-        adr = self.get_adr(reg)
-        shift = self.get_shift(reg)
-        mask = self.get_mask(reg)
-        res = self._read_address(adr)
-        return (res & mask) >> shift
+        field = self.regs[reg]
+        res = self._read_address(field.address)
+        return (res & field.mask) >> field.shift
 
     def write(self, reg, val):
-        # NOTE get the address here
-        adr = self.get_adr(reg)
-        shift = self.get_shift(reg)
-        mask = self.get_mask(reg)
-        tmp = self._read_address(adr)
+        field = self.regs[reg]
+        adr, shift, mask = field.address, field.shift, field.mask
+        if self.staged is not None:
+            staged_mask, bits = self.staged.get(adr, (0, 0))
+            self.staged[adr] = (staged_mask | mask, (bits & ~mask) | ((val << shift) & mask))
+            return
+        tmp = self._register_content(adr)
         val_to_write = (val << shift) | (tmp & ~mask)
         self._write_address(adr, val_to_write)
 
+    @contextlib.contextmanager
+    def stage(self):
+        '''
+        Collect the field writes in the block and merge them per register,
+        so that each register is read and written at most once, in the order the registers were first written to.
+        Registers whose fields are all written are not read at all.
+        Nothing is written if the block raises an exception.
+
+            with dev.stage():
+                dev.write("OSRS_T", 5)
+                dev.write("MODE", 1)
+        '''
+        if self.staged is not None:
+            # nested, the outermost stage commits
+            yield
+            return
+        self.staged = {}
+        try:
+            yield
+            staged, self.staged = self.staged, None
+            full = (1 << 8*self.reg_size) - 1
+            for adr, (mask, bits) in staged.items():
+                tmp = 0 if mask == full else self._register_content(adr)
+                self._write_address(adr, bits | (tmp & ~mask))
+        finally:
+            self.staged = None
+
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+'''
+Register maps of I2C devices, compiled from the YAML address tables.
+
+    regs = RegisterMap.load('address_table/BME280.yaml')
+    field = regs['OSRS_T']
+    value = (content & field.mask) >> field.shift
+
+Parsing YAML is slow compared to talking to a sensor, so a compiled map is kept in memory,
+and on disk (in $COCINA_CACHE, default ~/.cache/cocina), keyed by the path and modification time of the table.
+The disk cache is plain JSON, so that a cache directory shared with others can't be used to run code.
+'''
+
+import os
+import json
+import hashlib
+import logging
+from yaml import load
+from yaml import CLoader as Loader
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+
+def ffs(x):
+    '''
+    Returns the index, counting from 0, of the
+    least significant set bit in `x`.
+    from https://stackoverflow.com/questions/5520655/return-index-of-least-significant-bit-in-python
+    There really is no better way!
+    '''
+    return (x&-x).bit_length()-1
+
+def cache_dir():
+    return os.environ.get('COCINA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'cocina'))
+
+class Field:
+    __slots__ = ('name', 'address', 'mask', 'shift', 'default', 'type', 'doc')
+
+    def __init__(self, name: str, address: int, mask: int, default: int = 0, type: str = None, doc: str = ''):
+        '''
+        A field of a register, with the shift precomputed from the mask
+        '''
+        self.name = name
+        self.address = address
+        self.mask = mask
+        self.shift = ffs(mask) if mask else 0
+        self.default = default
+        self.type = type
+        self.doc = doc
+
+    def as_tuple(self) -> tuple:
+        return (self.name, self.address, self.mask, self.default, self.type, self.doc)
+
+    def __repr__(self):
+        return f"Field({self.name}, address={hex(self.address)}, mask={hex(self.mask)})"
+
+def as_int(value) -> int:
+    '''
+    Numbers from the address tables, where an incomplete entry like "mask: 0x" is read as a string and taken as 0
+    '''
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value), 0)
+    except ValueError:
+        return 0
+
+class RegisterMap:
+    _loaded = {}  # path -> (mtime, map), shared by all devices of a process
+
+    def __init__(self, fields: list):
+        '''
+        Parameters:
+            fields (list): Field objects
+        '''
+        self.fields = {field.name: field for field in fields}
+
+    def __getitem__(self, name: str) -> Field:
+        return self.fields[name]
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    @classmethod
+    def compile(cls, table: dict):
+        '''
+        Compile the content of an address table, {name: {'address': ..., 'mask': ..., 'default': ..., 'type': ..., 'doc': ...}}
+        '''
+        fields = []
+        for name, entry in table.items():
+            mask = as_int(entry.get('mask', 0))
+            if not mask:
+                logger.warning(f"RegisterMap: Field {name} has no valid mask ({entry.get('mask')}).")
+            fields.append(Field(name, as_int(entry['address']), mask, as_int(entry.get('default', 0)),
+                                entry.get('type'), entry.get('doc', '')))
+        return cls(fields)
+
+    @classmethod
+    def from_yaml(cls, f_in: str):
+        with open(f_in, 'r') as f:
+            return cls.compile(load(f, Loader=Loader))
+
+    @classmethod
+    def load(cls, f_in: str, use_cache: bool = True):
+        '''
+        Compiled register map of an address table, from memory or the disk cache if the table didn't change
+
+        Parameters:
+            f_in (str): path of the YAML address table
+            use_cache (bool): use and update the disk cache
+
+        Returns:
+            RegisterMap: the map
+        '''
+        path = os.path.abspath(f_in)
+        mtime = os.stat(path).st_mtime_ns
+        loaded = cls._loaded.get(path)
+        if loaded and loaded[0] == mtime:
+            return loaded[1]
+
+        cache_file = os.path.join(cache_dir(), hashlib.sha1(path.encode()).hexdigest()[:16] + '.json')
+        regs = None
+        if use_cache:
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                if cached['version'] == CACHE_VERSION and cached['path'] == path and cached['mtime'] == mtime:
+                    regs = cls([Field(*field) for field in cached['fields']])
+            except Exception:
+                pass  # missing or unreadable, compile again
+        if regs is None:
+            regs = cls.from_yaml(path)
+            if use_cache:
+                regs._dump(cache_file, path, mtime)
+        cls._loaded[path] = (mtime, regs)
+        return regs
+
+    def _dump(self, cache_file: str, path: str, mtime: int):
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}"
+            with open(tmp, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'path': path, 'mtime': mtime,
+                           'fields': [field.as_tuple() for field in self.fields.values()]}, f)
+            os.replace(tmp, cache_file)  # atomic, readers never see a partial file
+        except OSError as e:
+            logger.debug(f"RegisterMap: Can't write cache {cache_file}: {e}")
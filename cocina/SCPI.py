@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+'''
+Protocol core shared by the blocking (SkippyDevice) and asyncio (AsyncSkippyDevice) SCPI devices.
+Everything in here is transport agnostic: it only deals with bytes and strings.
+'''
+
+import numpy as np
+
+TERMINATOR = b'\n'
+
+def encode(msg: str) -> bytes:
+    '''
+    Encode a message for the wire, appending the terminator
+
+    Parameters:
+        msg (str): The message to be sent to the device
+
+    Returns:
+        bytes: encoded message
+    '''
+    return f"{msg}".encode('utf-8') + TERMINATOR
+
+def decode(raw: bytes) -> str:
+    '''
+    Decode a response from the device, stripping whitespace and the terminator
+
+    Parameters:
+        raw (bytes): raw response
+
+    Returns:
+        str: decoded response
+    '''
+    return bytes(raw).decode('utf-8').strip()
+
+def compare(res: str, value, rtol: float = 1e-5) -> bool:
+    '''
+    Compare a readback with the value that was written.
+    Numbers are compared with a relative tolerance only, so that small values (ns, nA) are told apart,
+    everything else as strings.
+
+    Parameters:
+        res (str): readback from the device
+        value (any): value that was written
+        rtol (float): relative tolerance, 0 for an exact comparison
+
+    Returns:
+        bool: True if readback and value agree
+    '''
+    try:
+        return bool(np.isclose(float(res), float(value), rtol=rtol, atol=0))
+    except ValueError:
+        # if return value is not a number, compare the strings
+        return res == str(value)
+
+def join_commands(msgs: list, compound: bool = True, max_length: int = 1024) -> list:
+    '''
+    Join commands for a single transfer.
+    Compound commands are joined with ';', with a leading ':' so that each command starts from the root,
+    otherwise the commands are joined with the terminator.
+
+    Parameters:
+        msgs (list): commands
+        compound (bool): join into compound commands, if the device supports them
+        max_length (int): maximum length of a compound command
+
+    Returns:
+        list: messages to send
+    '''
+    if not compound:
+        return ['\n'.join(msgs)] if msgs else []
+    res = []
+    current = ''
+    for msg in msgs:
+        msg = msg.strip()
+        if not msg.startswith((':', '*')):
+            msg = ':' + msg
+        if current and len(current) + len(msg) + 1 > max_length:
+            res.append(current)
+            current = ''
+        current = f"{current};{msg}" if current else msg
+    if current:
+        res.append(current)
+    return res
+
+def parse_error(res: str) -> tuple:
+    '''
+    Parse the reply to SYST:ERR?, e.g. '-113,"Undefined header"' or '0  No Error'
+
+    Returns:
+        tuple: (error code, message)
+    '''
+    code, _, msg = res.strip().replace(',', ' ', 1).partition(' ')
+    return int(code), msg.strip().strip('"')
+
+def parse_block_header(header) -> tuple:
+    '''
+    Parse the header of an IEEE 488.2 definite length arbitrary block, #<n><length>
+
+    Parameters:
+        header (bytes-like): the first 2+n bytes of the block, or at least 2 bytes to get the header length
+
+    Returns:
+        tuple: (length of the header, length of the data), data length is None for an indefinite block (#0) or an incomplete header
+    '''
+    if header[0:1] != b'#':
+        raise ValueError(f"Expected an arbitrary block starting with '#', got {bytes(header[:16])}")
+    n = int(bytes(header[1:2]))
+    if n == 0:
+        return 2, None
+    if len(header) < 2+n:
+        return 2+n, None
+    return 2+n, int(bytes(header[2:2+n]))
+
+def as_bytes_view(out) -> memoryview:
+    '''
+    Flat, writable byte view on a bytearray or (C-contiguous) numpy array
+    '''
+    view = memoryview(out)
+    if view.readonly:
+        raise ValueError("Output buffer is read-only")
+    return view.cast('B') if view.format != 'B' or view.ndim != 1 else view
+
+class FrameReader():
+    def __init__(self, recv_into, size: int = 65536):
+        '''
+        Buffered reader that frames responses on the terminator,
+        or as IEEE 488.2 definite length blocks (#<n><length><data>).
+        Block data is received straight into the destination buffer.
+
+        Parameters:
+            recv_into (callable): function filling a memoryview and returning the number of bytes, e.g. socket.recv_into
+            size (int): initial size of the internal buffer, grows for long lines
+        '''
+        self.recv_into = recv_into
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.scanned = 0  # position up to which the buffer has been searched for a terminator
+        self.skip_terminator = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        '''
+        Discard all buffered data
+        '''
+        self.start = self.end = self.scanned = 0
+        self.skip_terminator = False
+
+    def _recv(self, view) -> int:
+        n = self.recv_into(view)
+        if not n:
+            raise ConnectionError("Connection closed by device")
+        return n
+
+    def _fill(self):
+        '''
+        Receive more data into the internal buffer, compacting or growing it if full
+        '''
+        if self.end == len(self.buffer):
+            n = self.end - self.start
+            if self.start > 0:
+                self.buffer[:n] = self.buffer[self.start:self.end]
+            else:
+                self.buffer = self.buffer + bytearray(len(self.buffer))
+                self.view = memoryview(self.buffer)
+            self.scanned -= self.start
+            self.start, self.end = 0, n
+        self.end += self._recv(self.view[self.end:])
+
+    def _skip_terminator(self):
+        # the terminator after a block is consumed lazily, so that reading a block never blocks on it
+        if self.skip_terminator:
+            while len(self) < 1:
+                self._fill()
+            if self.buffer[self.start] == ord('\r'):
+                self.start += 1
+                while len(self) < 1:
+                    self._fill()
+            if self.buffer[self.start:self.start+1] == TERMINATOR:
+                self.start += 1
+            self.scanned = max(self.scanned, self.start)
+            self.skip_terminator = False
+
+    def read_line(self) -> bytes:
+        '''
+        Read up to the next terminator
+
+        Returns:
+            bytes: the response without the terminator
+        '''
+        self._skip_terminator()
+        self.scanned = max(self.scanned, self.start)
+        while True:
+            idx = self.buffer.find(TERMINATOR, self.scanned, self.end)
+            if idx >= 0:
+                line = bytes(self.view[self.start:idx])
+                self.start = self.scanned = idx + len(TERMINATOR)
+                return line
+            self.scanned = self.end
+            self._fill()
+
+    def read_into(self, out) -> memoryview:
+        '''
+        Fill out completely, first from the internal buffer, then directly from the transport
+
+        Parameters:
+            out (bytearray, memoryview or numpy array): destination
+
+        Returns:
+            memoryview: byte view on out
+        '''
+        view = as_bytes_view(out)
+        n = min(len(self), len(view))
+        view[:n] = self.view[self.start:self.start+n]
+        self.start += n
+        self.scanned = max(self.scanned, self.start)
+        while n < len(view):
+            n += self._recv(view[n:])
+        return view
+
+    def read_block(self, out=None) -> memoryview:
+        '''
+        Read an IEEE 488.2 arbitrary block
+
+        Parameters:
+            out (bytearray or numpy array): preallocated destination, allocated if None
+
+        Returns:
+            memoryview: byte view on the block data inside out
+        '''
+        self._skip_terminator()
+        while len(self) < 2:
+            self._fill()
+        header_len, length = parse_block_header(self.view[self.start:self.start+2])
+        if header_len == 2:
+            # indefinite length block, terminated by the terminator
+            self.start += 2
+            data = self.read_line()
+            view = as_bytes_view(bytearray(len(data)) if out is None else out)
+            view[:len(data)] = data
+            return view[:len(data)]
+        while len(self) < header_len:
+            self._fill()
+        header_len, length = parse_block_header(self.view[self.start:self.start+header_len])
+        self.start += header_len
+        if out is None:
+            out = bytearray(length)
+        view = as_bytes_view(out)
+        if len(view) < length:
+            raise ValueError(f"Output buffer of {len(view)} bytes is too small for block of {length} bytes")
+        self.read_into(view[:length])
+        self.skip_terminator = True
+        return view[:length]
+
+class ShadowState():
+    def __init__(self, enabled: bool = False):
+        '''
+        Last value written to (or read back from) each setting of a device, used to drop writes that would not change anything.
+        Written values are assumed to be applied, they are not read back.
+        The state is forgotten when the device is reset (*RST, *RCL) or reconnected.
+
+        Parameters:
+            enabled (bool): if False, nothing is ever considered unchanged
+        '''
+        self.enabled = enabled
+        self.values = {}
+
+    @staticmethod
+    def key(cmd: str) -> str:
+        return cmd.strip().lstrip(':').upper()
+
+    def __contains__(self, cmd):
+        return self.key(cmd) in self.values
+
+    def get(self, cmd: str, default=None):
+        return self.values.get(self.key(cmd), default)
+
+    def unchanged(self, cmd: str, value) -> bool:
+        '''
+        Returns:
+            bool: True if the cache is enabled and cmd is known to be set to value already
+        '''
+        return self.enabled and cmd in self and compare(str(self.get(cmd)), value, rtol=0)
+
+    def update(self, cmd: str, value):
+        self.values[self.key(cmd)] = value
+
+    def invalidate(self, *cmds):
+        '''
+        Forget the given settings, or everything if no setting is given.
+        Settings are matched by prefix, e.g. "C1:BSWV" forgets all basic wave parameters of channel 1.
+        '''
+        if not cmds:
+            self.values.clear()
+            return
+        prefixes = tuple(self.key(cmd) for cmd in cmds)
+        for key in [key for key in self.values if key.startswith(prefixes)]:
+            del self.values[key]
+
+    def observe(self, msg: str):
+        '''
+        Check a message that is sent to the device for commands that change the state of the device as a whole
+        '''
+        if msg.strip().upper().startswith(('*RST', '*RCL')):
+            self.invalidate()
+
+SYNC_MODES = ['sleep', 'opc', 'adaptive']
+
+def is_query(msg: str) -> bool:
+    return '?' in msg
+
+def header(msg: str) -> str:
+    '''
+    Command header without parameters, e.g. "C1:BSWV" for "C1:BSWV WIDTH,1e-6"
+    '''
+    return msg.strip().split(' ', 1)[0].lstrip(':').upper()
+
+def batch_key(msgs: list) -> str:
+    '''
+    Key under which the settle time of a batch of commands is learned, e.g. "SOUR:VOLT;SOUR:VOLT:RANG"
+    '''
+    return ';'.join(sorted({header(msg) for msg in msgs}))
+
+class AdaptiveSettle():
+    def __init__(self, learn: int = 3, margin: float = 1.5, floor: float = 0.001):
+        '''
+        Learn how long a device actually needs after each command.
+        The first `learn` times a command is sent, the device is synchronized with *OPC?
+        and the time it took beyond a plain *OPC? round trip is recorded.
+        Afterwards, the device only waits for the largest recorded time (times margin),
+        or not at all if that is below floor.
+
+        Parameters:
+            learn (int): number of synchronized samples per command header
+            margin (float): safety factor on the largest recorded time
+            floor (float): settle times below this are ignored, in s
+        '''
+        self.learn = learn
+        self.margin = margin
+        self.floor = floor
+        self.baseline = None  # round trip of *OPC? on an idle device
+        self.samples = {}
+
+    def learning(self, msg: str) -> bool:
+        return len(self.samples.get(header(msg), [])) < self.learn
+
+    def record(self, msg: str, elapsed: float):
+        '''
+        Record the time between sending msg and the reply to the following *OPC?
+        '''
+        self.samples.setdefault(header(msg), []).append(max(elapsed - (self.baseline or 0), 0))
+
+    def delay(self, msg: str) -> float:
+        '''
+        Returns:
+            float: time to wait after sending msg, in s
+        '''
+        samples = self.samples.get(header(msg))
+        if not samples:
+            return 0
+        delay = max(samples)*self.margin
+        return delay if delay >= self.floor else 0
+
+    def reset(self):
+        self.baseline = None
+        self.samples.clear()
@@ -3,14 +3,37 @@
 Parent class for all SCPI devices
 '''
 
+import contextlib
 import logging
 import threading
 import time
 import socket
-import numpy as np
+from collections import deque
+from concurrent.futures import Future
+
+from . import SCPI
+
+class PendingReply(Future):
+    '''
+    Future for the reply of a pipelined query, see SkippyDevice.submit.
+    Asking for the result reads all replies up to (and including) this one.
+    '''
+    def __init__(self, device, msg: str):
+        super().__init__()
+        self.device = device
+        self.msg = msg
+
+    def result(self, timeout=None):
+        if not self.done():
+            self.device.collect(until=self)
+        return super().result(timeout)
 
 class SkippyDevice():
-    def __init__(self, ip: str, port: int, name: str = "", timeout: int = 1, wait: int = 0):
+    compound = False  # the device accepts ';' separated compound commands, see batch
+    check_errors = True  # check the error queue after a batch
+
+    def __init__(self, ip: str, port: int, name: str = "", timeout: int = 1, wait: int = 0, cache: bool = False, sync: str = "sleep",
+                 transport=None):
         '''
         Initialize a SCPI device, with a default timeout for socket transactions.
         For some (slow?) devices a wait time between send and receive is necessary.
@@ -21,6 +44,9 @@ class SkippyDevice():
             name (str): arbitrary name used for the python instance of the device
             timeout (int): timeout of socket transaction in seconds
             wait (int): wait time between after sending a message
+            cache (bool): remember settings and skip writes that would not change them, see configure
+            sync (str): how to wait for the device after a command, see set_sync
+            transport (RemoteDevice): send everything through the broker instead of a connection of our own, see from_broker
         '''
 
         self.name       = name
@@ -31,12 +57,40 @@ class SkippyDevice():
         self.wait       = wait
 
         self.logger     = logging.getLogger(__name__)
-        self.lock       = threading.Lock()
+        self.lock       = threading.RLock()
+        self.pipe_lock  = threading.RLock()  # keeps pipelined sends and their replies in order
+        self.pending    = deque()
+        self.frames     = SCPI.FrameReader(self._recv_into)
+        self.state      = SCPI.ShadowState(cache)
+        self.batched    = None  # commands collected by batch
+        self.batch_owner = None
+        self.timing     = SCPI.AdaptiveSettle()
+        self.set_sync(sync)
+        self.transport  = transport
+        self.replies    = deque()  # replies from the transport that were not read yet
 
         self.lstr = f"{self.name} @ {self.ip}:{self.port}"
 
         self.connect()
 
+    @classmethod
+    def from_broker(cls, remote, **kwargs):
+        '''
+        Instrument that talks to the device through the broker, without a connection (and *IDN?) of its own:
+
+            with BrokerClient() as broker:
+                psu = PowerSupply.from_broker(broker.device('Readout'))
+
+        The broker settles every command with the sync mode of its own connection, binary transfers are not available.
+        GlobalLock sections of the instrument lock "broker_<name>", so that they serialize the broker clients
+        without blocking the broker itself.
+
+        Parameters:
+            remote (RemoteDevice): the device, from BrokerClient.device
+            kwargs: further arguments of the instrument class, e.g. cache
+        '''
+        return cls(name=remote.name, ip=f"broker_{remote.name}", port=None, transport=remote, **kwargs)
+
     def connect(self) -> bool:
         '''
         Socket based connection
@@ -45,8 +99,17 @@ class SkippyDevice():
             bool: True for a successful connection
         '''
         with self.lock:
+            self._fail_pending(ConnectionError(f"{self.lstr}: Connection was reset"))
+            self.frames.clear()
+            self.state.invalidate()
+            self.timing.baseline = None
+            if self.transport:
+                self.replies.clear()
+                return True
             self.dev = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.dev.settimeout(self.timeout)
+            # small commands are sent back-to-back, don't let Nagle hold them back
+            self.dev.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             #self.dev.setblocking(0)
             self.dev.connect((self.ip, self.port))
             #context = zmq.Context()
@@ -59,22 +122,233 @@ class SkippyDevice():
         else:
             return False
 
-    def send(self, msg: str):
+    def send(self, msg: str, settle: bool = True):
         '''
         Send a message to the device
 
         Parameters:
             msg (str): The message to be sent to the device
+            settle (bool): wait for the device after sending the message
         '''
+        if self.batched is not None and self.batch_owner == threading.get_ident():
+            if '?' not in msg:
+                self.state.observe(msg)
+                self.batched.append(msg)
+                return
+            # queries can't be deferred
+            self.flush()
+        if self.transport:
+            with self.lock:
+                self.logger.debug(f"{self.lstr}: Sending message through the broker: {msg}")
+                self.state.observe(msg)
+                if SCPI.is_query(msg):
+                    self.replies.append(self.transport.query(msg))
+                else:
+                    self.transport.send(msg)  # settled by the broker
+            return
+        if settle and self.sync == 'adaptive' and self.timing.baseline is None and not SCPI.is_query(msg):
+            self._calibrate()
         with self.lock:
             if not self.dev:
                 self.logger.debug(f"{self.lstr}: Reconnecting")
                 self.connect()
             self.logger.debug(f"{self.lstr}: Sending message: {msg}")
-            self.dev.sendall(f"{msg}\n".encode('utf-8'))
-            if self.wait>0:
+            self.state.observe(msg)
+            start = time.perf_counter()
+            self.dev.sendall(SCPI.encode(msg))
+            if settle and self.sync == 'sleep' and self.wait>0:
                 time.sleep(self.wait)
             #self.close()
+        if settle and self.sync != 'sleep' and not SCPI.is_query(msg):
+            self._settle(msg, start)
+
+    def send_binary(self, msg: str, data, settle: bool = True):
+        '''
+        Send a command followed by binary data, e.g. waveform points.
+        The data is sent straight from its buffer, without copying it into the message.
+
+        Parameters:
+            msg (str): The command, the data follows it directly
+            data (bytes-like): e.g. bytes or a (C-contiguous) numpy array
+            settle (bool): wait for the device after sending the message
+        '''
+        if self.transport:
+            raise NotImplementedError(f"{self.lstr}: Binary transfers are not supported through the broker")
+        if self.batched is not None and self.batch_owner == threading.get_ident():
+            self.flush()
+        if settle and self.sync == 'adaptive' and self.timing.baseline is None:
+            self._calibrate()
+        view = memoryview(data)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        with self.lock:
+            if not self.dev:
+                self.logger.debug(f"{self.lstr}: Reconnecting")
+                self.connect()
+            self.logger.debug(f"{self.lstr}: Sending message: {msg} with {len(view)} bytes of data")
+            start = time.perf_counter()
+            self.dev.sendall(f"{msg}".encode('utf-8'))
+            self.dev.sendall(view)
+            self.dev.sendall(SCPI.TERMINATOR)
+            if settle and self.sync == 'sleep' and self.wait>0:
+                time.sleep(self.wait)
+        if settle and self.sync != 'sleep':
+            self._settle(msg, start)
+
+    def set_sync(self, mode: str):
+        '''
+        Select how to wait for the device after a command:
+            'sleep': sleep for the fixed wait time
+            'opc': query *OPC? after every command, waits exactly as long as the device needs
+            'adaptive': use *OPC? for the first few commands of each kind to learn how long they take,
+                        afterwards only sleep if a command was found to need it
+
+        Parameters:
+            mode (str): one of 'sleep', 'opc', 'adaptive'
+        '''
+        if mode not in SCPI.SYNC_MODES:
+            raise ValueError(f"Unknown sync mode {mode}, use one of {SCPI.SYNC_MODES}")
+        self.sync = mode
+
+    def _settle(self, msg: str, start: float):
+        '''
+        Wait for the device after msg was sent at start (time.perf_counter), in opc or adaptive mode
+        '''
+        if self.sync == 'opc':
+            self.opc()
+            return
+        if self.timing.learning(msg):
+            self.opc()
+            self.timing.record(msg, time.perf_counter() - start)
+            return
+        delay = self.timing.delay(msg) - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _calibrate(self, n: int = 3):
+        '''
+        Measure the round trip of *OPC? on the idle device, the baseline for adaptive settle times
+        '''
+        times = []
+        for _ in range(n):
+            start = time.perf_counter()
+            self.opc()
+            times.append(time.perf_counter() - start)
+        self.timing.baseline = min(times)
+        self.logger.debug(f"{self.lstr}: *OPC? round trip is {self.timing.baseline*1e3:.2f} ms.")
+
+    @contextlib.contextmanager
+    def batch(self, compound: bool = None, check: bool = None):
+        '''
+        Collect all commands sent inside the context and send them in a single transfer,
+        followed by a single settle wait instead of one per command.
+        Errors are checked once at the end with SYST:ERR?. Queries inside the context flush the batch first.
+        If an exception is raised inside the context, the collected commands are dropped.
+
+            with dev.batch():
+                dev.send(":SOURCE:VOLT 0")
+                dev.send(":SOURCE:VOLT:RANGE 20")
+
+        Parameters:
+            compound (bool): join commands with ';' into compound commands, defaults to the device setting
+            check (bool): check for errors after sending and raise a RuntimeError if there are any, defaults to the device setting
+        '''
+        if self.batched is not None and self.batch_owner == threading.get_ident():
+            # nested batch, joins the outer one
+            yield self
+            return
+        with self.pipe_lock:
+            self.batched = []
+            self.batch_sent = 0
+            self.batch_owner = threading.get_ident()
+            self.batch_compound = self.compound if compound is None else compound
+            try:
+                yield self
+            except BaseException:
+                self.logger.debug(f"{self.lstr}: Dropping {len(self.batched)} batched commands.")
+                self.batched = None
+                self.batch_owner = None
+                self.state.invalidate()
+                raise
+            try:
+                self.flush()
+            finally:
+                self.batched = None
+                self.batch_owner = None
+            if (self.check_errors if check is None else check) and self.batch_sent:
+                errors = self.errors()
+                if errors:
+                    self.state.invalidate()
+                    raise RuntimeError(f"{self.lstr}: Errors after batch: {errors}")
+
+    def flush(self) -> int:
+        '''
+        Send the commands collected by batch
+
+        Returns:
+            int: number of commands sent
+        '''
+        if not self.batched:
+            return 0
+        msgs, self.batched = self.batched, []
+        self.batch_sent += len(msgs)
+        if self.transport:
+            for msg in SCPI.join_commands(msgs, self.batch_compound):
+                self.transport.send(msg)
+            return len(msgs)
+        if self.sync == 'adaptive' and self.timing.baseline is None:
+            self._calibrate()
+        with self.lock:
+            if not self.dev:
+                self.logger.debug(f"{self.lstr}: Reconnecting")
+                self.connect()
+            data = b''.join(SCPI.encode(msg) for msg in SCPI.join_commands(msgs, self.batch_compound))
+            self.logger.debug(f"{self.lstr}: Sending batch of {len(msgs)} commands: {data}")
+            start = time.perf_counter()
+            self.dev.sendall(data)
+            if self.sync == 'sleep' and self.wait>0:
+                time.sleep(self.wait)
+        if self.sync == 'opc':
+            self.opc()
+        elif self.sync == 'adaptive':
+            # the settle time is learned for the batch as a whole, like for a single command
+            self._settle(SCPI.batch_key(msgs), start)
+        return len(msgs)
+
+    def errors(self, max_errors: int = 20) -> list:
+        '''
+        Read all entries from the error queue of the device (SYST:ERR?)
+
+        Returns:
+            list: (code, message) of all errors
+        '''
+        res = []
+        for _ in range(max_errors):
+            try:
+                code, msg = SCPI.parse_error(self.query("SYST:ERR?"))
+            except ValueError:
+                break
+            if code == 0:
+                break
+            res.append((code, msg))
+        return res
+
+    def _recv_into(self, view) -> int:
+        return self.dev.recv_into(view)
+
+    def _drop(self, exc: Exception):
+        '''
+        Drop the connection after a timeout or a transport error.
+        A late or partially read response would otherwise be returned for the next query.
+        The next send reconnects.
+        '''
+        with self.lock:
+            self.logger.debug(f"{self.lstr}: Dropping connection to resynchronize.")
+            self._fail_pending(exc)
+            self.frames.clear()
+            if self.dev:
+                self.dev.close()
+            self.dev = None
 
     def read(self) -> str:
         '''
@@ -84,15 +358,75 @@ class SkippyDevice():
             str: Response from the device
         '''
         with self.lock:
+            if self.transport:
+                if not self.replies:
+                    raise ConnectionError(f"{self.lstr}: No reply from the broker to read")
+                return self.replies.popleft()
             if not self.dev:
                 self.logger.debug(f"{self.lstr}: Reconnecting")
                 self.connect()
             self.logger.debug(f"{self.lstr}: Reading message.")
-            res = self.dev.recv(4096).decode("utf-8").strip()
+            try:
+                res = SCPI.decode(self.frames.read_line())
+            except (socket.timeout, ConnectionError) as e:
+                self._drop(e)
+                raise
             self.logger.debug(f"{self.lstr}: Received message: {res}")
             #self.close()
             return res
 
+    def read_block(self, out=None) -> memoryview:
+        '''
+        Read a binary response, sent as IEEE 488.2 definite length block (#<n><length><data>).
+        The data is received directly into out, without intermediate copies.
+
+        Parameters:
+            out (bytearray or numpy array): preallocated destination, allocated if None
+
+        Returns:
+            memoryview: byte view on the received data, use np.frombuffer to interpret it
+        '''
+        if self.transport:
+            raise NotImplementedError(f"{self.lstr}: Binary transfers are not supported through the broker")
+        with self.lock:
+            if not self.dev:
+                self.logger.debug(f"{self.lstr}: Reconnecting")
+                self.connect()
+            self.logger.debug(f"{self.lstr}: Reading block.")
+            try:
+                res = self.frames.read_block(out)
+            except (socket.timeout, ConnectionError) as e:
+                self._drop(e)
+                raise
+            self.logger.debug(f"{self.lstr}: Received block of {len(res)} bytes.")
+            return res
+
+
+    def clear(self, expect: bool = False, quiet: float = 0.05):
+        '''
+        Discard buffered input and everything the device sends until it has been quiet for a while,
+        e.g. a welcome banner that is not a reply to any query.
+
+        Parameters:
+            expect (bool): wait up to the device timeout for the first data to arrive
+            quiet (float): time in seconds without new data after which the input is considered clear
+        '''
+        with self.lock:
+            if self.transport:
+                self.replies.clear()  # the broker keeps its own connection clear
+                return
+            if not self.dev:
+                self.logger.debug(f"{self.lstr}: Reconnecting")
+                self.connect()
+            self.frames.clear()
+            self.dev.settimeout(self.timeout if expect else quiet)
+            try:
+                while self.dev.recv(4096):
+                    self.dev.settimeout(quiet)
+            except socket.timeout:
+                pass
+            finally:
+                self.dev.settimeout(self.timeout)
 
     def query(self, msg:str) -> str:
         '''
@@ -104,10 +438,113 @@ class SkippyDevice():
         Returns:
             str: Response from the device
         '''
-        self.send(msg)
-        res = self.read()
+        with self.pipe_lock:
+            if self.pending:
+                self.collect()
+            self.send(msg)
+            res = self.read()
         #self.close()
         return res
+
+    def query_block(self, msg: str, out=None) -> memoryview:
+        '''
+        Submit a query with a binary block response, see read_block
+
+        Parameters:
+            msg (str): The message to be sent to the device
+            out (bytearray or numpy array): preallocated destination, allocated if None
+
+        Returns:
+            memoryview: byte view on the received data
+        '''
+        if self.transport:
+            raise NotImplementedError(f"{self.lstr}: Binary transfers are not supported through the broker")
+        with self.pipe_lock:
+            if self.pending:
+                self.collect()
+            self.send(msg)
+            return self.read_block(out)
+
+    def opc(self, timeout: float = None) -> bool:
+        '''
+        Wait until the device has completed all pending operations (*OPC?).
+
+        Parameters:
+            timeout (float): socket timeout for this query, e.g. for long running operations
+
+        Returns:
+            bool: True if the device reports completion
+        '''
+        with self.pipe_lock, self.lock:
+            if timeout is not None and self.dev:
+                self.dev.settimeout(timeout)
+            try:
+                return self.query('*OPC?') == '1'
+            finally:
+                if self.dev:
+                    self.dev.settimeout(self.timeout)
+
+    def submit(self, msg: str) -> PendingReply:
+        '''
+        Send a query without waiting for the reply (pipelined mode).
+        Replies are matched to queries in the order the queries were submitted.
+
+        Parameters:
+            msg (str): The query to be sent to the device
+
+        Returns:
+            PendingReply: future that resolves to the response from the device
+        '''
+        with self.pipe_lock:
+            self.send(msg, settle=False)
+            reply = PendingReply(self, msg)
+            self.pending.append(reply)
+        return reply
+
+    def collect(self, until: PendingReply = None):
+        '''
+        Read the replies of pipelined queries in FIFO order.
+
+        Parameters:
+            until (PendingReply): stop after this reply has been read, read all outstanding replies if None
+        '''
+        with self.pipe_lock:
+            while self.pending:
+                reply = self.pending.popleft()
+                try:
+                    reply.set_result(self.read())
+                except Exception as e:
+                    reply.set_exception(e)
+                    self._fail_pending(e)
+                    raise
+                if reply is until:
+                    break
+
+    def _fail_pending(self, exc: Exception):
+        while self.pending:
+            self.pending.popleft().set_exception(exc)
+
+    def pipeline(self, msgs: list) -> list:
+        '''
+        Send several queries back-to-back and read all replies afterwards,
+        so that the whole set costs about one network round trip.
+
+        Parameters:
+            msgs (list): queries to be sent to the device
+
+        Returns:
+            list: responses from the device, in the same order as msgs
+        '''
+        if self.transport:
+            with self.pipe_lock:
+                if self.pending:
+                    self.collect()
+                if self.batched is not None and self.batch_owner == threading.get_ident():
+                    self.flush()
+                return self.transport.pipeline(msgs)
+        replies = [self.submit(msg) for msg in msgs]
+        self.collect()
+        return [reply.result() for reply in replies]
     
     def write(self, cmd, value, strict=True) -> bool:
         '''
@@ -123,29 +560,71 @@ class SkippyDevice():
         Returns:
             bool: True if write and readback agree, False otherwise.
         '''
+        if self.state.unchanged(cmd, value):
+            self.logger.debug(f"{self.lstr}: {cmd} is already set to {value}.")
+            return True
         self.logger.debug(f"{self.lstr}: Writing {value} to {cmd}.")
         self.send(f"{cmd} {value}")
         res = self.query(f"{cmd}?")
-        try:
-            comp = np.isclose(float(res), float(value))
-        except ValueError:
-            # if return value is not a number, compare the strings
-            comp = (res == str(value))
-        if comp:
+        if SCPI.compare(res, value):
             self.logger.debug(f"{self.lstr}: Write successful.")
+            self.state.update(cmd, res)
             return True
         else:
             self.logger.debug(f"{self.lstr}: Writing to {cmd} was not successful. Expected {value}, but got {res}.")
+            self.state.invalidate(cmd)
             if strict:
                 raise ValueError(f"Writing to {cmd} was not successful. Expected {value}, but got {res}.")
             return False
 
+    def configure(self, cmd: str, value, sep: str = " ") -> bool:
+        '''
+        Set a parameter, unless the shadow state (cache) knows it is already set to this value.
+        The value is recorded without reading it back, use write to check it.
+
+        Parameters:
+            cmd (str): The command to send (i.e., message without the value to write)
+            value (any): The value to write
+            sep (str): separator between command and value, e.g. "," for Siglent key/value commands
+
+        Returns:
+            bool: True if the command was sent
+        '''
+        if self.state.unchanged(cmd, value):
+            self.logger.debug(f"{self.lstr}: {cmd} is already set to {value}.")
+            return False
+        self.send(f"{cmd}{sep}{value}")
+        self.state.update(cmd, value)
+        return True
+
+    def invalidate(self, *cmds):
+        '''
+        Forget cached settings, all of them if no command is given. See configure
+        '''
+        self.state.invalidate(*cmds)
+
+    def refresh(self, *cmds):
+        '''
+        Read back settings from the device into the cache, or forget all cached settings if no command is given.
+
+        Parameters:
+            cmds (str): commands to read back, e.g. "CH1:VOLT"
+        '''
+        if not cmds:
+            self.state.invalidate()
+            return
+        for cmd, res in zip(cmds, self.pipeline([f"{cmd}?" for cmd in cmds])):
+            self.state.update(cmd, res)
+
     def close(self):
         '''
         Close the connection to the device
         '''
         with self.lock:
             self.logger.info(f"{self.lstr}: Closing Connection.")
-            self.dev.close()
+            self._fail_pending(ConnectionError(f"{self.lstr}: Connection closed"))
+            self.replies.clear()
+            if self.dev:
+                self.dev.close()
             self.dev = None
             self.logger.info(f"{self.lstr}: Connection to SCPI Device closed.")
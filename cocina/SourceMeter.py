@@ -6,13 +6,77 @@
 # If observe error -285, change command language to SCPI (from TSP)
 from .colors import green, red, yellow, dummy
 from .SkippyDevice import SkippyDevice
+from .AsyncSkippyDevice import AsyncSkippyDevice
 from .GlobalLock import GlobalLock
 
+import time
+import asyncio
 import numpy as np
 
 topline = "┏━" + "━"*20 + "━┓"
 botline = "┗━" + "━"*20 + "━┛"
 
+def trace_dtype(single: bool = False) -> np.dtype:
+    '''
+    Structured dtype of a buffer readout with READ, SOUR, REL elements.
+    Binary data is requested with swapped (little endian) byte order.
+
+    Parameters:
+        single (bool): single precision (SREAL) instead of double precision (REAL)
+    '''
+    fmt = '<f4' if single else '<f8'
+    return np.dtype([('current', fmt), ('voltage', fmt), ('timestamp', fmt)])
+
+def trace_chunks(start: int, end: int, chunk: int):
+    '''
+    Split the (inclusive) index range of a buffer readout into chunks of at most chunk readings
+    '''
+    for i in range(start, end+1, chunk):
+        yield i, min(i+chunk-1, end)
+
+def trace_data_cmd(start: int, end: int, buffer_name: str) -> str:
+    return f'TRAC:DATA? {start}, {end}, "{buffer_name}", READ, SOUR, REL'
+
+def ring_ranges(last: int, end: int, capacity: int) -> list:
+    '''
+    Index ranges of new readings in a ring buffer (fill mode CONTinuous)
+
+    Parameters:
+        last (int): index of the last reading that has been read already, 0 if none
+        end (int): index of the newest reading in the buffer
+        capacity (int): capacity of the buffer
+
+    Returns:
+        list: inclusive (start, end) index ranges, in acquisition order
+    '''
+    if end == last or end == 0:
+        return []
+    if end > last:
+        return [(last+1, end)]
+    # the buffer wrapped around since the last readout
+    ranges = [(last+1, capacity)] if last < capacity else []
+    return ranges + [(1, end)]
+
+def trigger_running(state: str) -> bool:
+    '''
+    Interpret the reply of :TRIG:STAT?, e.g. "RUNNING;RUNNING;12"
+    '''
+    return state.split(';')[0].strip().upper() in ['RUNNING', 'WAITING', 'PAUSED', 'BUILDING']
+
+def stream_trigger_cmd(count, duration, delay, buffer_name) -> str:
+    if duration is not None:
+        return f'TRIGger:LOAD "DurationLoop", {duration}, {delay}, "{buffer_name}"'
+    return f'TRIGger:LOAD "SimpleLoop", {count}, {delay}, "{buffer_name}"'
+
+def parse_trace(res: str, out: np.ndarray):
+    '''
+    Parse an ASCII buffer readout (READ, SOUR, REL) into a structured array
+    '''
+    values = np.array(res.split(','), dtype=float).reshape(-1, 3)
+    out['current'] = values[:,0]
+    out['voltage'] = values[:,1]
+    out['timestamp'] = values[:,2]
+
 '''
 # pyvisa version
 import pyvisa as visa
@@ -29,21 +93,138 @@ smu = Keithley("TCPIP::192.168.0.77::INSTR")
 smu.id
 '''
 
+class BufferManager():
+    '''
+    Book keeping of the reading buffers on the instrument: capacity, fill mode, number of readings and last use.
+    The methods return the SCPI commands that are necessary to get a buffer into the requested state,
+    the instrument class sends them (so that the same manager works for blocking and asyncio devices).
+    Buffers are reused across calls, and only resized, cleared or reconfigured if needed.
+    '''
+    builtin = ['defbuffer1', 'defbuffer2']
+
+    def __init__(self, min_capacity: int = 10):
+        self.min_capacity = min_capacity
+        self.capacity = {}  # name -> capacity, None if unknown
+        self.fill = {}      # name -> fill mode, None if unknown
+        self.contents = {}  # name -> number of readings from the last acquisition
+        self.used = {}      # name -> time of last use
+        self.forget()
+
+    def __contains__(self, name):
+        return name in self.capacity
+
+    def __iter__(self):
+        return iter(self.capacity)
+
+    def __len__(self):
+        return len(self.capacity)
+
+    def __repr__(self):
+        return f"BufferManager({', '.join(f'{name}: {self.contents[name]}/{self.capacity[name]}' for name in self)})"
+
+    def forget(self):
+        '''
+        Reset the book keeping, e.g. after *RST which deletes all user buffers
+        '''
+        for d in [self.capacity, self.fill, self.contents, self.used]:
+            d.clear()
+        for name in self.builtin:
+            self.capacity[name] = None
+            self.fill[name] = None
+            self.contents[name] = 0
+
+    def ensure(self, name: str, capacity: int, fill: str = 'ONCE', exact: bool = False, clear: bool = True) -> list:
+        '''
+        Get a buffer with at least (or exactly) the requested capacity.
+        The builtin buffers (defbuffer1, defbuffer2) are only cleared, never resized or switched to another fill mode,
+        since the front panel and :MEAS? rely on their default setup.
+
+        Parameters:
+            name (str): name of the reading buffer
+            capacity (int): number of readings the buffer has to hold
+            fill (str): fill mode, ONCE or CONT(inuous, ring buffer)
+            exact (bool): resize unless the capacity matches exactly, e.g. for ring buffers
+            clear (bool): clear the buffer if it is reused
+
+        Returns:
+            list: commands to send
+        '''
+        if name in self.builtin:
+            if exact or fill != 'ONCE':
+                raise ValueError(f"{name} is not reconfigured for fill mode {fill}, use a user buffer")
+            self.used[name] = time.time()
+            if not clear:
+                return []
+            self.contents[name] = 0
+            return [f':TRAC:CLE "{name}"']
+        capacity = max(capacity, self.min_capacity)
+        cmds = []
+        if name not in self:
+            cmds.append(f'TRACe:MAKE "{name}", {capacity}')
+            self.fill[name] = 'ONCE'
+        elif self.capacity[name] is None or self.capacity[name] < capacity or (exact and self.capacity[name] != capacity):
+            # resizing also clears the buffer
+            cmds.append(f':TRAC:POIN {capacity}, "{name}"')
+        elif clear:
+            cmds.append(f':TRAC:CLE "{name}"')
+        else:
+            capacity = self.capacity[name]
+        if cmds:
+            self.capacity[name] = capacity
+            self.contents[name] = 0
+        if self.fill[name] != fill:
+            cmds.append(f':TRAC:FILL:MODE {fill}, "{name}"')
+            self.fill[name] = fill
+        self.used[name] = time.time()
+        return cmds
+
+    def filled(self, name: str, count: int):
+        '''
+        Record the number of readings written to a buffer by an acquisition
+        '''
+        self.contents[name] = min(count, self.capacity[name] or count)
+        self.used[name] = time.time()
+
+    def delete(self, name: str) -> list:
+        '''
+        Returns:
+            list: commands to delete a user buffer
+        '''
+        assert name not in self.builtin, f"Can't delete default buffer {name}"
+        if name not in self:
+            return []
+        for d in [self.capacity, self.fill, self.contents, self.used]:
+            d.pop(name, None)
+        return [f':TRAC:DEL "{name}"']
+
+    def stale(self, max_age: float = None, keep: list = ()) -> list:
+        '''
+        Names of the user buffers that have not been used for max_age seconds (all if None)
+        '''
+        now = time.time()
+        return [name for name in self if name not in self.builtin and name not in keep and
+                (max_age is None or now - self.used.get(name, 0) > max_age)]
+
 class SourceMeter(SkippyDevice):
+    compound = True
+
     def __init__(self,
                  name,
                  ip,
                  port=5025,
                  timeout=1,
                  wait=0.01,
+                 cache=False,
+                 sync='sleep',
+                 transport=None,
                  ):
 
         # NOTE not sure if this needs locking
-        super().__init__(ip, port, name, timeout, wait)
+        super().__init__(ip, port, name, timeout, wait, cache, sync, transport)
         self.timeout = timeout
         self.id()
         self.mode="V"
-        self.buffers = []
+        self.buffers = BufferManager()
 
     def id(self):
         with GlobalLock(self.ip):
@@ -67,16 +248,16 @@ class SourceMeter(SkippyDevice):
                          i_max: float=0.00005,
                          i_range: float=0.000105,
                          ):
-        with GlobalLock(self.ip):
+        with GlobalLock(self.ip), self.batch():
             assert i_max<i_range, f"Current limit {i_max} is larger than range {i_range}. Aborting."
             assert voltage < v_range, "Voltage is larger than voltage range. Aborting."
-            self.send(':SENS:FUNC "CURR"')
-            self.send(f":SENS:CURR:RANGE {i_range}")
-            self.send(f":SOURCE:VOLT:ILIMIT {i_max}")
-            self.send(":SOURCE:FUNCTION VOLT")
-            self.send(f":SOURCE:VOLT 0")
-            self.send(f":SOURCE:VOLT:RANGE {v_range}")
-            self.send(f":SOURCE:VOLT {voltage}")
+            self.configure(':SENS:FUNC', '"CURR"')
+            self.configure(":SENS:CURR:RANGE", i_range)
+            self.configure(":SOURCE:VOLT:ILIMIT", i_max)
+            self.configure(":SOURCE:FUNCTION", "VOLT")
+            self.configure(":SOURCE:VOLT", 0)
+            self.configure(":SOURCE:VOLT:RANGE", v_range)
+            self.configure(":SOURCE:VOLT", voltage)
             self.mode="V"
         self.measure()
 
@@ -95,30 +276,241 @@ class SourceMeter(SkippyDevice):
                     ):
         with GlobalLock(self.ip):
             if self.mode=="V":
-                self.send(f":SOURCE:VOLT {voltage}")
+                self.configure(":SOURCE:VOLT", voltage)
         self.measure()
 
     def averaged_current(self,
                          count: int = 10,
                          voltage: float = 0,
+                         binary: bool = False,
                          ):
         '''
-        NOTE: WIP
-        This function should check if the used buffer already exists.
+        Take count readings at a fixed voltage.
+        The reading buffer is reused, and only resized if count exceeds its capacity.
+
+        Parameters:
+            count (int): number of readings
+            voltage (float): source voltage
+            binary (bool): read the buffer in binary format, see read_buffer
+
+        Returns:
+            tuple: arrays of current, voltage and timestamp
         '''
-        with GlobalLock(self.ip):
+        with GlobalLock(self.ip), self.batch():
             buffer_name = 'ivbuffer'
-            if not buffer_name in self.buffers:
-                self.send(f'TRACe:MAKE "{buffer_name}", {count}')
-                self.buffers.append(buffer_name)
-                print(self.buffers)
+            for cmd in self.buffers.ensure(buffer_name, count):
+                self.send(cmd)
             self.send(f'TRIGger:LOAD "SimpleLoop", {count}, 0, "{buffer_name}"')
-            self.send(f"SOURCE:VOLT {voltage}")
+            self.configure("SOURCE:VOLT", voltage)
             self.send("INIT")
             self.send("*WAI")
-            res = np.fromstring(self.query(f'TRAC:DATA? 1, {count}, "{buffer_name}", READ, SOUR, REL'), sep=",")
+            self.buffers.filled(buffer_name, count)
+            res = self._read_buffer(buffer_name, 1, count, binary=binary)
 
-        return res[::3], res[1::3], res[2::3]  # current, voltage, timestamp
+        return res['current'], res['voltage'], res['timestamp']
+
+    def iv_sweep(self,
+                 start: float = 0,
+                 stop: float = 1,
+                 points: int = 11,
+                 delay: float = 0,
+                 compliance: float = 0.00005,
+                 mode: str = 'LIN',
+                 values: list = None,
+                 buffer_name: str = 'sweepbuffer',
+                 binary: bool = True,
+                 ):
+        '''
+        Run a voltage sweep with the trigger model of the instrument and read all points at once.
+        Stepping and measuring happens on the instrument, so the sweep runs at instrument speed.
+
+        Parameters:
+            start (float): first voltage in V
+            stop (float): last voltage in V
+            points (int): number of points
+            delay (float): source delay in s before each measurement
+            compliance (float): current limit in A
+            mode (str): LIN, LOG or LIST
+            values (list): voltages for a LIST sweep, start, stop and points are ignored
+            buffer_name (str): reading buffer used for the sweep, it gets created or cleared
+            binary (bool): read the buffer in binary format, see read_buffer
+
+        Returns:
+            tuple: arrays of current, voltage and timestamp
+        '''
+        mode = mode.upper()
+        assert mode in ['LIN', 'LOG', 'LIST'], f"Don't know sweep mode {mode}"
+        if mode == 'LIST':
+            assert values is not None and len(values) > 0, "LIST sweep needs values"
+            points = len(values)
+        if mode == 'LOG':
+            assert start*stop > 0, "LOG sweep needs start and stop of the same sign, and not 0"
+        with GlobalLock(self.ip), self.batch():
+            self.configure(':SENS:FUNC', '"CURR"')
+            self.configure(":SOURCE:FUNCTION", "VOLT")
+            self.configure(":SOURCE:VOLT:ILIMIT", compliance)
+            for cmd in self.buffers.ensure(buffer_name, points):
+                self.send(cmd)
+            if mode == 'LIST':
+                self.send(f":SOUR:LIST:VOLT {', '.join(str(v) for v in values)}")
+                self.send(f':SOUR:SWE:VOLT:LIST 1, {delay}, 1, OFF, "{buffer_name}"')
+            else:
+                self.send(f':SOUR:SWE:VOLT:{mode} {start}, {stop}, {points}, {delay}, 1, BEST, OFF, OFF, "{buffer_name}"')
+            self.mode="V"
+            self.send(":INIT")
+            # the sweep leaves the source at an unknown level
+            self.invalidate(":SOURCE:VOLT")
+            # generous upper limit, a measurement at the slowest NPLC setting takes about 0.5s
+            self.opc(timeout=self.timeout + points*(delay + 0.5))
+            self.buffers.filled(buffer_name, points)
+            res = self._read_buffer(buffer_name, 1, points, binary=binary)
+
+        return res['current'], res['voltage'], res['timestamp']
+
+    def stream(self,
+               count: int = 100,
+               duration: float = None,
+               delay: float = 0,
+               buffer_name: str = 'streambuffer',
+               capacity: int = 100000,
+               interval: float = 0.5,
+               binary: bool = True,
+               ):
+        '''
+        Start a trigger model and read the readings while they are being acquired.
+        The reading buffer is used as a ring buffer, only new readings are fetched in each poll,
+        so host memory stays bounded for arbitrarily long runs.
+        Readings are lost if more than `capacity` readings are taken between two polls.
+        Stopping the iteration early aborts the trigger model.
+
+            for chunk in smu.stream(duration=3600, interval=1):
+                print(chunk['current'].mean())
+
+        Parameters:
+            count (int): number of readings (SimpleLoop)
+            duration (float): acquisition time in s (DurationLoop), overrides count
+            delay (float): delay between readings in s
+            buffer_name (str): name of the reading buffer
+            capacity (int): capacity of the reading buffer
+            interval (float): polling interval in s
+            binary (bool): read the buffer in binary format, see read_buffer
+
+        Yields:
+            np.ndarray: structured array with fields current, voltage, timestamp
+        '''
+        with GlobalLock(self.ip), self.batch():
+            for cmd in self.buffers.ensure(buffer_name, capacity, fill='CONT', exact=True):
+                self.send(cmd)
+            capacity = self.buffers.capacity[buffer_name]
+            self.send(stream_trigger_cmd(count, duration, delay, buffer_name))
+            self.send(":INIT")
+
+        last = 0
+        running = True
+        try:
+            while running:
+                with GlobalLock(self.ip):
+                    # the state has to be checked first, so that no readings are missed after the run ended
+                    running = trigger_running(self.query(":TRIG:STAT?"))
+                    end = int(self.query(f':TRAC:ACT:END? "{buffer_name}"'))
+                    ranges = ring_ranges(last, end, capacity)
+                    chunk = self._read_ranges(buffer_name, ranges, binary=binary) if ranges else None
+                last = end or last
+                if chunk is not None:
+                    yield chunk
+                if running:
+                    time.sleep(interval)
+        finally:
+            if running:
+                with GlobalLock(self.ip):
+                    self.send(":ABOR")
+
+    def delete_buffer(self, buffer_name: str):
+        '''
+        Delete a user reading buffer on the instrument
+        '''
+        with GlobalLock(self.ip):
+            for cmd in self.buffers.delete(buffer_name):
+                self.send(cmd)
+
+    def cleanup_buffers(self, max_age: float = None, keep: list = ()):
+        '''
+        Delete stale user reading buffers on the instrument
+
+        Parameters:
+            max_age (float): delete buffers that have not been used for max_age seconds, all if None
+            keep (list): names of buffers to keep
+        '''
+        with GlobalLock(self.ip):
+            for name in self.buffers.stale(max_age, keep):
+                for cmd in self.buffers.delete(name):
+                    self.send(cmd)
+
+    def reset(self):
+        '''
+        Reset the instrument, this also deletes all user reading buffers
+        '''
+        with GlobalLock(self.ip):
+            self.send("*RST")
+            self.buffers.forget()
+            self.mode="V"
+
+    def read_buffer(self,
+                    buffer_name: str = 'defbuffer1',
+                    start: int = 1,
+                    end: int = None,
+                    binary: bool = True,
+                    single: bool = False,
+                    chunk: int = 50000,
+                    ) -> np.ndarray:
+        '''
+        Read current (READ), voltage (SOUR) and relative timestamp (REL) from a reading buffer.
+        In binary mode the instrument sends IEEE 488.2 blocks of floats which are received
+        directly into the returned array, without formatting and parsing ASCII numbers.
+
+        Parameters:
+            buffer_name (str): name of the reading buffer
+            start (int): index of the first reading (starting from 1)
+            end (int): index of the last reading (inclusive), defaults to the last reading in the buffer
+            binary (bool): use FORM:DATA REAL / SREAL instead of ASCII
+            single (bool): single precision (SREAL), halves the transfer size
+            chunk (int): maximum number of readings per transfer
+
+        Returns:
+            np.ndarray: structured array with fields current, voltage, timestamp
+        '''
+        with GlobalLock(self.ip):
+            return self._read_buffer(buffer_name, start, end, binary, single, chunk)
+
+    def _read_buffer(self, buffer_name, start=1, end=None, binary=True, single=False, chunk=50000):
+        if end is None:
+            end = int(self.query(f':TRAC:ACT:END? "{buffer_name}"'))
+        return self._read_ranges(buffer_name, [(start, end)], binary, single, chunk)
+
+    def _read_ranges(self, buffer_name, ranges, binary=True, single=False, chunk=50000):
+        '''
+        Read several (inclusive) index ranges of a buffer into one array, switching the data format only once
+        '''
+        res = np.empty(sum(max(end-start+1, 0) for start, end in ranges), dtype=trace_dtype(single))
+        if binary:
+            self.send(f":FORM:DATA {'SREAL' if single else 'REAL'}")
+            self.send(":FORM:BORD SWAP")
+        try:
+            offset = 0
+            for start, end in ranges:
+                for i, j in trace_chunks(start, end, chunk):
+                    out = res[offset:offset+j-i+1]
+                    if binary:
+                        view = self.query_block(trace_data_cmd(i, j, buffer_name), out=out)
+                        if len(view) != out.nbytes:
+                            raise ValueError(f"Expected {j-i+1} readings from {buffer_name}, but got {len(view)} bytes.")
+                    else:
+                        parse_trace(self.query(trace_data_cmd(i, j, buffer_name)), out)
+                    offset += j-i+1
+        finally:
+            if binary:
+                self.send(":FORM:DATA ASC")
+        return res
 
     def get_voltage(self):
         with GlobalLock(self.ip):
@@ -173,3 +565,215 @@ class SourceMeter(SkippyDevice):
         '''
         with GlobalLock(self.ip):
             self.send(f":SYST:BEEP {freq}, {dur}")
+
+
+class AsyncSourceMeter(AsyncSkippyDevice):
+    '''
+    asyncio version of SourceMeter. Use as
+
+        async with AsyncSourceMeter("SMU", "192.168.0.77") as smu:
+            await smu.measure()
+    '''
+    def __init__(self,
+                 name,
+                 ip,
+                 port=5025,
+                 timeout=1,
+                 wait=0.01,
+                 cache=False,
+                 sync='sleep',
+                 ):
+        super().__init__(ip, port, name, timeout, wait, cache, sync)
+        self.mode="V"
+        self.buffers = BufferManager()
+
+    async def connect(self, timeout: float = None) -> bool:
+        res = await super().connect(timeout)
+        await self.id()
+        return res
+
+    async def id(self):
+        async with self.global_lock():
+            res = (await self.query('*IDN?')).split(',')
+        try:
+            self.manufacturer = res[0]
+            self.model = res[1]
+            self.sn = res[2]
+            self.firmware = res[3]
+        except IndexError:
+            self.model = "Default"
+
+    async def measure(self, timeout: float = None):
+        async with self.global_lock():
+            return float(await self.query(":MEAS:CURR?", timeout=timeout))
+
+    async def set_mode_voltage(self,
+                               v_range: float=20,
+                               voltage: float=0,
+                               i_max: float=0.00005,
+                               i_range: float=0.000105,
+                               ):
+        assert i_max<i_range, f"Current limit {i_max} is larger than range {i_range}. Aborting."
+        assert voltage < v_range, "Voltage is larger than voltage range. Aborting."
+        async with self.global_lock():
+            await self.send(':SENS:FUNC "CURR"')
+            await self.send(f":SENS:CURR:RANGE {i_range}")
+            await self.send(f":SOURCE:VOLT:ILIMIT {i_max}")
+            await self.send(":SOURCE:FUNCTION VOLT")
+            await self.send(f":SOURCE:VOLT 0")
+            await self.send(f":SOURCE:VOLT:RANGE {v_range}")
+            await self.send(f":SOURCE:VOLT {voltage}")
+            self.mode="V"
+        await self.measure()
+
+    async def set_current_range(self,
+                                i_range: float = 0.000105,
+                                i_max:   float = 0.00005,
+                                ):
+        assert i_max<i_range, f"Current limit {i_max} is larger than range {i_range}. Aborting."
+        async with self.global_lock():
+            await self.write(":SENS:CURR:RANGE", i_range, strict=False)
+            await self.write(":SOURCE:VOLT:ILIMIT", i_max, strict=False)
+        await self.measure()
+
+    async def set_voltage(self, voltage: float=0):
+        async with self.global_lock():
+            if self.mode=="V":
+                await self.configure(":SOURCE:VOLT", voltage)
+        await self.measure()
+
+    async def delete_buffer(self, buffer_name: str):
+        '''
+        Delete a user reading buffer on the instrument, see SourceMeter.delete_buffer
+        '''
+        async with self.global_lock():
+            for cmd in self.buffers.delete(buffer_name):
+                await self.send(cmd)
+
+    async def cleanup_buffers(self, max_age: float = None, keep: list = ()):
+        '''
+        Delete stale user reading buffers on the instrument, see SourceMeter.cleanup_buffers
+        '''
+        async with self.global_lock():
+            for name in self.buffers.stale(max_age, keep):
+                for cmd in self.buffers.delete(name):
+                    await self.send(cmd)
+
+    async def reset(self):
+        '''
+        Reset the instrument, this also deletes all user reading buffers
+        '''
+        async with self.global_lock():
+            await self.send("*RST")
+            self.buffers.forget()
+            self.mode="V"
+
+    async def read_buffer(self,
+                          buffer_name: str = 'defbuffer1',
+                          start: int = 1,
+                          end: int = None,
+                          binary: bool = True,
+                          single: bool = False,
+                          chunk: int = 50000,
+                          ) -> np.ndarray:
+        '''
+        Read current, voltage and timestamp from a reading buffer, see SourceMeter.read_buffer
+        '''
+        async with self.global_lock():
+            return await self._read_buffer(buffer_name, start, end, binary, single, chunk)
+
+    async def _read_buffer(self, buffer_name, start=1, end=None, binary=True, single=False, chunk=50000):
+        if end is None:
+            end = int(await self.query(f':TRAC:ACT:END? "{buffer_name}"'))
+        return await self._read_ranges(buffer_name, [(start, end)], binary, single, chunk)
+
+    async def _read_ranges(self, buffer_name, ranges, binary=True, single=False, chunk=50000):
+        '''
+        Read several (inclusive) index ranges of a buffer into one array, switching the data format only once
+        '''
+        res = np.empty(sum(max(end-start+1, 0) for start, end in ranges), dtype=trace_dtype(single))
+        if binary:
+            await self.send(f":FORM:DATA {'SREAL' if single else 'REAL'}")
+            await self.send(":FORM:BORD SWAP")
+        try:
+            offset = 0
+            for start, end in ranges:
+                for i, j in trace_chunks(start, end, chunk):
+                    out = res[offset:offset+j-i+1]
+                    if binary:
+                        view = await self.query_block(trace_data_cmd(i, j, buffer_name), out=out)
+                        if len(view) != out.nbytes:
+                            raise ValueError(f"Expected {j-i+1} readings from {buffer_name}, but got {len(view)} bytes.")
+                    else:
+                        parse_trace(await self.query(trace_data_cmd(i, j, buffer_name)), out)
+                    offset += j-i+1
+        finally:
+            if binary:
+                await self.send(":FORM:DATA ASC")
+        return res
+
+    async def stream(self,
+                     count: int = 100,
+                     duration: float = None,
+                     delay: float = 0,
+                     buffer_name: str = 'streambuffer',
+                     capacity: int = 100000,
+                     interval: float = 0.5,
+                     binary: bool = True,
+                     ):
+        '''
+        Async iterator over the readings of a running trigger model, see SourceMeter.stream
+
+            async for chunk in smu.stream(duration=3600, interval=1):
+                print(chunk['current'].mean())
+        '''
+        async with self.global_lock():
+            for cmd in self.buffers.ensure(buffer_name, capacity, fill='CONT', exact=True):
+                await self.send(cmd)
+            capacity = self.buffers.capacity[buffer_name]
+            await self.send(stream_trigger_cmd(count, duration, delay, buffer_name))
+            await self.send(":INIT")
+
+        last = 0
+        running = True
+        try:
+            while running:
+                async with self.global_lock():
+                    running = trigger_running(await self.query(":TRIG:STAT?"))
+                    end = int(await self.query(f':TRAC:ACT:END? "{buffer_name}"'))
+                    ranges = ring_ranges(last, end, capacity)
+                    chunk = await self._read_ranges(buffer_name, ranges, binary=binary) if ranges else None
+                last = end or last
+                if chunk is not None:
+                    yield chunk
+                if running:
+                    await asyncio.sleep(interval)
+        finally:
+            if running:
+                async with self.global_lock():
+                    await self.send(":ABOR")
+
+    async def get_voltage(self):
+        async with self.global_lock():
+            return float(await self.query(":SOURCE:VOLT?"))
+
+    async def is_tripped(self):
+        async with self.global_lock():
+            if self.mode == "V":
+                return (await self.query(":SOURCE:VOLT:ILIMIT:TRIP?")) == "1"
+            elif self.mode == "I":
+                return (await self.query(":SOURCE:CURR:VLIMIT:TRIP?")) == "1"
+
+    async def enable(self):
+        async with self.global_lock():
+            await self.send(":OUTP ON")
+        await self.measure()
+
+    async def disable(self):
+        async with self.global_lock():
+            await self.send(":OUTP OFF")
+        await self.measure()
+
+    async def get_output(self) -> bool:
+        async with self.global_lock():
+            return (await self.query(":OUTP:STATE?"))=="1"
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+'''
+Telemetry fan-out: a single publisher samples the instruments at a fixed rate
+and broadcasts timestamped records on a ZMQ PUB socket.
+Dashboards and watchdogs subscribe to the records instead of polling the instruments themselves.
+
+    psu = PowerSupply("Readout", "192.168.2.1")
+    smu = SourceMeter("SMU", "192.168.2.4")
+    publisher = TelemetryPublisher("tcp://*:5556", interval=1)
+    publisher.add("Readout", psu.snapshot)
+    publisher.add("SMU", lambda: {'Current': smu.measure()})
+    publisher.run()
+
+    for record in TelemetrySubscriber("tcp://daq-host:5556", topics=["Readout"]):
+        print(record['time'], record['values']['CH1']['Voltage'])
+
+Each message has two frames: the topic (source name) and the record as JSON,
+{"topic": <source>, "time": <unix time>, "seq": <sample number>, "values": <result of the source>},
+with "error" instead of "values" if sampling the source failed.
+'''
+
+import json
+import time
+import logging
+import threading
+
+import zmq
+
+class TelemetryPublisher:
+    def __init__(self, address: str = "tcp://*:5556", interval: float = 1.0):
+        '''
+        Parameters:
+            address (str): address to bind the PUB socket to, e.g. "tcp://*:5556" or "tcp://127.0.0.1:*" for a random port
+            interval (float): time between samples in seconds
+        '''
+        self.address    = address
+        self.interval   = interval
+        self.sources    = {}
+        self.seq        = 0
+        self.logger     = logging.getLogger(__name__)
+        self.stopped    = threading.Event()
+        self.thread     = None
+
+        self.pub = zmq.Context.instance().socket(zmq.PUB)
+        self.pub.bind(address)
+        self.endpoint = self.pub.getsockopt_string(zmq.LAST_ENDPOINT)
+
+    def add(self, topic: str, source):
+        '''
+        Add a quantity to sample
+
+        Parameters:
+            topic (str): name of the source, subscribers filter on it
+            source (callable): returns a JSON serializable value, e.g. PowerSupply.snapshot
+        '''
+        self.sources[topic] = source
+
+    def remove(self, topic: str):
+        self.sources.pop(topic, None)
+
+    def publish(self, topic: str, record: dict):
+        self.pub.send_multipart([topic.encode(), json.dumps(record).encode()])
+
+    def sample(self) -> list:
+        '''
+        Sample all sources once and publish the records
+
+        Returns:
+            list: the published records
+        '''
+        records = []
+        for topic, source in list(self.sources.items()):
+            record = {'topic': topic, 'time': time.time(), 'seq': self.seq}
+            try:
+                record['values'] = source()
+            except Exception as e:
+                self.logger.warning(f"Telemetry: Sampling {topic} failed: {e}")
+                record['error'] = f"{type(e).__name__}: {e}"
+            self.publish(topic, record)
+            records.append(record)
+        self.seq += 1
+        return records
+
+    def run(self, duration: float = None):
+        '''
+        Sample at a fixed rate, until stop is called or duration has passed.
+        The schedule doesn't drift with the time it takes to sample, samples that are late are skipped.
+
+        Parameters:
+            duration (float): run time in seconds, forever if None
+        '''
+        self.stopped.clear()
+        start = time.monotonic()
+        next_sample = start
+        while not self.stopped.is_set():
+            if duration is not None and time.monotonic() - start >= duration:
+                break
+            self.sample()
+            next_sample += self.interval
+            now = time.monotonic()
+            if next_sample < now:
+                skipped = int((now - next_sample)//self.interval) + 1
+                self.logger.debug(f"Telemetry: Sampling took too long, skipping {skipped} samples.")
+                next_sample += skipped*self.interval
+            self.stopped.wait(next_sample - now)
+
+    def start(self, duration: float = None):
+        '''
+        Run in a background thread, see run
+        '''
+        self.thread = threading.Thread(target=self.run, args=(duration,), name="TelemetryPublisher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.pub.close(linger=0)
+
+class TelemetrySubscriber:
+    def __init__(self, address: str = "tcp://localhost:5556", topics: list = None, timeout: float = None):
+        '''
+        Parameters:
+            address (str): address of the publisher
+            topics (list): source names to subscribe to, everything if None
+            timeout (float): timeout for recv in seconds, None waits forever
+        '''
+        self.address = address
+        self.timeout = timeout
+        self.sub = zmq.Context.instance().socket(zmq.SUB)
+        self.sub.connect(address)
+        for topic in (topics or ['']):
+            self.sub.setsockopt(zmq.SUBSCRIBE, topic.encode())
+
+    def recv(self, timeout: float = None) -> dict:
+        '''
+        Receive the next record
+
+        Parameters:
+            timeout (float): timeout in seconds, defaults to the subscriber timeout
+
+        Returns:
+            dict: the record, None after a timeout
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        if timeout is not None and not self.sub.poll(int(timeout*1000)):
+            return None
+        frames = self.sub.recv_multipart()
+        return json.loads(frames[-1])
+
+    def __iter__(self):
+        while True:
+            record = self.recv()
+            if record is None:
+                return
+            yield record
+
+    def close(self):
+        self.sub.close(linger=0)
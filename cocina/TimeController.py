@@ -3,12 +3,173 @@
 Simple class for IDQ Time Tagger
 '''
 import time
+import numpy as np
+from yaml import load, dump
+from yaml import CLoader as Loader, CDumper as Dumper
 from .ZeroMQDevice import ZeroMQDevice
 from .GlobalLock import GlobalLock
+from . import SCPI
 
 def s_to_ps(time):
     return int(time*1e12)
 
+# parameters of each block type, as paths relative to the block, in the order they are configured
+PARAMETERS = {
+    'GEN': ['ENAB', 'PNUM', 'PPER', 'PWID', 'TRIG:DELA', 'TRIG:LINK', 'TRIG:ARM:MODE'],
+    'TSCO': ['WIND:ENAB', 'WIND:BEGI:DELA', 'WIND:BEGI:EDGE', 'WIND:BEGI:LINK',
+             'WIND:END:DELA', 'WIND:END:EDGE', 'WIND:END:LINK',
+             'FIR:LINK', 'SEC:LINK', 'OPIN', 'OPOU', 'COUN:INTE', 'COUN:MODE'],
+    'OUTP': ['ENAB', 'LINK', 'MODE', 'PULS', 'DELA', 'PULS:WIDT'],
+    'INPU': ['ENAB', 'THRE', 'COUN:INTE'],
+}
+
+def scpi_value(value) -> str:
+    '''
+    Value as sent to the device, YAML turns unquoted ON / OFF into booleans
+    '''
+    if isinstance(value, bool):
+        return "ON" if value else "OFF"
+    return str(value)
+
+def block_type(block: str) -> str:
+    '''
+    Type of a block, e.g. "TSCO" for "TSCO9"
+    '''
+    return block.rstrip('0123456789').upper()
+
+def load_config(f_in: str) -> dict:
+    '''
+    Load a configuration from a YAML file, e.g.
+
+        GEN3:
+            ENAB: 'ON'
+            PPER: 2000000000
+            TRIG:ARM:MODE: MANU
+        OUTP1:
+            LINK: TSCO9
+
+    Returns:
+        dict: {block: {parameter: value}}
+    '''
+    with open(f_in, 'r') as f:
+        config = load(f, Loader=Loader) or {}
+    for block in config:
+        if block_type(block) not in PARAMETERS:
+            raise ValueError(f"Unknown block {block}, use one of {list(PARAMETERS)} with a channel number")
+    return config
+
+def dump_config(config: dict, f_out: str):
+    with open(f_out, 'w') as f:
+        dump(config, f, Dumper=Dumper, sort_keys=False)
+
+def diff_config(config: dict, state: dict) -> dict:
+    '''
+    Parameters of config that are not known to be set already
+
+    Parameters:
+        config (dict): desired configuration, {block: {parameter: value}}
+        state (dict): known configuration of the device
+
+    Returns:
+        dict: {block: {parameter: value}} of the parameters that need to be sent
+    '''
+    res = {}
+    for block, params in config.items():
+        known = state.get(block, {})
+        changed = {param: value for param, value in params.items()
+                   if param not in known or not SCPI.compare(scpi_value(known[param]), scpi_value(value), rtol=0)}
+        if changed:
+            res[block] = changed
+    return res
+
+def block_command(block: str, params: dict) -> str:
+    '''
+    Compound command setting several parameters of a block,
+    using paths relative to the previous command where possible, e.g.
+    GEN1:ENAB ON;PNUM 1;TRIG:DELA 0;LINK GEN3
+
+    Parameters:
+        block (str): block, e.g. GEN1
+        params (dict): {parameter: value}, parameters are paths relative to the block
+
+    Returns:
+        str: the command
+    '''
+    parts = []
+    node = None
+    for param, value in params.items():
+        path = [block] + param.split(':')
+        if node is not None and path[:len(node)] == node and len(path) > len(node):
+            header = ':'.join(path[len(node):])
+        else:
+            header = (':' if parts else '') + ':'.join(path)
+        parts.append(f"{header} {scpi_value(value)}")
+        node = path[:-1]
+    return ';'.join(parts)
+
+def compile_config(config: dict, state: dict = None, max_length: int = 1024) -> list:
+    '''
+    Compile a configuration into the fewest compound commands, only sending what differs from state
+
+    Parameters:
+        config (dict): desired configuration, {block: {parameter: value}}
+        state (dict): known configuration of the device, everything is sent if None
+        max_length (int): maximum length of a single command
+
+    Returns:
+        list: commands
+    '''
+    changed = diff_config(config, state or {})
+    return SCPI.join_commands([block_command(block, params) for block, params in changed.items()], max_length=max_length)
+
+class CounterRing:
+    def __init__(self, channels: list, capacity: int = 1000):
+        '''
+        Ring buffer of counter vectors, for rate monitoring
+
+        Parameters:
+            channels (list): input channels, one column each
+            capacity (int): number of readouts to keep
+        '''
+        self.channels = list(channels)
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.counts = np.zeros((capacity, len(self.channels)), dtype=np.int64)
+        self.total = 0  # number of readouts ever appended
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, timestamp: float, counts):
+        i = self.total % self.capacity
+        self.times[i] = timestamp
+        self.counts[i] = counts
+        self.total += 1
+
+    def data(self) -> tuple:
+        '''
+        Returns:
+            tuple: (timestamps, counts) in chronological order, counts has one column per channel
+        '''
+        if self.total <= self.capacity:
+            return self.times[:self.total].copy(), self.counts[:self.total].copy()
+        i = self.total % self.capacity
+        return np.roll(self.times, -i), np.roll(self.counts, -i, axis=0)
+
+    def rates(self, int_time: float) -> np.ndarray:
+        '''
+        Mean count rate of each channel over the buffer
+
+        Parameters:
+            int_time (float): integration time of the counters in s
+
+        Returns:
+            np.ndarray: rate per channel in Hz
+        '''
+        if not len(self):
+            return np.zeros(len(self.channels))
+        return self.counts[:len(self)].mean(axis=0)/int_time
+
 class TimeController(ZeroMQDevice):
 
     def __init__(self,
@@ -17,6 +178,7 @@ class TimeController(ZeroMQDevice):
                  port: int,
                  timeout: int=1,
                  wait: float=0.01,
+                 transport=None,
                  ):
         '''
         Initialize the TimeController
@@ -25,11 +187,14 @@ class TimeController(ZeroMQDevice):
             ip (str): IP Address of the device
             port (int): port that is used on the device
             name (str): arbitrary name of the device
+            transport (RemoteDevice): talk to the device through the broker, see ZeroMQDevice.from_broker
         '''
         self.ip = ip
         with GlobalLock(self.ip):
-            super().__init__(ip, port, name, timeout, wait)
+            super().__init__(ip, port, name, timeout, wait, transport=transport)
             self.dark = False
+            self.config_state = {}  # known configuration of the device, see apply_config
+            self.unconfirmed = {}  # parameters that were sent but not read back yet, see wait_ready
 
     def id(self) -> str:
         '''
@@ -78,6 +243,7 @@ class TimeController(ZeroMQDevice):
                 count = "INF"
             cmd = f"GEN{ch}:enable ON;PNUM {count};PPER {period};PWID {pw}"
             setattr(self, f"GEN{ch}", 1)
+            self._expect(f"GEN{ch}", {'PPER': period, 'PWID': pw})
             self.query(cmd)
 
     def config_generator(self,
@@ -107,6 +273,8 @@ class TimeController(ZeroMQDevice):
             else:
                 link = f"GEN{link}"
             cmd = f"GEN{ch}:ENAB ON;PNUM {count};PPER {period};PWID {pw};TRIG:DELAY {delay};LINK {link};ARM:MODE {mode}"
+            self._expect(f"GEN{ch}", {'PNUM': count, 'PPER': period, 'PWID': pw,
+                                      'TRIG:DELA': delay, 'TRIG:LINK': link, 'TRIG:ARM:MODE': mode})
             res = self.query(cmd)
             return res
 
@@ -116,6 +284,7 @@ class TimeController(ZeroMQDevice):
         '''
         with GlobalLock(self.ip):
             cmd = f"GEN{ch}:{par} {val}"
+            self._expect(f"GEN{ch}", {par.upper(): val} if par.upper() in PARAMETERS['GEN'] else {})
             res = self.query(cmd)
             return res
 
@@ -145,6 +314,7 @@ class TimeController(ZeroMQDevice):
                 f"TSCO{ch}:OPIN ONLYFIR;OPOU ONLYFIR;COUN:INTE 1000;MODE CYCL",
             ]
             cmd = ":".join(cmds)
+            self._expect(f"TSCO{ch}", {})
             res = self.query(cmd)
             return res
 
@@ -162,17 +332,58 @@ class TimeController(ZeroMQDevice):
             else:
                 link = f"TSC{link}"
             cmd = f"OUTP{ch}:ENAB {enab_str};LINK {link};MODE {mode};PULSE OFF;DELAY {delay}"
+            self._expect(f"OUTP{ch}", {})
             res = self.query(cmd)
             return res
 
-    def arm_trigger(self, ch:int):
+    def _expect(self, block: str, params: dict):
+        '''
+        Imperative setters: forget the known configuration of block, and wait for params to be applied before arming
+        '''
+        self.config_state.pop(block, None)
+        if params:
+            self.unconfirmed.setdefault(block, {}).update(params)
+
+    def wait_ready(self, timeout: float = 0.5, interval: float = 0.01) -> bool:
         '''
-        Arm the triger
+        Wait until all parameters that were sent since the last check read back with their new values,
+        i.e. the configuration is fully deployed on the device.
+
+        Parameters:
+            timeout (float): give up after this time in s, unconfirmed parameters are forgotten
+            interval (float): time between polls in s
+
+        Returns:
+            bool: True if the configuration was confirmed
         '''
-        # not ideal, but give the TC some time before arming
-        # otherwise, sometimes config is not fully deployed
-        time.sleep(0.5)
+        deadline = time.monotonic() + timeout
         with GlobalLock(self.ip):
+            while self.unconfirmed:
+                keys = [(block, param) for block, params in self.unconfirmed.items() for param in params]
+                values = self.pipeline([f"{block}:{param}?" for block, param in keys])
+                for (block, param), value in zip(keys, values):
+                    if SCPI.compare(value, scpi_value(self.unconfirmed[block][param]), rtol=0):
+                        self.config_state.setdefault(block, {})[param] = self.unconfirmed[block].pop(param)
+                self.unconfirmed = {block: params for block, params in self.unconfirmed.items() if params}
+                if not self.unconfirmed:
+                    break
+                if time.monotonic() + interval > deadline:
+                    self.logger.warning(f"{self.lstr}: Configuration not confirmed within {timeout}s: {self.unconfirmed}")
+                    self.unconfirmed = {}
+                    return False
+                time.sleep(interval)
+            return True
+
+    def arm_trigger(self, ch:int, timeout: float = 0.5):
+        '''
+        Arm the triger, as soon as the configuration is deployed on the device (see wait_ready)
+
+        Parameters:
+            ch (int): Channel number
+            timeout (float): maximum time to wait for the configuration in s
+        '''
+        with GlobalLock(self.ip):
+            self.wait_ready(timeout)
             _ = self.query(f"GEN{ch}:TRIG:ARM")
 
     def play(self, ch: int):
@@ -204,6 +415,7 @@ class TimeController(ZeroMQDevice):
             ch2 (int): Channel 2 (servant)
         '''
         with GlobalLock(self.ip):
+            self._expect(f"GEN{ch1}", {'TRIG:LINK': f"GEN{ch2}"})
             self.query(f"GEN{ch1}:TRIG:LINK GEN{ch2}")
 
     def delay(self, ch1: int, delay: int=0):
@@ -215,6 +427,7 @@ class TimeController(ZeroMQDevice):
             delay (int): Delay in [ps] wrt the trigger
         '''
         with GlobalLock(self.ip):
+            self._expect(f"GEN{ch1}", {'TRIG:DELA': delay})
             self.query(f"GEN{ch1}:TRIG:DELAY {delay}")
 
     def config_input(self,
@@ -231,9 +444,156 @@ class TimeController(ZeroMQDevice):
             int_time (int): Integration time for counter in ms
         '''
         with GlobalLock(self.ip):
-            _ = self.query(f"INPU{channel}:ENAB")
-            _ = self.query(f"INPU{channel}:THRESHOLD {threshold}")
-            _ = self.query(f"INPU{channel}:COUN:INTE {int_time}")
+            _ = self.pipeline([
+                f"INPU{channel}:ENAB",
+                f"INPU{channel}:THRESHOLD {threshold}",
+                f"INPU{channel}:COUN:INTE {int_time}",
+            ])
+            self.config_state[f"INPU{channel}"] = {'ENAB': 'ON', 'THRE': threshold, 'COUN:INTE': int_time}
+
+    def apply_config(self, config, force: bool = False) -> list:
+        '''
+        Bring the device into the given configuration.
+        Only parameters that differ from the known configuration (config_state) are sent,
+        as few compound commands as possible, that are streamed out without waiting for each reply.
+
+            tc.apply_config("config/TimeController.yaml")
+            tc.apply_config({'GEN1': {'PWID': s_to_ps(0.008)}})  # only changes the pulse width
+
+        Parameters:
+            config (dict or str): {block: {parameter: value}}, or a YAML file, see load_config
+            force (bool): send everything, regardless of the known configuration
+
+        Returns:
+            list: the commands that were sent
+        '''
+        if isinstance(config, str):
+            config = load_config(config)
+        with GlobalLock(self.ip):
+            changed = config if force else diff_config(config, self.config_state)
+            cmds = compile_config(changed)
+            if cmds:
+                self.pipeline(cmds)
+            for block, params in changed.items():
+                self.config_state.setdefault(block, {}).update(params)
+                self.unconfirmed.setdefault(block, {}).update(params)
+            return cmds
+
+    def read_config(self, blocks: list) -> dict:
+        '''
+        Read the configuration of blocks back from the device, and remember it as known configuration
+
+        Parameters:
+            blocks (list): blocks, e.g. ['GEN1', 'TSCO9', 'OUTP1']
+
+        Returns:
+            dict: {block: {parameter: value}}
+        '''
+        keys = [(block, param) for block in blocks for param in PARAMETERS[block_type(block)]]
+        with GlobalLock(self.ip):
+            values = self.pipeline([f"{block}:{param}?" for block, param in keys])
+        res = {block: {} for block in blocks}
+        for (block, param), value in zip(keys, values):
+            try:
+                value = int(value)
+            except ValueError:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            res[block][param] = value
+        for block in blocks:
+            self.config_state[block] = dict(res[block])
+        return res
+
+    def snapshot_config(self, f_out: str = None, blocks: list = None) -> dict:
+        '''
+        Read the live configuration from the device and write it to a YAML file, that can be used with apply_config
+
+        Parameters:
+            f_out (str): output file, nothing is written if None
+            blocks (list): blocks to read, defaults to the blocks of the known configuration
+
+        Returns:
+            dict: {block: {parameter: value}}
+        '''
+        res = self.read_config(list(self.config_state) if blocks is None else blocks)
+        if f_out:
+            dump_config(res, f_out)
+        return res
+
+    def counter_channels(self) -> list:
+        '''
+        Input channels that are known to be enabled, see config_input and apply_config
+        '''
+        return sorted(int(block[4:]) for block, params in self.config_state.items()
+                      if block_type(block) == 'INPU' and scpi_value(params.get('ENAB', 'OFF')).upper() == 'ON')
+
+    def get_counters(self, channels: list = None) -> tuple:
+        '''
+        Read the counters of several inputs with a single compound query
+
+        Parameters:
+            channels (list): input channels, defaults to all enabled inputs
+
+        Returns:
+            tuple: (host timestamp, np.ndarray of the counter values, in the order of channels)
+        '''
+        channels = self.counter_channels() if channels is None else channels
+        if not channels:
+            raise ValueError("No input channels given or enabled, see config_input")
+        with GlobalLock(self.ip):
+            start = time.time()
+            res = self.query(";:".join(f"INPU{channel}:COUN?" for channel in channels))
+            # the counters were read somewhere during the round trip
+            timestamp = (start + time.time())/2
+        values = res.replace(',', ';').split(';')
+        if len(values) != len(channels):
+            raise ValueError(f"Expected {len(channels)} counter values, got {res}")
+        return timestamp, np.array([int(float(value)) for value in values], dtype=np.int64)
+
+    def stream_counters(self,
+                        channels: list = None,
+                        interval: float = None,
+                        count: int = None,
+                        capacity: int = 1000,
+                        ):
+        '''
+        Read the counters of several inputs once per integration period.
+        The readouts are also kept in a ring buffer, self.counters (see CounterRing).
+
+            for timestamp, counts in tc.stream_counters(interval=0.1):
+                print(tc.counters.rates(0.1))
+
+        Parameters:
+            channels (list): input channels, defaults to all enabled inputs
+            interval (float): time between readouts in s, defaults to the longest integration time of the inputs
+            count (int): number of readouts, forever if None
+            capacity (int): size of the ring buffer
+
+        Yields:
+            tuple: (host timestamp, np.ndarray of the counter values)
+        '''
+        channels = self.counter_channels() if channels is None else channels
+        if interval is None:
+            int_times = [self.config_state.get(f"INPU{channel}", {}).get('COUN:INTE') for channel in channels]
+            interval = max((float(t) for t in int_times if t is not None), default=1000)/1000
+        self.counters = CounterRing(channels, capacity)
+        next_readout = time.monotonic()
+        n = 0
+        while True:
+            timestamp, values = self.get_counters(channels)
+            self.counters.append(timestamp, values)
+            n += 1
+            yield timestamp, values
+            if count is not None and n >= count:
+                return
+            # fixed schedule, readouts that are too late are skipped instead of piling up
+            next_readout += interval
+            now = time.monotonic()
+            if next_readout < now:
+                next_readout += ((now - next_readout)//interval + 1)*interval
+            time.sleep(next_readout - now)
 
     def get_counter(self, channel: int):
         '''
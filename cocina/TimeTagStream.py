@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+'''
+Time tag acquisition from the IDQ Time Controller data channels,
+and vectorized coincidence / cross-correlation analysis of the tags.
+
+Each input has its own data channel, a ZMQ socket that delivers messages
+of packed 64 bit little-endian timestamps in ps. The timestamps are copied
+straight from the received frames into preallocated numpy arrays.
+
+    stream = TimeTagStream({1: "tcp://192.168.10.42:4241", 2: "tcp://192.168.10.42:4242"}, capacity=10_000_000)
+    tags = stream.acquire(duration=10)
+    print(coincidences(tags[1], tags[2], window=1000))
+    hist, edges = cross_correlation(tags[1], tags[2], bin_width=100, max_delay=100_000, processes=4)
+'''
+
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import zmq
+import numpy as np
+
+TAG_DTYPE = np.dtype('<i8')
+
+class TimeTagStream:
+    def __init__(self,
+                 addresses: dict,
+                 capacity: int = 1_000_000,
+                 socket_type: int = zmq.SUB,
+                 dtype=TAG_DTYPE,
+                 ):
+        '''
+        Parameters:
+            addresses (dict): {input channel: ZMQ endpoint of its data channel}
+            capacity (int): maximum number of tags per channel and acquisition, the arrays are allocated once
+            socket_type (int): zmq.SUB if the device publishes the tags, zmq.PULL if it pushes them
+            dtype (np.dtype): format of the timestamps on the wire
+        '''
+        self.addresses  = dict(addresses)
+        self.capacity   = capacity
+        self.dtype      = np.dtype(dtype)
+        self.logger     = logging.getLogger(__name__)
+
+        self.tags       = {channel: np.empty(capacity, dtype=self.dtype) for channel in self.addresses}
+        self.filled     = {channel: 0 for channel in self.addresses}
+        self.overflow   = {channel: 0 for channel in self.addresses}
+
+        context = zmq.Context.instance()
+        self.sockets = {}
+        self.poller = zmq.Poller()
+        for channel, address in self.addresses.items():
+            sock = context.socket(socket_type)
+            if socket_type == zmq.SUB:
+                sock.setsockopt(zmq.SUBSCRIBE, b'')
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(address)
+            self.sockets[channel] = sock
+            self.poller.register(sock, zmq.POLLIN)
+        self.channel_of = {sock: channel for channel, sock in self.sockets.items()}
+
+    def reset(self):
+        '''
+        Start a new acquisition, the arrays are reused
+        '''
+        for channel in self.tags:
+            self.filled[channel] = 0
+            self.overflow[channel] = 0
+
+    def _store(self, channel, frame):
+        data = np.frombuffer(frame.buffer, dtype=self.dtype)
+        start = self.filled[channel]
+        n = min(len(data), self.capacity - start)
+        self.tags[channel][start:start+n] = data[:n]
+        self.filled[channel] = start + n
+        self.overflow[channel] += len(data) - n
+
+    def receive(self, timeout: float = 0.1) -> int:
+        '''
+        Receive all batches of tags that are available within timeout
+
+        Parameters:
+            timeout (float): time to wait for the first batch in s
+
+        Returns:
+            int: number of batches received
+        '''
+        received = 0
+        events = self.poller.poll(timeout*1000)
+        while events:
+            for sock, _ in events:
+                # drain the socket, without waiting
+                while True:
+                    try:
+                        frame = sock.recv(flags=zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self._store(self.channel_of[sock], frame)
+                    received += 1
+            events = self.poller.poll(0)
+        return received
+
+    def acquire(self, duration: float = None, count: int = None, timeout: float = 0.1) -> dict:
+        '''
+        Acquire tags for a given time, or until every channel has count tags
+
+        Parameters:
+            duration (float): acquisition time in s
+            count (int): minimum number of tags per channel
+            timeout (float): polling interval in s
+
+        Returns:
+            dict: {input channel: np.ndarray of timestamps}, views on the preallocated arrays
+        '''
+        assert duration is not None or count is not None, "Either duration or count is needed"
+        self.reset()
+        deadline = None if duration is None else time.monotonic() + duration
+        while True:
+            remaining = timeout if deadline is None else min(timeout, deadline - time.monotonic())
+            if remaining <= 0:
+                break
+            self.receive(remaining)
+            if count is not None and all(n >= count for n in self.filled.values()):
+                break
+            if all(n >= self.capacity for n in self.filled.values()):
+                break
+        for channel, lost in self.overflow.items():
+            if lost:
+                self.logger.warning(f"TimeTagStream: {lost} tags of channel {channel} did not fit into the buffer of {self.capacity}.")
+        return self.data()
+
+    def data(self) -> dict:
+        return {channel: self.tags[channel][:n] for channel, n in self.filled.items()}
+
+    def close(self):
+        for sock in self.sockets.values():
+            self.poller.unregister(sock)
+            sock.close()
+        self.sockets = {}
+
+def _pair_ranges(a: np.ndarray, b: np.ndarray, lower, upper) -> tuple:
+    '''
+    Index ranges [lo, hi) of the tags in b within [a + lower, a + upper] for each tag in a, both sorted
+    '''
+    lo = np.searchsorted(b, a + lower, side='left')
+    hi = np.searchsorted(b, a + upper, side='right')
+    return lo, hi
+
+def coincidences(a: np.ndarray, b: np.ndarray, window: int, delay: int = 0) -> int:
+    '''
+    Number of pairs of tags with |b - a - delay| <= window
+
+    Parameters:
+        a, b (np.ndarray): sorted timestamps of two channels
+        window (int): coincidence window
+        delay (int): delay of b with respect to a
+
+    Returns:
+        int: number of coincidences
+    '''
+    lo, hi = _pair_ranges(a, b, delay - window, delay + window)
+    return int((hi - lo).sum())
+
+def _histogram(a, b, bin_width, max_delay, chunk):
+    n_bins = int(np.ceil(2*max_delay/bin_width))
+    hist = np.zeros(n_bins, dtype=np.int64)
+    # chunked, so that the number of pairs in memory stays bounded
+    for start in range(0, len(a), chunk):
+        a_chunk = a[start:start+chunk]
+        lo, hi = _pair_ranges(a_chunk, b, -max_delay, max_delay)
+        n = hi - lo
+        total = int(n.sum())
+        if not total:
+            continue
+        idx_a = np.repeat(np.arange(len(a_chunk)), n)
+        idx_b = np.arange(total) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+        delays = b[idx_b] - a_chunk[idx_a]
+        bins = (delays + max_delay)//bin_width
+        bins = bins[(bins >= 0) & (bins < n_bins)]
+        hist += np.bincount(bins, minlength=n_bins)
+    return hist
+
+def cross_correlation(a: np.ndarray,
+                      b: np.ndarray,
+                      bin_width: int,
+                      max_delay: int,
+                      processes: int = None,
+                      chunk: int = 100_000,
+                      ) -> tuple:
+    '''
+    Histogram of the delays b - a of all pairs of tags within +-max_delay
+
+    Parameters:
+        a, b (np.ndarray): sorted timestamps of two channels
+        bin_width (int): width of a histogram bin
+        max_delay (int): range of the histogram
+        processes (int): split the work over a pool of processes, None to compute in this process
+        chunk (int): number of tags of a that are processed at once
+
+    Returns:
+        tuple: (histogram, bin edges)
+    '''
+    n_bins = int(np.ceil(2*max_delay/bin_width))
+    edges = -max_delay + np.arange(n_bins + 1)*bin_width
+    if not processes or processes < 2 or len(a) < 2*chunk:
+        return _histogram(a, b, bin_width, max_delay, chunk), edges
+
+    # each worker gets a slice of a, and only the part of b that it can pair with
+    bounds = np.linspace(0, len(a), processes + 1).astype(int)
+    with ProcessPoolExecutor(processes) as pool:
+        futures = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start == end:
+                continue
+            a_part = a[start:end]
+            b_lo = np.searchsorted(b, a_part[0] - max_delay, side='left')
+            b_hi = np.searchsorted(b, a_part[-1] + max_delay, side='right')
+            futures.append(pool.submit(_histogram, a_part, b[b_lo:b_hi], bin_width, max_delay, chunk))
+        hist = sum(future.result() for future in futures)
+    return hist, edges
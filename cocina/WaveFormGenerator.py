@@ -4,29 +4,109 @@
 # Programming guide: https://siglentna.com/wp-content/uploads/dlm_uploads/2024/06/SDG_Programming-Guide_PG02-E05C.pdf
 # (bad) socket example hinting at necessary wait times between send and receive, as well as port 5024 instead of 5025:
 # https://www.siglenteu.com/application-note/programming-example-using-python-to-configure-a-basic-waveform-with-an-sdg-x-series-generator-via-open-sockets-lan/
+import re
+import hashlib
+import numpy as np
 from .SkippyDevice import SkippyDevice
+from .AsyncSkippyDevice import AsyncSkippyDevice
 from .colors import green, red, yellow, dummy
 from .GlobalLock import GlobalLock
+from . import SCPI
 
 topline = "┏━" + "━"*20 + "━┓"
 botline = "┗━" + "━"*20 + "━┛"
 
+def wave_command(channel: int, kind: str, params: dict, state: SCPI.ShadowState = None) -> str:
+    '''
+    Merge several parameters into a single key/value command, e.g. C1:BSWV WVTP,PULSE,FRQ,0.1,WIDTH,0.001
+
+    Parameters:
+        channel (int): channel 1 or 2
+        kind (str): BSWV (basic wave), BTWV (burst wave), SWWV (sweep wave), ...
+        params (dict): {key: value}, in the order they should be applied
+        state (ShadowState): parameters that are known to be set already are left out
+
+    Returns:
+        str: the command, None if there is nothing to change
+    '''
+    pairs = [f"{key},{value}" for key, value in params.items()
+             if state is None or not state.unchanged(f"C{channel}:{kind} {key}", value)]
+    if not pairs:
+        return None
+    return f"C{channel}:{kind} {','.join(pairs)}"
+
+def arb_data(samples) -> np.ndarray:
+    '''
+    Convert waveform points to the binary format of WVDT, 16 bit little-endian signed integers.
+
+    Parameters:
+        samples (np.ndarray): floats between -1 and 1 (full scale), or integers that are used as they are
+
+    Returns:
+        np.ndarray: contiguous array of '<i2'
+    '''
+    samples = np.asarray(samples)
+    if np.issubdtype(samples.dtype, np.floating):
+        samples = np.rint(np.clip(samples, -1, 1)*32767)
+    return np.ascontiguousarray(samples, dtype='<i2')
+
+def width_scan_data(widths, period: float, points: int) -> tuple:
+    '''
+    Points of an arbitrary waveform with one pulse per period, the i-th pulse with width widths[i].
+
+    Parameters:
+        widths (list): pulse widths in s
+        period (float): time between the rising edges of the pulses in s
+        points (int): total number of points of the waveform
+
+    Returns:
+        tuple: (samples between -1 and 1, widths after rounding to the time resolution)
+    '''
+    widths = np.asarray(widths, dtype=float)
+    per_pulse = points//len(widths)
+    resolution = period/per_pulse
+    high = np.rint(widths/resolution).astype(int)
+    if np.any(high < 1) or np.any(high >= per_pulse):
+        raise ValueError(f"Pulse widths must be between {resolution:.3g} s and the period with {per_pulse} points per pulse")
+    samples = np.where(np.arange(per_pulse)[None, :] < high[:, None], 1., -1.)
+    return samples.ravel(), high*resolution
+
+def parse_wave(res: str) -> dict:
+    '''
+    Parse the reply to C1:BSWV? (or BTWV?, ...), e.g. "C1:BSWV WVTP,PULSE,FRQ,0.1HZ,AMP,2.8V"
+
+    Returns:
+        dict: {key: value}, numbers are converted to float with the unit stripped
+    '''
+    _, _, body = res.strip().partition(' ')
+    items = body.split(',')
+    params = {}
+    for key, value in zip(items[::2], items[1::2]):
+        match = re.fullmatch(r'([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)([A-Za-z]*)', value)
+        params[key] = float(match.group(1)) if match else value
+    return params
+
 class WaveFormGenerator(SkippyDevice):
+    check_errors = False  # the error queue of the SDG is not checked after a batch
+
     def __init__(self,
                  name,
                  ip,
                  port=5024,
                  timeout=1,
                  wait=0.1,
+                 cache=False,
+                 sync='sleep',
+                 transport=None,
                  ):
-        super().__init__(ip, port, name, timeout, wait)
+        super().__init__(ip, port, name, timeout, wait, cache, sync, transport)
 
         self.name   = name
         self.ip     = ip
         self.port   = port
         self.channels = ['CH1', 'CH2']
         self.timeout = timeout
-        _ = self.read()
+        self.clear(expect=True)  # welcome banner
         #print(self.dev.recv(4096).decode('utf-8'))
         self.id()
         #self.status()
@@ -45,14 +125,124 @@ class WaveFormGenerator(SkippyDevice):
             res = self.query('SYST:COMM:LAN:IPAD?')
             print(res)
 
+    def configure_wave(self, channel: int, kind: str, params: dict) -> bool:
+        '''
+        Set several parameters with a single command, leaving out the ones the cache knows are set already.
+
+        Parameters:
+            channel (int): select channel 1 or 2
+            kind (str): BSWV (basic wave), BTWV (burst wave), ...
+            params (dict): {key: value}, in the order they should be applied
+
+        Returns:
+            bool: True if a command was sent
+        '''
+        cmd = wave_command(channel, kind, params, self.state)
+        if cmd is None:
+            self.logger.debug(f"{self.lstr}: C{channel}:{kind} is already set to {params}.")
+            return False
+        self.send(cmd)
+        for key, value in params.items():
+            self.state.update(f"C{channel}:{kind} {key}", value)
+        return True
+
+    def get_wave(self, channel: int=1, kind: str='BSWV') -> dict:
+        '''
+        Read back all parameters of a channel with a single query
+
+        Parameters:
+            channel (int): select channel 1 or 2
+            kind (str): BSWV (basic wave), BTWV (burst wave), ...
+
+        Returns:
+            dict: {key: value}, e.g. {'WVTP': 'PULSE', 'FRQ': 0.1, 'WIDTH': 0.001, ...}
+        '''
+        with GlobalLock(self.ip):
+            return parse_wave(self.query(f"C{channel}:{kind}?"))
+
+    def verify_wave(self, channel: int, kind: str, params: dict):
+        '''
+        Compare the parameters of a channel with the expected ones, raise a ValueError if they don't agree.
+        Numbers are compared with a relative tolerance, since the generator rounds to its resolution.
+        '''
+        res = self.get_wave(channel, kind)
+        wrong = {key: (value, res.get(key)) for key, value in params.items()
+                 if key not in res or not SCPI.compare(str(res[key]), value)}
+        for key, value in res.items():
+            if key in params and key not in wrong:
+                self.state.update(f"C{channel}:{kind} {key}", value)
+        if wrong:
+            self.invalidate(f"C{channel}:{kind}")
+            raise ValueError(f"{self.lstr}: C{channel}:{kind} parameters (expected, read back) don't agree: {wrong}")
+
     def set_wave(self):
         '''
-        This function is a stub.
+        Output a 2.5 kHz sine with 2.1 V amplitude on channel 1. Use upload_arb for arbitrary waveforms.
+        '''
+        with GlobalLock(self.ip):
+            self.configure_wave(1, 'BSWV', {'WVTP': 'SINE', 'FRQ': 2500, 'AMP': 2.1})
+
+    def user_waves(self) -> list:
+        '''
+        Names of the user defined (uploaded) waveforms that are stored on the instrument (STL? USER)
+        '''
+        with GlobalLock(self.ip):
+            res = self.query('STL? USER')
+        names = [name.strip() for name in res.split(' ', 1)[-1].split(',')]
+        return [name for name in names if name and name.upper() != 'WVNM']
+
+    def upload_arb(self,
+                   name: str,
+                   samples,
+                   channel: int=1,
+                   freq: float=1000,
+                   amplitude: float=1,
+                   offset: float=0,
+                   select: bool=True,
+                   force: bool=False,
+                   ) -> bool:
+        '''
+        Upload an arbitrary waveform.
+        The points are sent as binary data straight from the array.
+        With the cache enabled, the upload is skipped if this process uploaded the same waveform under this name before
+        and the instrument still lists it (see user_waves). The instrument can't report the content of a waveform,
+        so the hash is only known to this process: it is forgotten on reconnect, *RST and *RCL,
+        and an upload under the same name from elsewhere goes unnoticed, use force then.
+
+        Parameters:
+            name (str): name of the waveform on the instrument
+            samples (np.ndarray): points, floats between -1 and 1 or 16 bit integers, see arb_data
+            channel (int): select channel 1 or 2
+            freq (float): frequency of the waveform in Hz
+            amplitude (float): amplitude peak to peak in V
+            offset (float): offset in V
+            select (bool): output the waveform on the channel
+            force (bool): upload even if the waveform is known to be there
+
+        Returns:
+            bool: True if the waveform was uploaded
         '''
+        data = arb_data(samples)
+        cmd = f"C{channel}:WVDT WVNM,{name},FREQ,{freq},AMPL,{amplitude},OFST,{offset},PHASE,0,WAVEDATA,"
+        digest = hashlib.sha1(cmd.encode('utf-8'))
+        digest.update(data)
+        digest = digest.hexdigest()
+        key = f"C{channel}:WVDT {name}"
         with GlobalLock(self.ip):
-            self.send('C1:BSWV WVTP,SINE')
-            self.send('C1:BSWV FRQ,2500')
-            self.send('C1:BSWV AMP,2.1')
+            known = not force and self.state.enabled and self.state.get(key) == digest
+            if known and name not in self.user_waves():
+                self.logger.debug(f"{self.lstr}: Waveform {name} was deleted on the instrument.")
+                known = False
+            uploaded = not known
+            if uploaded:
+                self.send_binary(cmd, data)
+                self.state.update(key, digest)
+            else:
+                self.logger.debug(f"{self.lstr}: Waveform {name} is already uploaded.")
+            if select:
+                self.send(f'C{channel}:ARWV NAME,{name}')
+                self.state.update(f'C{channel}:BSWV WVTP', 'ARB')
+        return uploaded
 
     def set_pulse(self,
                   channel: int=1,
@@ -62,9 +252,11 @@ class WaveFormGenerator(SkippyDevice):
                   offset: float=1.4,
                   delay: float=0,
                   period: float=0,
+                  verify: bool=False,
                   ):
         '''
         Configure the Waveform Generator output to generate pulses.
+        All parameters are sent with a single command.
         Parameters:
             channel (int): select channel 1 or 2
             freq (float): frequency of the pulse in Hz
@@ -73,17 +265,20 @@ class WaveFormGenerator(SkippyDevice):
             offset (float): offset in V (half amp for 0-amp signal)
             delay (float): offset in s
             period (float): period in s, overwrites frequency
+            verify (bool): read back all parameters and raise a ValueError if they don't agree
         '''
+        params = {'WVTP': 'PULSE'}
+        if period>0:
+            params['PERI'] = period
+        else:
+            params['FRQ'] = freq
+        params.update({'WIDTH': width, 'AMP': amplitude, 'OFST': offset, 'DLY': delay})
         with GlobalLock(self.ip):
-            self.send(f'C{channel}:BSWV WVTP,PULSE')
-            if period>0:
-                self.send(f'C{channel}:BSWV PERI,{period}')
-            else:
-                self.send(f'C{channel}:BSWV FRQ,{freq}')
-            self.send(f'C{channel}:BSWV WIDTH,{width}')
-            self.send(f'C{channel}:BSWV AMP,{amplitude}')
-            self.send(f'C{channel}:BSWV OFST,{offset}')
-            self.send(f'C{channel}:BSWV DLY,{delay}')
+            # frequency and period are the same setting
+            self.invalidate(f'C{channel}:BSWV FRQ' if period>0 else f'C{channel}:BSWV PERI')
+            self.configure_wave(channel, 'BSWV', params)
+            if verify:
+                self.verify_wave(channel, 'BSWV', params)
 
     def set_burst(self,
                   channel: int=1,
@@ -91,22 +286,106 @@ class WaveFormGenerator(SkippyDevice):
                   trigger: str='MAN',
                   cycles: int=1,
                   delay: float=0.,
+                  verify: bool=False,
                   ):
         '''
         Set a channel into burst mode, with a defined number of cycles.
+        All parameters are sent with a single command.
         Parameters:
             channel (int): select channel 1 or 2
             period (float): period in s
             trigger (str): trigger mode, MANual, INTernal, EXTernal
             cycles (int): number of cycles of burst for a single trigger
+            verify (bool): read back all parameters and raise a ValueError if they don't agree
         '''
         with GlobalLock(self.ip):
             assert trigger in ['MAN', 'EXT', 'INT'], f"Don't know trigger mode {trigger}"
-            self.send(f'C{channel}:BTWV STATE,ON')
-            #self.send(f'C{channel}:BTWV PRD,{period}')
-            self.send(f'C{channel}:BTWV TRSR,{trigger}')
-            self.send(f'C{channel}:BTWV TIME,{cycles}')
-            self.send(f'C{channel}:BTWV DLAY,{delay}')
+            #params['PRD'] = period
+            params = {'STATE': 'ON', 'TRSR': trigger, 'TIME': cycles, 'DLAY': delay}
+            self.configure_wave(channel, 'BTWV', params)
+            if verify:
+                self.verify_wave(channel, 'BTWV', params)
+
+    def set_sweep(self,
+                  channel: int=1,
+                  start: float=100,
+                  stop: float=1000,
+                  time: float=1,
+                  mode: str='LINE',
+                  direction: str='UP',
+                  trigger: str='INT',
+                  verify: bool=False,
+                  ):
+        '''
+        Sweep the frequency of a channel on the instrument, no commands are needed while it runs.
+        All parameters are sent with a single command.
+        Parameters:
+            channel (int): select channel 1 or 2
+            start (float): start frequency in Hz
+            stop (float): stop frequency in Hz
+            time (float): duration of the sweep in s
+            mode (str): LINEar or LOGarithmic
+            direction (str): UP, DOWN or UP_DOWN
+            trigger (str): trigger mode, MANual, INTernal, EXTernal
+            verify (bool): read back all parameters and raise a ValueError if they don't agree
+        '''
+        assert mode in ['LINE', 'LOG'], f"Don't know sweep mode {mode}"
+        assert direction in ['UP', 'DOWN', 'UP_DOWN'], f"Don't know sweep direction {direction}"
+        assert trigger in ['MAN', 'EXT', 'INT'], f"Don't know trigger mode {trigger}"
+        params = {'STATE': 'ON', 'TIME': time, 'START': start, 'STOP': stop, 'SWMD': mode, 'DIR': direction, 'TRSR': trigger}
+        with GlobalLock(self.ip):
+            self.configure_wave(channel, 'SWWV', params)
+            # sweep and burst mode exclude each other
+            self.invalidate(f'C{channel}:BTWV STATE')
+            if verify:
+                self.verify_wave(channel, 'SWWV', params)
+
+    def stop_sweep(self, channel: int=1):
+        '''
+        Turn the sweep of a channel off
+        Parameters:
+            channel (int): select channel 1 or 2
+        '''
+        with GlobalLock(self.ip):
+            self.configure_wave(channel, 'SWWV', {'STATE': 'OFF'})
+
+    def width_scan(self,
+                   channel: int=1,
+                   widths: list=[10e-9, 20e-9, 50e-9, 100e-9],
+                   period: float=1e-6,
+                   amplitude: float=2.8,
+                   offset: float=1.4,
+                   trigger: str='MAN',
+                   points: int=65536,
+                   name: str='width_scan',
+                   ) -> np.ndarray:
+        '''
+        Program a whole pulse width scan into the instrument.
+        The SDG has no list mode, so the scan is uploaded as an arbitrary waveform with one pulse per period,
+        and every trigger plays the whole scan once (burst mode).
+        NOTE this is not a step per trigger: a single trigger produces all len(widths) pulses back-to-back,
+        period apart, in the order of widths. To get one width per trigger, call change_pulse_width
+        before each send_trigger instead.
+        The channel outputs the ARB waveform afterwards, call set_pulse to go back to single pulses.
+        Re-programming the same scan does not upload it again if the cache is enabled, see upload_arb.
+        Parameters:
+            channel (int): select channel 1 or 2
+            widths (list): pulse widths in s
+            period (float): time between the pulses in s
+            amplitude (float): amplitude peak to peak in V
+            offset (float): offset in V (half amp for 0-amp signal)
+            trigger (str): trigger mode, MANual, INTernal, EXTernal
+            points (int): number of points of the waveform, sets the time resolution period*len(widths)/points
+
+        Returns:
+            np.ndarray: pulse widths after rounding to the time resolution
+        '''
+        samples, widths = width_scan_data(widths, period, points)
+        with GlobalLock(self.ip):
+            self.upload_arb(name, samples, channel, freq=1/(period*len(widths)), amplitude=amplitude, offset=offset)
+            self.set_burst(channel, trigger=trigger, cycles=1)
+            self.invalidate(f'C{channel}:SWWV STATE')
+        return widths
 
     def change_burst_trig_src(self, channel: int=1, src: str='MAN'):
         '''
@@ -115,28 +394,32 @@ class WaveFormGenerator(SkippyDevice):
             channel (int): select channel 1 or 2
         '''
         with GlobalLock(self.ip):
-            self.send(f'C{channel}:BTWV TRSR,{src}')
+            self.configure_wave(channel, 'BTWV', {'TRSR': src})
 
-    def change_pulse_width(self, channel: int=1, width: float=10e-9):
+    def change_pulse_width(self, channel: int=1, width: float=10e-9, verify: bool=False):
         '''
         Change the pulse width for a channel
         Parameters:
             channel (int): select channel 1 or 2
+            verify (bool): read back the width and raise a ValueError if it doesn't agree
         '''
         with GlobalLock(self.ip):
-            self.send(f'C{channel}:BSWV WIDTH,{width}')
+            self.configure_wave(channel, 'BSWV', {'WIDTH': width})
+            if verify:
+                self.verify_wave(channel, 'BSWV', {'WIDTH': width})
 
-    def send_trigger(self, channel: int=1):
+    def send_trigger(self, channel: int=1, kind: str='BTWV'):
         '''
         Send a manual trigger pulse
         Parameters:
             channel (int): select channel 1 or 2
+            kind (str): BTWV to trigger a burst, SWWV to trigger a sweep
         '''
-        with GlobalLock(self.ip):
+        with GlobalLock(self.ip), self.batch():
             # change trigger source to MAN so that we can actually send a trigger
-            self.send(f'C{channel}:BTWV TRSR,MAN')
+            self.configure_wave(channel, kind, {'TRSR': 'MAN'})
             # send the trigger cmd
-            self.send(f'C{channel}:BTWV MTRIG')
+            self.send(f'C{channel}:{kind} MTRIG')
             ## change trigger source to INT so the channel does not trigger unexpectedly
             # self.send(f'C{channel}:BTWV TRSR,EXT')
 
@@ -147,7 +430,7 @@ class WaveFormGenerator(SkippyDevice):
             channel (int): the channel to enable
             hiz (bool): set output to High Z (default) or 50Ohm
         '''
-        with GlobalLock(self.ip):
+        with GlobalLock(self.ip), self.batch():
             self.send(f'C{channel}:OUTP ON')
             if hiz:
                 self.send(f'C{channel}:OUTP LOAD,HZ')
@@ -160,7 +443,7 @@ class WaveFormGenerator(SkippyDevice):
         Parameters:
             channel (int): the channel to enable
         '''
-        with GlobalLock(self.ip):
+        with GlobalLock(self.ip), self.batch():
             if channel==0:
                 self.send(f'C1:OUTP OFF')
                 self.send(f'C2:OUTP OFF')
@@ -187,3 +470,134 @@ class WaveFormGenerator(SkippyDevice):
             res = self.send('*RST')
             if res:
                 self.logger.info(f"{self.lstr}: Device has been reset")
+
+
+class AsyncWaveFormGenerator(AsyncSkippyDevice):
+    '''
+    asyncio version of WaveFormGenerator. Use as
+
+        async with AsyncWaveFormGenerator("SDG", "192.168.0.80") as wfg:
+            await wfg.set_pulse(channel=1, width=1e-6)
+    '''
+    def __init__(self,
+                 name,
+                 ip,
+                 port=5024,
+                 timeout=1,
+                 wait=0.1,
+                 cache=False,
+                 sync='sleep',
+                 ):
+        super().__init__(ip, port, name, timeout, wait, cache, sync)
+        self.channels = ['CH1', 'CH2']
+
+    async def connect(self, timeout: float = None) -> bool:
+        res = await super().connect(timeout)
+        await self.clear(expect=True)  # welcome banner
+        await self.id()
+        return res
+
+    async def id(self):
+        async with self.global_lock():
+            res = (await self.query('*IDN?')).split(',')
+        self.model = res[1]
+        self.firmware = res[3]
+        self.hardware = res[2]
+
+    async def configure_wave(self, channel: int, kind: str, params: dict) -> bool:
+        '''
+        Set several parameters with a single command, see WaveFormGenerator.configure_wave
+        '''
+        cmd = wave_command(channel, kind, params, self.state)
+        if cmd is None:
+            return False
+        await self.send(cmd)
+        for key, value in params.items():
+            self.state.update(f"C{channel}:{kind} {key}", value)
+        return True
+
+    async def get_wave(self, channel: int=1, kind: str='BSWV') -> dict:
+        '''
+        Read back all parameters of a channel with a single query, see WaveFormGenerator.get_wave
+        '''
+        async with self.global_lock():
+            return parse_wave(await self.query(f"C{channel}:{kind}?"))
+
+    async def set_pulse(self,
+                        channel: int=1,
+                        freq: float=0.1,
+                        width: float=0.001,
+                        amplitude: float=2.8,
+                        offset: float=1.4,
+                        delay: float=0,
+                        period: float=0,
+                        ):
+        '''
+        Configure the Waveform Generator output to generate pulses, see WaveFormGenerator.set_pulse
+        '''
+        params = {'WVTP': 'PULSE'}
+        if period>0:
+            params['PERI'] = period
+        else:
+            params['FRQ'] = freq
+        params.update({'WIDTH': width, 'AMP': amplitude, 'OFST': offset, 'DLY': delay})
+        async with self.global_lock():
+            self.invalidate(f'C{channel}:BSWV FRQ' if period>0 else f'C{channel}:BSWV PERI')
+            await self.configure_wave(channel, 'BSWV', params)
+
+    async def set_burst(self,
+                        channel: int=1,
+                        period: float=5.1,
+                        trigger: str='MAN',
+                        cycles: int=1,
+                        delay: float=0.,
+                        ):
+        '''
+        Set a channel into burst mode, see WaveFormGenerator.set_burst
+        '''
+        assert trigger in ['MAN', 'EXT', 'INT'], f"Don't know trigger mode {trigger}"
+        async with self.global_lock():
+            await self.configure_wave(channel, 'BTWV', {'STATE': 'ON', 'TRSR': trigger, 'TIME': cycles, 'DLAY': delay})
+
+    async def set_sweep(self,
+                        channel: int=1,
+                        start: float=100,
+                        stop: float=1000,
+                        time: float=1,
+                        mode: str='LINE',
+                        direction: str='UP',
+                        trigger: str='INT',
+                        ):
+        '''
+        Sweep the frequency of a channel on the instrument, see WaveFormGenerator.set_sweep
+        '''
+        assert mode in ['LINE', 'LOG'], f"Don't know sweep mode {mode}"
+        assert direction in ['UP', 'DOWN', 'UP_DOWN'], f"Don't know sweep direction {direction}"
+        assert trigger in ['MAN', 'EXT', 'INT'], f"Don't know trigger mode {trigger}"
+        async with self.global_lock():
+            await self.configure_wave(channel, 'SWWV', {'STATE': 'ON', 'TIME': time, 'START': start, 'STOP': stop,
+                                                        'SWMD': mode, 'DIR': direction, 'TRSR': trigger})
+            self.invalidate(f'C{channel}:BTWV STATE')
+
+    async def stop_sweep(self, channel: int=1):
+        async with self.global_lock():
+            await self.configure_wave(channel, 'SWWV', {'STATE': 'OFF'})
+
+    async def change_pulse_width(self, channel: int=1, width: float=10e-9):
+        async with self.global_lock():
+            await self.configure_wave(channel, 'BSWV', {'WIDTH': width})
+
+    async def send_trigger(self, channel: int=1, kind: str='BTWV'):
+        async with self.global_lock():
+            await self.configure_wave(channel, kind, {'TRSR': 'MAN'})
+            await self.send(f'C{channel}:{kind} MTRIG')
+
+    async def enable(self, channel: int=1, hiz: bool=True):
+        async with self.global_lock():
+            await self.send(f'C{channel}:OUTP ON')
+            await self.send(f'C{channel}:OUTP LOAD,{"HZ" if hiz else "50"}')
+
+    async def disable(self, channel: int=0):
+        async with self.global_lock():
+            for ch in ([1, 2] if channel==0 else [channel]):
+                await self.send(f'C{ch}:OUTP OFF')
@@ -8,51 +8,80 @@ import logging
 import threading
 import time
 import zmq
-import numpy as np
+from collections import deque
+
+from . import SCPI
+from .SkippyDevice import PendingReply
 
 class ZeroMQDevice():
-    def __init__(self, ip: str, port: int, name: str = "", timeout: int = 1, wait: int = 0):
+    def __init__(self, ip: str, port: int, name: str = "", timeout: int = 1, wait: int = 0, retries: int = 3, transport=None):
         '''
         Initialize a SCPI device, with a default timeout for socket transactions.
         For some (slow?) devices a wait time between send and receive is necessary.
 
+        The device is talked to with a DEALER socket, so that several queries can be outstanding (see submit).
+        All devices of a process share one ZMQ context.
+
         Parameters:
             ip (str): IP Address of the device
             port (int): port to use for SCPI connection
             name (str): arbitrary name used for the python instance of the device
             timeout (int): timeout of socket transaction in seconds
             wait (int): wait time between after sending a message
+            retries (int): number of times a query is resent on a new connection after a timeout
+            transport (RemoteDevice): send everything through the broker instead of a connection of our own, see from_broker
         '''
 
         self.name       = name
         self.ip         = ip
         self.port       = port
         self.dev        = None
+        self.poller     = None
         self.timeout    = timeout
         self.wait       = wait
+        self.retries    = retries
 
         self.logger     = logging.getLogger(__name__)
-        self.lock       = threading.Lock()
+        self.lock       = threading.RLock()
+        self.pending    = deque()
+        self.transport  = transport
+        self.replies    = deque()  # replies from the transport that were not read yet
 
         self.lstr = f"{self.name} @ {self.ip}:{self.port}"
 
         self.connect()
 
+    @classmethod
+    def from_broker(cls, remote, **kwargs):
+        '''
+        Instrument that talks to the device through the broker, without a connection of its own, see SkippyDevice.from_broker
+
+        Parameters:
+            remote (RemoteDevice): the device, from BrokerClient.device
+            kwargs: further arguments of the instrument class
+        '''
+        return cls(name=remote.name, ip=f"broker_{remote.name}", port=None, transport=remote, **kwargs)
+
     def connect(self) -> bool:
         '''
-        Socket based connection
+        Socket based connection.
+        Reconnecting drops all replies that are still on their way, see query.
 
         Returns:
             bool: True for a successful connection
         '''
         with self.lock:
-            context = zmq.Context()
-            self.dev = context.socket(zmq.REQ)
-            #self.dev.settimeout(self.timeout)
+            self._fail_pending(ConnectionError(f"{self.lstr}: Connection was reset"))
+            if self.transport:
+                self.replies.clear()
+                return True
+            if self.dev:
+                self.dev.close(linger=0)
+            self.dev = zmq.Context.instance().socket(zmq.DEALER)
+            self.dev.setsockopt(zmq.LINGER, 0)
             self.dev.connect(f"tcp://{self.ip}:{self.port}")
-            #context = zmq.Context()
-            #self.dev = context.socket(zmq.REQ)
-            #self.dev.connect(f"tcp://{self.ip}:{self.port}")
+            self.poller = zmq.Poller()
+            self.poller.register(self.dev, zmq.POLLIN)
             self.logger.info(f"{self.lstr}: Connected to SCPI Device")
 
         if self.dev:
@@ -62,39 +91,72 @@ class ZeroMQDevice():
 
     def send(self, msg: str):
         '''
-        Send a message to the device
+        Send a message to the device.
+        The device replies to every message, the reply to a message sent with send is read and discarded
+        before the next query (see collect). Use query or submit to get the reply.
 
         Parameters:
             msg (str): The message to be sent to the device
         '''
         with self.lock:
+            if self.transport:
+                # the device replies to every message, the broker returns the reply
+                self.logger.debug(f"{self.lstr}: Sending message through the broker: {msg}")
+                self.replies.append(self.transport.query(msg))
+                self.pending.append(None)
+                return
             if not self.dev:
                 self.logger.debug(f"{self.lstr}: Reconnecting")
                 self.connect()
             self.logger.debug(f"{self.lstr}: Sending message: {msg}")
-            self.dev.send_string(f"{msg}")
+            # empty delimiter frame, as a REQ socket would send it
+            self.dev.send_multipart([b'', f"{msg}".encode('utf-8')])
+            self.pending.append(None)  # reply to be discarded
             if self.wait>0:
                 time.sleep(self.wait)
 
-    def read(self) -> str:
+    def _claim_reply(self):
+        '''
+        The reply to the message that was just sent is read by the caller, don't discard it
+        '''
+        if self.pending and self.pending[-1] is None:
+            self.pending.pop()
+
+    def read(self, timeout: float = None) -> str:
         '''
         Read response from the device
 
+        Parameters:
+            timeout (float): timeout in seconds, defaults to the device timeout
+
         Returns:
             str: Response from the device
+
+        Raises:
+            TimeoutError: if no response arrived in time
         '''
         with self.lock:
+            if self.transport:
+                if not self.replies:
+                    raise ConnectionError(f"{self.lstr}: No reply from the broker to read")
+                return self.replies.popleft()
             if not self.dev:
                 self.logger.debug(f"{self.lstr}: Reconnecting")
                 self.connect()
             self.logger.debug(f"{self.lstr}: Reading message.")
-            res = self.dev.recv().decode("utf-8").strip()
+            timeout = self.timeout if timeout is None else timeout
+            if timeout is not None and not self.poller.poll(timeout*1000):
+                raise TimeoutError(f"{self.lstr}: No response within {timeout}s")
+            res = self.dev.recv_multipart()[-1].decode("utf-8").strip()
             self.logger.debug(f"{self.lstr}: Received message: {res}")
             return res
 
     def query(self, msg:str) -> str:
         '''
-        Submit a query to the device
+        Submit a query to the device.
+        If the reply to a query (a message with '?') doesn't arrive in time, the connection is re-established
+        and the query resent (lazy pirate), up to retries times.
+        Other messages, e.g. ARM or STOP, are never resent since they may have been executed already.
 
         Parameters:
             msg (str): The message to be sent to the device
@@ -102,8 +164,92 @@ class ZeroMQDevice():
         Returns:
             str: Response from the device
         '''
-        self.send(msg)
-        return self.read()
+        with self.lock:
+            if self.pending:
+                self.collect()
+            retries = self.retries if SCPI.is_query(msg) else 0
+            for attempt in range(retries + 1):
+                self.send(msg)
+                self._claim_reply()
+                try:
+                    return self.read()
+                except TimeoutError:
+                    if attempt == retries:
+                        self.connect()
+                        raise
+                    self.logger.warning(f"{self.lstr}: No response to {msg}, reconnecting and retrying.")
+                    self.connect()
+
+    def submit(self, msg: str) -> PendingReply:
+        '''
+        Send a query without waiting for the reply, so that several queries can be outstanding.
+        Replies are matched to queries in the order the queries were submitted.
+
+        Parameters:
+            msg (str): The query to be sent to the device
+
+        Returns:
+            PendingReply: future that resolves to the response from the device
+        '''
+        with self.lock:
+            self.send(msg)
+            self._claim_reply()
+            reply = PendingReply(self, msg)
+            self.pending.append(reply)
+        return reply
+
+    def collect(self, until: PendingReply = None):
+        '''
+        Read the replies of submitted queries in FIFO order, and discard the replies to messages sent with send.
+        After a timeout the connection is re-established and all outstanding queries fail,
+        they are not resent since they may have been executed already.
+
+        Parameters:
+            until (PendingReply): stop after this reply has been read, read all outstanding replies if None
+        '''
+        with self.lock:
+            while self.pending:
+                reply = self.pending.popleft()
+                try:
+                    res = self.read()
+                except Exception as e:
+                    if reply is not None:
+                        reply.set_exception(e)
+                    self._fail_pending(e)
+                    if isinstance(e, TimeoutError):
+                        self.connect()
+                    raise
+                if reply is None:
+                    self.logger.debug(f"{self.lstr}: Discarding reply: {res}")
+                    continue
+                reply.set_result(res)
+                if reply is until:
+                    break
+
+    def _fail_pending(self, exc: Exception):
+        while self.pending:
+            reply = self.pending.popleft()
+            if reply is not None:
+                reply.set_exception(exc)
+
+    def pipeline(self, msgs: list) -> list:
+        '''
+        Send several messages back-to-back and read all replies afterwards
+
+        Parameters:
+            msgs (list): messages to be sent to the device
+
+        Returns:
+            list: responses from the device, in the same order as msgs
+        '''
+        with self.lock:
+            if self.transport:
+                if self.pending:
+                    self.collect()
+                return self.transport.pipeline(msgs)
+            replies = [self.submit(msg) for msg in msgs]
+            self.collect()
+        return [reply.result() for reply in replies]
 
     def write(self, cmd, value, strict=True) -> bool:
         '''
@@ -120,14 +266,8 @@ class ZeroMQDevice():
             bool: True if write and readback agree, False otherwise.
         '''
         self.logger.debug(f"{self.lstr}: Writing {value} to {cmd}.")
-        self.send(f"{cmd} {value}")
-        res = self.query(f"{cmd}?")
-        try:
-            comp = np.isclose(float(res), float(value))
-        except ValueError:
-            # if return value is not a number, compare the strings
-            comp = (res == str(value))
-        if comp:
+        _, res = self.pipeline([f"{cmd} {value}", f"{cmd}?"])
+        if SCPI.compare(res, value):
             self.logger.debug(f"{self.lstr}: Write successful.")
             return True
         else:
@@ -142,6 +282,10 @@ class ZeroMQDevice():
         '''
         with self.lock:
             self.logger.info(f"{self.lstr}: Closing Connection.")
-            self.dev.close()
+            self._fail_pending(ConnectionError(f"{self.lstr}: Connection closed"))
+            self.replies.clear()
+            if self.dev:
+                self.dev.close(linger=0)
             self.dev = None
+            self.poller = None
             self.logger.info(f"{self.lstr}: Connection to SCPI Device closed.")
@@ -1,4 +1,4 @@
-from .PowerSupply import PowerSupply
+from .PowerSupply import PowerSupply, AsyncPowerSupply
 from .colors import green, red, yellow, dummy
 
 __version__ = "1.0.0"
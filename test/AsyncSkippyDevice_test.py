@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+from cocina.AsyncSkippyDevice import AsyncSkippyDevice
+from cocina.PowerSupply import AsyncPowerSupply
+
+class FakeInstrument:
+    '''
+    Minimal line based SCPI server answering every query with a fixed value
+    '''
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.received = []
+
+    async def handle(self, reader, writer):
+        while True:
+            try:
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError:
+                break
+            msg = line.decode().strip()
+            self.received.append(msg)
+            if msg.endswith('?') or '? ' in msg:
+                await asyncio.sleep(self.delay)
+                if msg == '*IDN?':
+                    writer.write(b'Siglent,SPD3303X,SN123,1.0,2.0\n')
+                elif msg == 'BLOCK?':
+                    writer.write(b'#216' + bytes(range(16)) + b'\n')
+                elif msg.startswith('ECHO?'):
+                    writer.write(msg.split()[-1].encode() + b'\n')
+                elif msg == 'SYSTEM:STATUS?':
+                    writer.write(b'0x0010\n')
+                else:
+                    writer.write(b'1.5\n')
+                await writer.drain()
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+class AsyncSkippyDeviceTest(unittest.TestCase):
+
+    def test_query_and_write(self):
+        async def run():
+            instrument = FakeInstrument()
+            port = await instrument.start()
+            async with AsyncSkippyDevice('127.0.0.1', port, 'test') as dev:
+                self.assertEqual(await dev.query('MEAS:VOLT?'), '1.5')
+                self.assertTrue(await dev.write('VOLT', 1.5))
+                self.assertFalse(await dev.write('VOLT', 2, strict=False))
+            instrument.server.close()
+        asyncio.run(run())
+
+    def test_timeout_drops_connection(self):
+        async def run():
+            instrument = FakeInstrument(delay=0.5)
+            port = await instrument.start()
+            async with AsyncSkippyDevice('127.0.0.1', port, 'test') as dev:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await dev.query('MEAS:VOLT?', timeout=0.05)
+                self.assertIsNone(dev.dev)
+                # reconnects on the next call
+                self.assertEqual(await dev.query('MEAS:VOLT?', timeout=2), '1.5')
+            instrument.server.close()
+        asyncio.run(run())
+
+    def test_pipelined_queries(self):
+        async def run():
+            instrument = FakeInstrument(delay=0.01)
+            port = await instrument.start()
+            async with AsyncSkippyDevice('127.0.0.1', port, 'test') as dev:
+                res = await asyncio.gather(*[dev.query(f'ECHO? {i}') for i in range(20)])
+                self.assertEqual(res, [str(i) for i in range(20)])
+                self.assertEqual(await dev.pipeline(['ECHO? a', 'ECHO? b']), ['a', 'b'])
+                # a cancelled query keeps its place in the queue
+                task = asyncio.ensure_future(dev.query('ECHO? lost'))
+                await asyncio.sleep(0)
+                task.cancel()
+                self.assertEqual(await dev.query('ECHO? next'), 'next')
+            instrument.server.close()
+        asyncio.run(run())
+
+    def test_block(self):
+        async def run():
+            instrument = FakeInstrument()
+            port = await instrument.start()
+            async with AsyncSkippyDevice('127.0.0.1', port, 'test') as dev:
+                out = bytearray(32)
+                view = await dev.query_block('BLOCK?', out=out)
+                self.assertEqual(bytes(view), bytes(range(16)))
+                self.assertEqual(await dev.query('ECHO? after'), 'after')
+            instrument.server.close()
+        asyncio.run(run())
+
+    def test_power_supply(self):
+        async def run():
+            instrument = FakeInstrument()
+            port = await instrument.start()
+            async with AsyncPowerSupply('test', '127.0.0.1', port) as ps:
+                self.assertEqual(ps.model, 'SPD3303X')
+                self.assertEqual(ps.CH1, 1)
+                self.assertEqual(ps.CH2, 0)
+                res = await ps.monitor(show=False)
+                self.assertEqual(res['CH1']['Voltage'], 1.5)
+                await ps.set_voltage('CH1', 3.3)
+            instrument.server.close()
+            self.assertIn('CH1:VOLT 3.3', instrument.received)
+        asyncio.run(run())
+
+    def test_power_supply_reconnect(self):
+        # the handshake of connect (id, status) talks to the device, it must not wait for the lock of the reconnecting call
+        async def run():
+            instrument = FakeInstrument()
+            port = await instrument.start()
+            ps = AsyncPowerSupply('test', '127.0.0.1', port)
+            await ps.connect()
+            instrument.delay = 0.5
+            with self.assertRaises(asyncio.TimeoutError):
+                await ps.measure(timeout=0.05)
+            self.assertIsNone(ps.dev)
+            instrument.delay = 0
+            self.assertEqual(await asyncio.wait_for(ps.measure(), 2), 1.5)
+            await ps.close()
+            self.assertEqual(await asyncio.wait_for(ps.measure(), 2), 1.5)
+            self.assertEqual(instrument.received.count('*IDN?'), 3)
+            await ps.close()
+            instrument.server.close()
+        asyncio.run(run())
+
+    def test_global_lock(self):
+        async def run():
+            dev = AsyncSkippyDevice('127.0.0.1', 0, 'lock_test')
+            order = []
+            async def hold(i):
+                async with dev.global_lock():
+                    order.append(('in', i))
+                    await asyncio.sleep(0.02)
+                    order.append(('out', i))
+            await asyncio.gather(*[hold(i) for i in range(3)])
+            # never two tasks inside at once
+            self.assertEqual([kind for kind, _ in order], ['in', 'out']*3)
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
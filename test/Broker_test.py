@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import socket
+import tempfile
+import threading
+import unittest
+from cocina.Broker import Broker, BrokerClient, DeviceQueue
+from cocina.SkippyDevice import SkippyDevice
+from cocina.PowerSupply import PowerSupply
+
+def serve(server, received):
+    '''
+    Answer "ECHO? <x>" queries with <x>, "SLOW? <x>" with <x> after 0.5 s and "COUNT?" with the number of messages received
+    '''
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return
+        buf = b''
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                received.append(line.decode())
+                if line.startswith(b'SLOW?'):
+                    time.sleep(0.5)
+                if line.startswith((b'ECHO?', b'SLOW?')):
+                    conn.sendall(line.split()[-1] + b'\n')
+                elif line == b'COUNT?':
+                    conn.sendall(f"{len(received)}\n".encode())
+                elif line == b'*IDN?':
+                    conn.sendall(b'Siglent Technologies,SPD3303X,SPD3XXX0000000,1.01.01.02.05,V3.0\n')
+                elif line == b'SYSTEM:STATUS?':
+                    conn.sendall(b'0x0030\n')
+        conn.close()
+
+class DeviceQueueTest(unittest.TestCase):
+
+    def test_round_robin(self):
+        queue = DeviceQueue()
+        for i in range(3):
+            queue.put('a', 'send', {'msg': f'a{i}'}, None)
+        queue.put('b', 'send', {'msg': 'b0'}, None)
+        queue.put('c', 'send', {'msg': 'c0'}, None)
+        self.assertEqual(len(queue), 5)
+        order = []
+        while (job := queue.get()) is not None:
+            order.append(job.args['msg'])
+        self.assertEqual(order, ['a0', 'b0', 'c0', 'a1', 'a2'])
+
+    def test_coalesce(self):
+        queue = DeviceQueue()
+        self.assertFalse(queue.put('a', 'query', {'msg': 'VOLT?'}, 1))
+        self.assertTrue(queue.put('b', 'query', {'msg': 'VOLT?'}, 2))
+        # c has a command waiting, its query must be answered after that command
+        self.assertFalse(queue.put('c', 'send', {'msg': 'VOLT 1'}, 3))
+        self.assertFalse(queue.put('c', 'query', {'msg': 'VOLT?'}, 4))
+        job = queue.get()
+        self.assertEqual(job.futures, [1, 2])
+        # joins the query of c that is still waiting, not the one that is already being sent
+        self.assertTrue(queue.put('b', 'query', {'msg': 'VOLT?'}, 5))
+        self.assertEqual([queue.get().futures for _ in range(2)], [[3], [4, 5]])
+        self.assertIsNone(queue.get())
+        self.assertEqual(queue.coalesced, 2)
+
+    def test_no_coalesce(self):
+        queue = DeviceQueue()
+        for msg in ['SYST:ERR?', ':SYSTem:ERRor:NEXT?', '*OPC?', 'INIT;*OPC?', ':TRAC:DATA? 1, 10, "defbuffer1"', '*ESR?']:
+            self.assertFalse(queue.put('a', 'query', {'msg': msg}, 1))
+            self.assertFalse(queue.put('b', 'query', {'msg': msg}, 2), msg)
+        self.assertEqual(queue.coalesced, 0)
+        self.assertTrue(queue.shareable('MEAS:VOLT? CH1;MEAS:CURR? CH1'))
+        # configurable
+        queue = DeviceQueue(no_coalesce=[r'MEAS'])
+        self.assertFalse(queue.shareable('MEAS:VOLT? CH1'))
+        self.assertTrue(queue.shareable('SYST:ERR?'))
+
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.received = []
+        threading.Thread(target=serve, args=(self.server, self.received), daemon=True).start()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = f"{self.tmp.name}/broker.sock"
+        config = {'echo': {'type': 'scpi', 'ip': '127.0.0.1', 'port': self.server.getsockname()[1]}}
+        self.broker = Broker(config, path=self.path)
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.broker.start())
+            started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        self.assertTrue(started.wait(5))
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.broker.close(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+        self.server.close()
+        self.tmp.cleanup()
+
+    def test_client(self):
+        with BrokerClient(self.path, timeout=5) as client:
+            self.assertEqual(client.devices(), ['echo'])
+            dev = client.device('echo')
+            self.assertEqual(dev.query('ECHO? hello'), 'hello')
+            dev.send('VOLT 1')
+            self.assertEqual(dev.pipeline(['ECHO? 1', 'ECHO? 2']), ['1', '2'])
+            self.assertEqual(dev.query('COUNT?'), '5')
+            with self.assertRaises(RuntimeError):
+                client.request('query', device='nothing', msg='*IDN?')
+            self.assertEqual(client.stats()['echo']['executed'], 4)
+
+    def test_transport(self):
+        with BrokerClient(self.path, timeout=5) as client:
+            dev = SkippyDevice.from_broker(client.device('echo'))
+            self.assertEqual(dev.query('ECHO? hello'), 'hello')
+            reply = dev.submit('ECHO? later')
+            dev.send('VOLT 1')
+            self.assertEqual(reply.result(), 'later')
+            self.assertEqual(dev.pipeline(['ECHO? 1', 'ECHO? 2']), ['1', '2'])
+            with self.assertRaises(NotImplementedError):
+                dev.query_block('TRAC:DATA?')
+            psu = PowerSupply.from_broker(client.device('echo'))
+            self.assertEqual((psu.model, psu.CH1, psu.CH2), ('SPD3303X', 1, 1))
+            psu.close()
+            dev.close()
+            self.assertEqual(client.stats()['echo']['executed'], 6)
+        self.assertEqual(self.received[-2:], ['*IDN?', 'SYSTEM:STATUS?'])
+
+    def test_timeout(self):
+        with BrokerClient(self.path, timeout=5) as client:
+            dev = client.device('echo')
+            self.assertEqual(dev.query('ECHO? first'), 'first')
+            client.sock.settimeout(0.2)
+            with self.assertRaises(socket.timeout):
+                dev.query('SLOW? late')
+            client.sock.settimeout(5)
+            # the late reply is skipped
+            self.assertEqual(dev.query('ECHO? next'), 'next')
+            self.assertEqual(client.devices(), ['echo'])
+
+    def test_clients(self):
+        # several scripts share the single connection of the broker
+        results = {}
+        def script(i):
+            with BrokerClient(self.path, timeout=5) as client:
+                results[i] = [client.device('echo').query(f'ECHO? {i}_{j}') for j in range(10)]
+        threads = [threading.Thread(target=script, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {i: [f'{i}_{j}' for j in range(10)] for i in range(5)})
+
+if __name__ == '__main__':
+    unittest.main()
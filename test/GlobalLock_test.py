@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import signal
+import threading
+import unittest
+import multiprocessing
+from cocina import GlobalLock as lock_module
+from cocina.GlobalLock import GlobalLock
+
+def hold(name, ready, seconds):
+    with GlobalLock(name):
+        ready.set()
+        time.sleep(seconds)
+
+class GlobalLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.name = f"cocina_test_{uuid.uuid4().hex}"
+        self.ctx = multiprocessing.get_context('spawn')
+
+    def tearDown(self):
+        try:
+            os.remove(f"/tmp/{self.name}_lock")
+        except OSError:
+            pass
+
+    def test_reentrant(self):
+        with GlobalLock(self.name):
+            with GlobalLock(self.name, timeout=0.1):
+                pass
+            # still held after the inner block, another thread has to wait
+            res = []
+            def other():
+                try:
+                    with GlobalLock(self.name, timeout=0.1):
+                        res.append(True)
+                except TimeoutError:
+                    res.append(False)
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join()
+            self.assertEqual(res, [False])
+        with GlobalLock(self.name, timeout=0.1):
+            pass
+
+    def test_processes(self):
+        ready = self.ctx.Event()
+        proc = self.ctx.Process(target=hold, args=(self.name, ready, 0.5))
+        proc.start()
+        self.assertTrue(ready.wait(10))
+        with self.assertRaises(TimeoutError):
+            with GlobalLock(self.name, timeout=0.1):
+                pass
+        # waiters are woken up as soon as the lock is released
+        start = time.monotonic()
+        with GlobalLock(self.name, timeout=10):
+            self.assertLess(time.monotonic() - start, 0.5)
+        proc.join()
+        stats = lock_module.stats(self.name)
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['contended'], 1)
+        (blocked_by, wait), = stats['blocked_by'].items()
+        self.assertTrue(blocked_by.startswith(f"{proc.pid} "))
+        self.assertAlmostEqual(wait, stats['wait'])
+
+    def test_dead_holder(self):
+        ready = self.ctx.Event()
+        proc = self.ctx.Process(target=hold, args=(self.name, ready, 60))
+        proc.start()
+        self.assertTrue(ready.wait(10))
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.join()
+        with GlobalLock(self.name, timeout=1):
+            pass
+
+    def test_owner(self):
+        lock = GlobalLock(self.name, owner='task')
+        thread = threading.Thread(target=lock.__enter__)
+        thread.start()
+        thread.join()
+        # released by a different thread than the one that acquired it
+        lock.__exit__(None, None, None)
+        with GlobalLock(self.name, timeout=0.1):
+            pass
+
+    def test_stats(self):
+        lock_module.reset_stats()
+        for _ in range(3):
+            with GlobalLock(self.name):
+                with GlobalLock(self.name):
+                    time.sleep(0.01)
+        stats = lock_module.stats(self.name)
+        self.assertEqual(stats['count'], 3)  # nested acquisitions are not counted
+        self.assertEqual(stats['contended'], 0)
+        self.assertGreaterEqual(stats['hold'], 0.03)
+        self.assertIsNone(stats['holder'])
+        (site, site_stats), = stats['sites'].items()
+        self.assertIn('GlobalLock_test.py', site)
+        self.assertIn('test_stats', site)
+        self.assertEqual(site_stats['count'], 3)
+        dump = json.loads(lock_module.dump_stats())
+        self.assertEqual(dump['pid'], os.getpid())
+        self.assertIn(f"/tmp/{self.name}_lock", dump['locks'])
+        lock_module.reset_stats()
+        self.assertEqual(lock_module.stats(self.name), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import sys
+import types
+import tempfile
+import unittest
+from unittest.mock import patch
+
+class FakeSMBus:
+    '''
+    Register file of an I2C device, every transfer is recorded in transfers
+    '''
+    def __init__(self, channel=1):
+        self.registers = {}
+        self.transfers = []
+
+    def read_byte_data(self, i2c_adr, adr):
+        self.transfers.append(('read', adr))
+        return self.registers.get(adr, 0)
+
+    def write_byte_data(self, i2c_adr, adr, val):
+        self.transfers.append(('write', adr, val))
+        self.registers[adr] = val
+
+    def read_i2c_block_data(self, i2c_adr, adr, length):
+        self.transfers.append(('block', adr, length))
+        return [self.registers.get(a, 0) for a in range(adr, adr + length)]
+
+# smbus is only available on the Raspberry Pi
+smbus = types.ModuleType('smbus')
+smbus.SMBus = FakeSMBus
+sys.modules.setdefault('smbus', smbus)
+
+from cocina import RPi_I2C_Device
+from cocina.RPi_I2C_Device import I2C_Device, plan_spans
+from cocina.BME280_RPi import BME280
+from cocina.RegisterMap import RegisterMap
+
+class PlanSpansTest(unittest.TestCase):
+
+    def test_consecutive(self):
+        self.assertEqual(plan_spans([]), [])
+        self.assertEqual(plan_spans([0x8A, 0x88, 0x89, 0x89]), [(0x88, 3)])
+
+    def test_gaps(self):
+        self.assertEqual(plan_spans([1, 2, 5]), [(1, 2), (5, 1)])
+        self.assertEqual(plan_spans([1, 2, 5], max_gap=1), [(1, 2), (5, 1)])
+        self.assertEqual(plan_spans([1, 2, 5], max_gap=2), [(1, 5)])
+
+    def test_max_length(self):
+        self.assertEqual(plan_spans(range(40)), [(0, 32), (32, 8)])
+        self.assertEqual(plan_spans([0, 31, 32], max_gap=40), [(0, 32), (32, 1)])
+        self.assertEqual(plan_spans([4, 3, 2, 1], max_length=3), [(1, 3), (4, 1)])
+
+class I2C_DeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'COCINA_CACHE': self.tmp.name})
+        self.env.start()
+        self.smbus = patch.object(RPi_I2C_Device, 'SMBus', FakeSMBus)
+        self.smbus.start()
+        self.dev = I2C_Device(address=0x76, address_table='../address_table/BME280.yaml')
+        self.bus = self.dev.bus
+
+    def tearDown(self):
+        self.smbus.stop()
+        self.env.stop()
+        RegisterMap._loaded.clear()
+        self.tmp.cleanup()
+
+    def test_read_many(self):
+        self.bus.registers.update({0xFA: 0x12, 0xFB: 0x34, 0xFC: 0x5A})
+        res = self.dev.read_many(["TEMP_XLSB", "TEMP_MSB", "TEMP_LSB"])
+        self.assertEqual(res, {"TEMP_XLSB": 0x5, "TEMP_MSB": 0x12, "TEMP_LSB": 0x34})
+        self.assertEqual(self.bus.transfers, [('block', 0xFA, 3)])
+
+    def test_shared_register(self):
+        # OSRS_T, OSRS_P and MODE are fields of ctrl_meas (0xF4)
+        self.bus.registers[0xF4] = (5 << 5) | (3 << 2) | 1
+        res = self.dev.read_many(["OSRS_T", "OSRS_P", "MODE"])
+        self.assertEqual(res, {"OSRS_T": 5, "OSRS_P": 3, "MODE": 1})
+        self.assertEqual(self.bus.transfers, [('read', 0xF4)])
+
+    def test_read_registers(self):
+        self.bus.registers.update({0x88: 1, 0x89: 2, 0x8C: 3})
+        self.assertEqual(self.dev.read_registers([0x8C, 0x88, 0x89]), {0x88: 1, 0x89: 2, 0x8C: 3})
+        self.assertEqual(self.bus.transfers, [('block', 0x88, 2), ('read', 0x8C)])
+        self.bus.transfers.clear()
+        res = self.dev.read_registers([0x8C, 0x88, 0x89], max_gap=2)
+        self.assertEqual(res, {0x88: 1, 0x89: 2, 0x8A: 0, 0x8B: 0, 0x8C: 3})
+        self.assertEqual(self.bus.transfers, [('block', 0x88, 5)])
+
+    def test_stage(self):
+        self.bus.registers[0xF4] = 0x03
+        with self.dev.stage():
+            self.dev.write("OSRS_T", 5)
+            self.dev.write("OSRS_P", 3)
+            self.dev.write("OSRS_T", 4)
+            self.assertEqual(self.bus.transfers, [])
+        # one read-modify-write, the last value of a field wins
+        self.assertEqual(self.bus.transfers, [('read', 0xF4), ('write', 0xF4, (4 << 5) | (3 << 2) | 3)])
+
+    def test_stage_full_register(self):
+        self.bus.registers[0xF4] = 0xFF
+        with self.dev.stage():
+            self.dev.write("MODE", 1)
+            self.dev.write("OSRS_P", 0)
+            self.dev.write("OSRS_T", 2)
+        # all bits written, nothing to read
+        self.assertEqual(self.bus.transfers, [('write', 0xF4, (2 << 5) | 1)])
+
+    def test_stage_exception(self):
+        with self.assertRaises(KeyError):
+            with self.dev.stage():
+                self.dev.write("MODE", 1)
+                self.dev.write("NOT_A_FIELD", 1)
+        self.assertEqual(self.bus.transfers, [])
+        self.assertIsNone(self.dev.staged)
+
+    def test_image_cache(self):
+        dev = I2C_Device(address=0x76, address_table='../address_table/BME280.yaml', cache=True)
+        dev.bus.registers[0xF4] = 0x03
+        self.assertEqual(dev.read("MODE"), 3)
+        dev.write("OSRS_T", 5)
+        dev.write("MODE", 1)
+        # the register is read once, later read-modify-writes use the image
+        self.assertEqual(dev.bus.transfers, [('read', 0xF4), ('write', 0xF4, (5 << 5) | 3), ('write', 0xF4, (5 << 5) | 1)])
+        self.assertEqual(dev.image, {0xF4: (5 << 5) | 1})
+
+    def test_bme280_default(self):
+        bme = BME280()
+        # ctrl_hum only takes effect after ctrl_meas is written
+        self.assertEqual(bme.bus.transfers, [('read', 0xF2), ('write', 0xF2, 5), ('write', 0xF4, (5 << 5) | (5 << 2) | 1)])
+
+if __name__ == '__main__':
+    unittest.main()
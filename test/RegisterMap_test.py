@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from cocina.RegisterMap import RegisterMap
+
+here = os.path.dirname(os.path.abspath(__file__))
+BME280 = os.path.join(here, '../address_table/BME280.yaml')
+
+class RegisterMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = os.environ.get('COCINA_CACHE')
+        os.environ['COCINA_CACHE'] = os.path.join(self.tmp.name, 'cache')
+        self.table = os.path.join(self.tmp.name, 'BME280.yaml')
+        shutil.copy(BME280, self.table)
+        RegisterMap._loaded.clear()
+
+    def tearDown(self):
+        if self.cache is None:
+            del os.environ['COCINA_CACHE']
+        else:
+            os.environ['COCINA_CACHE'] = self.cache
+        RegisterMap._loaded.clear()
+        self.tmp.cleanup()
+
+    def test_compile(self):
+        regs = RegisterMap.from_yaml(self.table)
+        self.assertEqual((regs['OSRS_T'].address, regs['OSRS_T'].mask, regs['OSRS_T'].shift), (0xF4, 0xE0, 5))
+        self.assertEqual(regs['T2_LSB'].type, 'h')
+        # incomplete entry "mask: 0x"
+        self.assertEqual((regs['DEF'].mask, regs['DEF'].shift), (0, 0))
+
+    def test_cache(self):
+        regs = RegisterMap.load(self.table)
+        self.assertIs(RegisterMap.load(self.table), regs)
+        self.assertEqual(len(os.listdir(os.environ['COCINA_CACHE'])), 1)
+
+        # a new process reads the compiled map from disk
+        RegisterMap._loaded.clear()
+        cached = RegisterMap.load(self.table)
+        self.assertIsNot(cached, regs)
+        self.assertEqual([f.as_tuple() for f in cached.fields.values()], [f.as_tuple() for f in regs.fields.values()])
+
+        # a modified table is compiled again
+        with open(self.table, 'a') as f:
+            f.write("\nEXTRA:\n    address: 0x10\n    mask: 0x0C\n")
+        stat = os.stat(self.table)
+        os.utime(self.table, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(RegisterMap.load(self.table)['EXTRA'].shift, 2)
+        RegisterMap._loaded.clear()
+        self.assertIn('EXTRA', RegisterMap.load(self.table))
+
+    def test_cache_format(self):
+        regs = RegisterMap.load(self.table)
+        cache_file = os.path.join(os.environ['COCINA_CACHE'], os.listdir(os.environ['COCINA_CACHE'])[0])
+        with open(cache_file) as f:
+            self.assertEqual(len(json.load(f)['fields']), len(regs))
+        # anything else in the cache file is ignored, the table is compiled again
+        with open(cache_file, 'wb') as f:
+            f.write(b'\x80\x04garbage')
+        RegisterMap._loaded.clear()
+        self.assertEqual(RegisterMap.load(self.table)['OSRS_T'].shift, 5)
+
+if __name__ == '__main__':
+    unittest.main()
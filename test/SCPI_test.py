@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy as np
+from cocina import SCPI
+
+class ChunkedStream:
+    '''
+    recv_into replacement delivering data in chunks of a fixed size
+    '''
+    def __init__(self, data: bytes, chunk: int = 7):
+        self.data = data
+        self.chunk = chunk
+        self.pos = 0
+
+    def recv_into(self, view):
+        n = min(self.chunk, len(view), len(self.data) - self.pos)
+        view[:n] = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+def block(data: bytes) -> bytes:
+    length = str(len(data)).encode()
+    return b'#' + str(len(length)).encode() + length + data + b'\n'
+
+class SCPITest(unittest.TestCase):
+
+    def test_lines(self):
+        long_line = b','.join([b'1.2345e-06']*2000)
+        frames = SCPI.FrameReader(ChunkedStream(b'first\nsecond\n' + long_line + b'\nlast\n').recv_into, size=16)
+        self.assertEqual(frames.read_line(), b'first')
+        self.assertEqual(frames.read_line(), b'second')
+        self.assertEqual(frames.read_line(), long_line)
+        self.assertEqual(frames.read_line(), b'last')
+        with self.assertRaises(ConnectionError):
+            frames.read_line()
+
+    def test_block_into_numpy(self):
+        values = np.arange(10000, dtype='<f8')
+        stream = ChunkedStream(b'1\n' + block(values.tobytes()) + b'next\n', chunk=1000)
+        frames = SCPI.FrameReader(stream.recv_into, size=64)
+        self.assertEqual(frames.read_line(), b'1')
+        out = np.empty(10000, dtype='<f8')
+        view = frames.read_block(out)
+        self.assertEqual(len(view), values.nbytes)
+        np.testing.assert_array_equal(out, values)
+        self.assertEqual(frames.read_line(), b'next')
+
+    def test_consecutive_blocks(self):
+        stream = ChunkedStream(block(b'abc\ndef') + block(b'') + b'#0indefinite\n' + block(b'x'*12345))
+        frames = SCPI.FrameReader(stream.recv_into)
+        self.assertEqual(bytes(frames.read_block()), b'abc\ndef')
+        self.assertEqual(bytes(frames.read_block()), b'')
+        self.assertEqual(bytes(frames.read_block()), b'indefinite')
+        self.assertEqual(bytes(frames.read_block()), b'x'*12345)
+
+    def test_block_errors(self):
+        frames = SCPI.FrameReader(ChunkedStream(block(b'x'*100)).recv_into)
+        with self.assertRaises(ValueError):
+            frames.read_block(bytearray(10))
+        frames = SCPI.FrameReader(ChunkedStream(b'1.0,2.0\n').recv_into)
+        with self.assertRaises(ValueError):
+            frames.read_block()
+
+    def test_parse_block_header(self):
+        self.assertEqual(SCPI.parse_block_header(b'#3100'), (5, 100))
+        self.assertEqual(SCPI.parse_block_header(b'#3'), (5, None))
+        self.assertEqual(SCPI.parse_block_header(b'#0'), (2, None))
+
+    def test_shadow_state(self):
+        state = SCPI.ShadowState()
+        state.update('CH1:VOLT', 1.2)
+        self.assertFalse(state.unchanged('CH1:VOLT', 1.2))  # disabled
+        state.enabled = True
+        self.assertTrue(state.unchanged(':ch1:volt', '1.20'))
+        self.assertFalse(state.unchanged('CH1:VOLT', 1.3))
+        self.assertFalse(state.unchanged('CH1:CURR', 1.2))
+        state.update('C1:BSWV WIDTH', '1e-06')
+        state.update('C1:BSWV AMP', 'HIGH')
+        self.assertTrue(state.unchanged('C1:BSWV AMP', 'HIGH'))
+        state.invalidate('C1:BSWV')
+        self.assertNotIn('C1:BSWV WIDTH', state)
+        self.assertIn('CH1:VOLT', state)
+        state.observe('*RST')
+        self.assertNotIn('CH1:VOLT', state)
+        # small values are told apart
+        state.update('C1:BSWV WIDTH', 10e-9)
+        self.assertTrue(state.unchanged('C1:BSWV WIDTH', '1e-08'))
+        self.assertFalse(state.unchanged('C1:BSWV WIDTH', 15e-9))
+        state.update(':SOUR:CURR:VLIM', 1e-9)
+        self.assertFalse(state.unchanged(':SOUR:CURR:VLIM', 2e-9))
+
+    def test_compare(self):
+        self.assertTrue(SCPI.compare('1.000000E-08', 10e-9))
+        self.assertFalse(SCPI.compare('1.5E-08', 10e-9))
+        self.assertFalse(SCPI.compare('1000000000001', 1000000000000, rtol=0))
+        self.assertTrue(SCPI.compare('ON', 'ON'))
+
+    def test_adaptive_settle(self):
+        timing = SCPI.AdaptiveSettle(learn=2, margin=2, floor=0.001)
+        timing.baseline = 0.01
+        self.assertTrue(timing.learning(':SOUR:VOLT 1'))
+        timing.record(':SOUR:VOLT 1', 0.05)
+        timing.record('SOUR:VOLT 2', 0.03)
+        self.assertFalse(timing.learning('sour:volt 3'))
+        self.assertAlmostEqual(timing.delay('SOUR:VOLT 3'), 0.08)
+        timing.record('OUTP ON', 0.0102)
+        timing.record('OUTP ON', 0.009)
+        self.assertEqual(timing.delay('OUTP OFF'), 0)  # below floor
+        self.assertEqual(SCPI.header('C1:BSWV WIDTH,1e-6'), 'C1:BSWV')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import time
+import socket
+import threading
+import unittest
+from cocina.SkippyDevice import SkippyDevice
+
+def serve(server, received):
+    '''
+    Answer "ECHO? <x>" queries with <x> and *OPC? with 1, in chunks that don't align with the replies
+    '''
+    conn, _ = server.accept()
+    buf = b''
+    out = b''
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            break
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            received.append(line.decode())
+            if line.startswith(b'ECHO?'):
+                out += line.split()[-1] + b'\n'
+            elif line == b'*OPC?':
+                out += b'1\n'
+        if len(out) > 3:
+            conn.sendall(out[:3])
+            out = out[3:]
+        conn.sendall(out)
+        out = b''
+    conn.close()
+
+def serve_slow(server, received, connections=2):
+    '''
+    Answer "SLOW? <x>" with <x> after 0.5 s and "ECHO? <x>" right away, on each of several connections
+    '''
+    def handle(conn):
+        buf = b''
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                received.append(line.decode())
+                if line.startswith(b'SLOW?'):
+                    time.sleep(0.5)
+                try:
+                    conn.sendall(line.split()[-1] + b'\n')
+                except OSError:
+                    return
+        conn.close()
+    for _ in range(connections):
+        conn, _ = server.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+class TimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(2)
+        self.received = []
+        self.thread = threading.Thread(target=serve_slow, args=(self.server, self.received), daemon=True)
+        self.thread.start()
+        self.dev = SkippyDevice('127.0.0.1', self.server.getsockname()[1], 'test', timeout=0.2)
+
+    def tearDown(self):
+        self.dev.close()
+        self.thread.join(1)
+        self.server.close()
+
+    def test_late_reply(self):
+        first = self.dev.submit('ECHO? first')
+        slow = self.dev.submit('SLOW? late')
+        after = self.dev.submit('ECHO? after')
+        with self.assertRaises(socket.timeout):
+            self.dev.collect()
+        self.assertEqual(first.result(), 'first')
+        self.assertRaises(socket.timeout, slow.result)
+        self.assertRaises(socket.timeout, after.result)
+        # the late reply is not returned for the next query, that one goes over a new connection
+        time.sleep(0.5)
+        self.assertEqual(self.dev.query('ECHO? next'), 'next')
+        self.assertEqual(self.dev.pipeline(['ECHO? a', 'ECHO? b']), ['a', 'b'])
+
+class SkippyDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.received = []
+        self.thread = threading.Thread(target=serve, args=(self.server, self.received), daemon=True)
+        self.thread.start()
+        self.dev = SkippyDevice('127.0.0.1', self.server.getsockname()[1], 'test')
+
+    def tearDown(self):
+        self.dev.close()
+        self.thread.join(1)
+        self.server.close()
+
+    def test_pipeline(self):
+        self.assertEqual(self.dev.pipeline([f'ECHO? {i}' for i in range(50)]), [str(i) for i in range(50)])
+
+    def test_futures(self):
+        first = self.dev.submit('ECHO? first')
+        second = self.dev.submit('ECHO? second')
+        self.assertEqual(second.result(), 'second')
+        self.assertTrue(first.done())
+        self.assertEqual(first.result(), 'first')
+        # outstanding replies are collected before a regular query
+        third = self.dev.submit('ECHO? third')
+        self.assertEqual(self.dev.query('ECHO? fourth'), 'fourth')
+        self.assertEqual(third.result(), 'third')
+
+    def test_sync_opc(self):
+        self.dev.set_sync('opc')
+        self.dev.send('VOLT 1')
+        self.dev.send('VOLT 2')
+        self.assertEqual(self.dev.query('ECHO? done'), 'done')
+        self.assertEqual(self.received, ['VOLT 1', '*OPC?', 'VOLT 2', '*OPC?', 'ECHO? done'])
+
+    def test_sync_adaptive(self):
+        self.dev.set_sync('adaptive')
+        for i in range(5):
+            self.dev.send(f'VOLT {i}')
+        self.assertEqual(self.dev.query('ECHO? done'), 'done')
+        # calibration, then *OPC? only while learning, the local server needs no settle time
+        self.assertEqual(self.received.count('*OPC?'), 3 + self.dev.timing.learn)
+        self.assertEqual(self.received[-3:], ['VOLT 3', 'VOLT 4', 'ECHO? done'])
+        self.assertEqual(self.dev.timing.delay('VOLT 5'), 0)
+
+    def test_sync_adaptive_batch(self):
+        self.dev.set_sync('adaptive')
+        for i in range(5):
+            with self.dev.batch(check=False):
+                self.dev.send(f'VOLT {i}')
+                self.dev.send(f'CURR {i}')
+        self.assertEqual(self.dev.query('ECHO? done'), 'done')
+        # batches are learned like single commands
+        self.assertEqual(self.received.count('*OPC?'), 3 + self.dev.timing.learn)
+        self.assertEqual(self.received[-3:], ['VOLT 4', 'CURR 4', 'ECHO? done'])
+
+    def test_sync_mode(self):
+        with self.assertRaises(ValueError):
+            self.dev.set_sync('never')
+
+if __name__ == '__main__':
+    unittest.main()
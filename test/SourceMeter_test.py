@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import re
+import socket
+import threading
+import unittest
+import numpy as np
+from cocina.SourceMeter import SourceMeter, BufferManager, trace_chunks, ring_ranges
+
+class FakeKeithley:
+    '''
+    Minimal emulation of the reading buffers of a Keithley 2450 over a socket
+    '''
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.received = []
+        self.lines = []
+        self.errors = []
+        self.buffers = {'defbuffer1': np.zeros((0, 3))}
+        self.form = 'ASC'
+        self.voltage = 0.
+        self.capacity = {}
+        self.streaming = None
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def fill(self, name, n, voltages=None):
+        idx = np.arange(1, n+1)
+        voltages = np.full(n, self.voltage) if voltages is None else voltages
+        self.buffers[name] = np.stack([idx*1e-9, voltages, idx*0.01], axis=1)
+
+    def handle(self, msg):
+        if msg == '*IDN?':
+            return b'KEITHLEY INSTRUMENTS,MODEL 2450,0123456,1.7.0\n'
+        if msg.startswith('FORM:DATA'):
+            self.form = msg.split()[-1]
+        elif m := re.match(r'TRACe:MAKE "(\w+)", (\d+)', msg):
+            self.buffers[m.group(1)] = np.zeros((0, 3))
+            self.capacity[m.group(1)] = int(m.group(2))
+        elif m := re.match(r'TRAC:FILL:MODE CONT, "(\w+)"', msg):
+            self.streaming = m.group(1)
+        elif msg == 'TRIG:STAT?':
+            if not self.streaming:
+                return b'IDLE;IDLE;0\n'
+            # acquire 7 readings per poll into the ring buffer
+            name, total = self.loaded
+            ring = self.buffers[name]
+            if len(ring) == 0:
+                ring = self.buffers[name] = np.zeros((self.capacity[name], 3))
+                self.produced = 0
+                self.end = 0
+            for _ in range(min(7, total-self.produced)):
+                self.produced += 1
+                ring[self.end % len(ring)] = [self.produced, self.voltage, self.produced*0.01]
+                self.end = self.end % len(ring) + 1
+            return b'RUNNING;RUNNING;1\n' if self.produced < total else b'IDLE;IDLE;1\n'
+        elif m := re.match(r'TRIGger:LOAD "SimpleLoop", (\d+), [\d.]+, "(\w+)"', msg):
+            self.loaded = (m.group(2), int(m.group(1)))
+        elif m := re.match(r'SOURCE:VOLT ([-\d.e]+)', msg):
+            self.voltage = float(m.group(1))
+        elif m := re.match(r'TRAC:POIN (\d+), "(\w+)"', msg):
+            self.buffers[m.group(2)] = np.zeros((0, 3))
+        elif m := re.match(r'SOUR:SWE:VOLT:(LIN|LOG) ([-\d.e]+), ([-\d.e]+), (\d+), [\d.e]+, 1, BEST, OFF, OFF, "(\w+)"', msg):
+            start, stop, points = float(m.group(2)), float(m.group(3)), int(m.group(4))
+            space = np.linspace if m.group(1) == 'LIN' else np.geomspace
+            self.loaded = (m.group(5), points, space(start, stop, points))
+        elif m := re.match(r'SOUR:LIST:VOLT (.*)', msg):
+            self.values = np.array(m.group(1).split(','), dtype=float)
+        elif m := re.match(r'SOUR:SWE:VOLT:LIST 1, [\d.e]+, 1, OFF, "(\w+)"', msg):
+            self.loaded = (m.group(1), len(self.values), self.values)
+        elif msg == 'INIT' and self.loaded[0] == self.streaming:
+            self.buffers[self.streaming] = np.zeros((0, 3))
+        elif msg == 'INIT':
+            self.fill(*self.loaded)
+        elif msg == '*OPC?':
+            return b'1\n'
+        elif msg == 'SYST:ERR?':
+            return self.errors.pop(0) if self.errors else b'0,"No error;0;0 0"\n'
+        elif m := re.match(r'TRAC:ACT:END\? "(\w+)"', msg):
+            if self.streaming == m.group(1):
+                return f'{self.end}\n'.encode()
+            return f'{len(self.buffers[m.group(1)])}\n'.encode()
+        elif m := re.match(r'TRAC:DATA\? (\d+), (\d+), "(\w+)", READ, SOUR, REL', msg):
+            data = self.buffers[m.group(3)][int(m.group(1))-1:int(m.group(2))]
+            if self.form == 'ASC':
+                return ','.join(f'{x:.6e}' for x in data.ravel()).encode() + b'\n'
+            raw = data.astype('<f4' if self.form == 'SREAL' else '<f8').tobytes()
+            length = str(len(raw)).encode()
+            return b'#' + str(len(length)).encode() + length + raw + b'\n'
+        elif msg.endswith('?'):
+            return b'0\n'
+        return b''
+
+    def serve(self):
+        conn, _ = self.server.accept()
+        buf = b''
+        while data := conn.recv(4096):
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                self.lines.append(line.decode())
+                # compound commands are answered one by one, commands are recorded without leading ':'
+                for msg in line.decode().split(';'):
+                    msg = msg.strip().lstrip(':')
+                    self.received.append(msg)
+                    conn.sendall(self.handle(msg))
+        conn.close()
+
+class SourceMeterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instrument = FakeKeithley()
+        self.smu = SourceMeter('test', '127.0.0.1', port=self.instrument.port, wait=0)
+
+    def tearDown(self):
+        self.smu.close()
+        self.instrument.server.close()
+
+    def test_id(self):
+        self.assertEqual(self.smu.model, 'MODEL 2450')
+
+    def test_averaged_current(self):
+        for binary in [False, True]:
+            current, voltage, timestamp = self.smu.averaged_current(count=100, voltage=1.5, binary=binary)
+            self.assertEqual(len(current), 100)
+            np.testing.assert_allclose(current, np.arange(1, 101)*1e-9)
+            np.testing.assert_allclose(voltage, 1.5)
+            np.testing.assert_allclose(timestamp, np.arange(1, 101)*0.01)
+
+    def test_chunked_binary_readout(self):
+        self.instrument.fill('defbuffer1', 1000)
+        res = self.smu.read_buffer(chunk=300)
+        self.assertEqual(len(res), 1000)
+        np.testing.assert_allclose(res['timestamp'], np.arange(1, 1001)*0.01)
+        res = self.smu.read_buffer(start=11, end=20, single=True)
+        self.assertEqual(res.dtype['current'], np.dtype('<f4'))
+        np.testing.assert_allclose(res['timestamp'], np.arange(11, 21)*0.01, rtol=1e-6)
+        # ASCII format is restored after a binary readout
+        self.smu.opc()
+        self.assertEqual(self.instrument.form, 'ASC')
+        self.assertEqual(list(trace_chunks(1, 10, 4)), [(1, 4), (5, 8), (9, 10)])
+
+    def test_iv_sweep(self):
+        current, voltage, timestamp = self.smu.iv_sweep(start=0, stop=2, points=21, delay=0.01)
+        np.testing.assert_allclose(voltage, np.linspace(0, 2, 21))
+        self.assertEqual(len(current), 21)
+        _, voltage, _ = self.smu.iv_sweep(start=0.01, stop=10, points=4, mode='log', binary=False)
+        np.testing.assert_allclose(voltage, [0.01, 0.1, 1, 10], rtol=1e-5)
+        _, voltage, _ = self.smu.iv_sweep(mode='LIST', values=[0, 5, 1])
+        np.testing.assert_allclose(voltage, [0, 5, 1])
+        with self.assertRaises(AssertionError):
+            self.smu.iv_sweep(start=0, stop=1, mode='LOG')
+
+    def test_stream(self):
+        chunks = list(self.smu.stream(count=100, capacity=10, interval=0))
+        self.assertTrue(all(len(chunk) <= 7 for chunk in chunks))
+        np.testing.assert_array_equal(np.concatenate(chunks)['current'], np.arange(1, 101))
+        self.assertNotIn('ABOR', self.instrument.received)
+        # stopping early aborts the trigger model
+        for chunk in self.smu.stream(count=100, capacity=10, interval=0):
+            break
+        self.smu.opc()
+        self.assertIn('ABOR', self.instrument.received)
+
+    def test_buffer_manager(self):
+        buffers = BufferManager()
+        self.assertEqual(buffers.ensure('ivbuffer', 100), ['TRACe:MAKE "ivbuffer", 100'])
+        self.assertEqual(buffers.ensure('ivbuffer', 50), [':TRAC:CLE "ivbuffer"'])
+        self.assertEqual(buffers.ensure('ivbuffer', 200), [':TRAC:POIN 200, "ivbuffer"'])
+        self.assertEqual(buffers.ensure('ivbuffer', 100, fill='CONT', exact=True),
+                         [':TRAC:POIN 100, "ivbuffer"', ':TRAC:FILL:MODE CONT, "ivbuffer"'])
+        # the default buffers are never resized or reconfigured
+        self.assertEqual(buffers.ensure('defbuffer1', 5), [':TRAC:CLE "defbuffer1"'])
+        self.assertEqual(buffers.ensure('defbuffer1', 500000, clear=False), [])
+        with self.assertRaises(ValueError):
+            buffers.ensure('defbuffer1', 100, fill='CONT', exact=True)
+        self.assertEqual(buffers.stale(), ['ivbuffer'])
+        self.assertEqual(buffers.stale(max_age=60), [])
+        self.assertEqual(buffers.delete('ivbuffer'), [':TRAC:DEL "ivbuffer"'])
+        self.assertNotIn('ivbuffer', buffers)
+        # repeated measurements with a growing count resize instead of silently truncating
+        self.smu.averaged_current(count=10)
+        self.smu.averaged_current(count=10)
+        current, _, _ = self.smu.averaged_current(count=20)
+        self.assertEqual(len(current), 20)
+        self.assertEqual(self.instrument.received.count('TRACe:MAKE "ivbuffer", 10'), 1)
+        self.assertIn('TRAC:CLE "ivbuffer"', self.instrument.received)
+        self.assertIn('TRAC:POIN 20, "ivbuffer"', self.instrument.received)
+
+    def test_cache(self):
+        self.smu.state.enabled = True
+        self.smu.set_voltage(1.0)
+        self.smu.set_voltage(1.0)
+        self.smu.set_voltage(2.0)
+        self.assertEqual(self.instrument.received.count('SOURCE:VOLT 1.0'), 1)
+        self.assertEqual(self.instrument.received.count('SOURCE:VOLT 2.0'), 1)
+        # a reset forgets all settings
+        self.smu.reset()
+        self.smu.set_voltage(2.0)
+        self.assertEqual(self.instrument.received.count('SOURCE:VOLT 2.0'), 2)
+
+    def test_batch(self):
+        self.smu.set_mode_voltage(voltage=1.0)
+        self.assertEqual(self.instrument.lines[-3:], [
+            ':SENS:FUNC "CURR";:SENS:CURR:RANGE 0.000105;:SOURCE:VOLT:ILIMIT 5e-05;:SOURCE:FUNCTION VOLT;'
+            ':SOURCE:VOLT 0;:SOURCE:VOLT:RANGE 20;:SOURCE:VOLT 1.0',
+            'SYST:ERR?',
+            ':MEAS:CURR?',
+        ])
+        self.instrument.errors = [b'-222,"Parameter data out of range"\n']
+        with self.assertRaises(RuntimeError):
+            with self.smu.batch():
+                self.smu.send(':SOURCE:VOLT:RANGE 2000')
+        # an exception inside the batch drops the commands
+        with self.assertRaises(KeyError):
+            with self.smu.batch():
+                self.smu.send(':SOURCE:VOLT 99')
+                raise KeyError
+        self.smu.opc()
+        self.assertNotIn('SOURCE:VOLT 99', self.instrument.received)
+
+    def test_ring_ranges(self):
+        self.assertEqual(ring_ranges(0, 0, 10), [])
+        self.assertEqual(ring_ranges(0, 4, 10), [(1, 4)])
+        self.assertEqual(ring_ranges(4, 9, 10), [(5, 9)])
+        self.assertEqual(ring_ranges(9, 3, 10), [(10, 10), (1, 3)])
+        self.assertEqual(ring_ranges(10, 3, 10), [(1, 3)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+from cocina.Telemetry import TelemetryPublisher, TelemetrySubscriber
+
+class TelemetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.publisher = TelemetryPublisher("tcp://127.0.0.1:*", interval=0.01)
+        self.publisher.add("PSU", self.measure)
+        self.publisher.add("broken", lambda: 1/0)
+
+    def tearDown(self):
+        self.publisher.close()
+
+    def measure(self):
+        self.calls += 1
+        return {'CH1': {'Voltage': 1.2}}
+
+    def test_fanout(self):
+        subscribers = [TelemetrySubscriber(self.publisher.endpoint, topics=["PSU"], timeout=2) for _ in range(3)]
+        time.sleep(0.2)  # let the subscriptions arrive
+        self.publisher.start(duration=0.1)
+        records = [sub.recv() for sub in subscribers]
+        self.publisher.stop()
+        for record in records:
+            self.assertEqual(record['topic'], 'PSU')
+            self.assertEqual(record['values'], {'CH1': {'Voltage': 1.2}})
+        # the instrument is sampled once for all subscribers
+        self.assertEqual(self.calls, self.publisher.seq)
+        self.assertLessEqual(self.calls, 11)
+        for sub in subscribers:
+            sub.close()
+
+    def test_error(self):
+        sub = TelemetrySubscriber(self.publisher.endpoint, topics=["broken"], timeout=0.5)
+        time.sleep(0.2)
+        records = self.publisher.sample()
+        self.assertEqual(len(records), 2)
+        record = sub.recv()
+        self.assertNotIn('values', record)
+        self.assertTrue(record['error'].startswith('ZeroDivisionError'))
+        self.assertIsNone(sub.recv(timeout=0.05))
+        sub.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import time
 import unittest
-from unittest.mock import patch, MagicMock
-from cocina.TimeController import TimeController
+import numpy as np
+from unittest.mock import patch, MagicMock, call
+from cocina.TimeController import TimeController, CounterRing, compile_config, block_command, load_config, diff_config
 
 class TimeControllerTest(unittest.TestCase):
 
@@ -61,3 +63,95 @@ class TimeControllerTest(unittest.TestCase):
         with patch.object(tc, 'close', return_value=None):
             tc.close()
             self.assertFalse(tc.dev)
+
+    def test_compile_config(self):
+        self.assertEqual(
+            block_command('TSCO9', {'WIND:ENAB': False, 'WIND:BEGI:DELA': 0, 'WIND:BEGI:EDGE': 'RISI', 'WIND:END:DELA': 0, 'OPIN': 'ONLYFIR'}),
+            "TSCO9:WIND:ENAB OFF;BEGI:DELA 0;EDGE RISI;:TSCO9:WIND:END:DELA 0;:TSCO9:OPIN ONLYFIR",
+        )
+        config = {'GEN1': {'PPER': 100, 'PWID': 50}, 'OUTP1': {'ENAB': True, 'LINK': 'TSCO9'}}
+        self.assertEqual(compile_config(config), [":GEN1:PPER 100;PWID 50;:OUTP1:ENAB ON;LINK TSCO9"])
+        state = {'GEN1': {'PPER': '100', 'PWID': 50}, 'OUTP1': {'ENAB': 'ON', 'LINK': 'TSCO10'}}
+        self.assertEqual(compile_config(config, state), [":OUTP1:LINK TSCO9"])
+        cmds = compile_config({f'GEN{i}': {'PPER': 10**12} for i in range(1, 17)}, max_length=100)
+        self.assertTrue(all(len(cmd) <= 100 for cmd in cmds))
+        self.assertEqual(sum(cmd.count('PPER') for cmd in cmds), 16)
+        config = load_config('config/TimeController.yaml')
+        self.assertEqual(config['OUTP1']['ENAB'], 'ON')
+        self.assertEqual(len(compile_config(config)), 1)
+
+    @patch("cocina.ZMQDummy.ZeroMQDevice.connect", return_vale=True)
+    @patch("cocina.ZMQDummy.ZeroMQDevice.read", return_value="0")
+    @patch("cocina.ZMQDummy.ZeroMQDevice.send")
+    def test_apply_config(self, mock_send, mock_read, mock_connect):
+        tc = TimeController("123.123.123.123", 5050, "test")
+        config = {'GEN1': {'PPER': 100, 'PWID': 50}, 'GEN2': {'PPER': 100}}
+        self.assertEqual(tc.apply_config(config), [":GEN1:PPER 100;PWID 50;:GEN2:PPER 100"])
+        mock_send.assert_called_once_with(":GEN1:PPER 100;PWID 50;:GEN2:PPER 100")
+        # only the change is sent
+        self.assertEqual(tc.apply_config({'GEN1': {'PPER': 100, 'PWID': 60}}), [":GEN1:PWID 60"])
+        self.assertEqual(tc.apply_config({'GEN1': {'PPER': 100, 'PWID': 60}}), [])
+        # imperative setters make the block unknown again
+        tc.change_generator_par(1, "PWID", 70)
+        self.assertEqual(tc.apply_config({'GEN1': {'PWID': 60}}), [":GEN1:PWID 60"])
+        res = tc.snapshot_config(blocks=['INPU1'])
+        self.assertEqual(res, {'INPU1': {'ENAB': 0, 'THRE': 0, 'COUN:INTE': 0}})
+        self.assertEqual(mock_send.call_args_list[-3:], [call("INPU1:ENAB?"), call("INPU1:THRE?"), call("INPU1:COUN:INTE?")])
+
+    @patch("cocina.ZMQDummy.ZeroMQDevice.connect", return_vale=True)
+    @patch("cocina.ZMQDummy.ZeroMQDevice.read", return_value="100")
+    @patch("cocina.ZMQDummy.ZeroMQDevice.send")
+    def test_arm_trigger(self, mock_send, mock_read, mock_connect):
+        tc = TimeController("123.123.123.123", 5050, "test")
+        # nothing to confirm, armed right away
+        tc.arm_trigger(1)
+        mock_send.assert_called_once_with("GEN1:TRIG:ARM")
+        # the new parameter reads back, armed after one poll
+        tc.apply_config({'GEN1': {'PPER': 100}})
+        mock_send.reset_mock()
+        tc.arm_trigger(1)
+        self.assertEqual(mock_send.call_args_list, [call("GEN1:PPER?"), call("GEN1:TRIG:ARM")])
+        self.assertEqual(tc.unconfirmed, {})
+        # never confirmed, armed after the timeout
+        tc.delay(1, 200)
+        start = time.monotonic()
+        self.assertFalse(tc.wait_ready(timeout=0.1))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(tc.unconfirmed, {})
+
+    @patch("cocina.ZMQDummy.ZeroMQDevice.connect", return_vale=True)
+    @patch("cocina.ZMQDummy.ZeroMQDevice.read", return_value="10;20;30")
+    @patch("cocina.ZMQDummy.ZeroMQDevice.send")
+    def test_counters(self, mock_send, mock_read, mock_connect):
+        tc = TimeController("123.123.123.123", 5050, "test")
+        for channel in (1, 2, 4):
+            tc.config_input(channel, int_time=10)
+        self.assertEqual(tc.counter_channels(), [1, 2, 4])
+        mock_send.reset_mock()
+        timestamp, counts = tc.get_counters()
+        mock_send.assert_called_once_with("INPU1:COUN?;:INPU2:COUN?;:INPU4:COUN?")
+        np.testing.assert_array_equal(counts, [10, 20, 30])
+        self.assertAlmostEqual(timestamp, time.time(), delta=1)
+        with self.assertRaises(ValueError):
+            tc.get_counters([1, 2])
+
+        start = time.monotonic()
+        readouts = list(tc.stream_counters(count=5))
+        self.assertAlmostEqual(time.monotonic() - start, 0.04, delta=0.03)  # 10 ms integration time
+        self.assertEqual(len(readouts), 5)
+        self.assertEqual(len(tc.counters), 5)
+        np.testing.assert_allclose(tc.counters.rates(0.01), [1000, 2000, 3000])
+
+    def test_diff_config(self):
+        state = {'DELAY1': {'VALUE': 1_000_000_000_000}}
+        self.assertEqual(diff_config({'DELAY1': {'VALUE': 1_000_000_000_001}}, state), {'DELAY1': {'VALUE': 1_000_000_000_001}})
+        self.assertEqual(diff_config({'DELAY1': {'VALUE': 1_000_000_000_000}}, state), {})
+
+    def test_counter_ring(self):
+        ring = CounterRing([1, 2], capacity=3)
+        for i in range(5):
+            ring.append(i, [i, 2*i])
+        times, counts = ring.data()
+        np.testing.assert_array_equal(times, [2, 3, 4])
+        np.testing.assert_array_equal(counts[:, 1], [4, 6, 8])
+        np.testing.assert_allclose(ring.rates(1), [3, 6])
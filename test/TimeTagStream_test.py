@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy as np
+import zmq
+from cocina.TimeTagStream import TimeTagStream, coincidences, cross_correlation
+
+class TimeTagStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.a = np.sort(rng.integers(0, 10**9, 20000))
+        # half of the tags of b are correlated with a, delayed by 500 +- 50
+        self.b = np.sort(np.concatenate([
+            self.a[::2] + 500 + rng.integers(-50, 50, 10000),
+            rng.integers(0, 10**9, 10000),
+        ]))
+
+    def brute_force(self, window, delay=0):
+        return sum(int(np.sum(np.abs(self.b - t - delay) <= window)) for t in self.a[:2000])
+
+    def test_coincidences(self):
+        self.assertEqual(coincidences(self.a[:2000], self.b, 100, delay=500), self.brute_force(100, delay=500))
+        self.assertGreaterEqual(coincidences(self.a, self.b, 100, delay=500), 10000)
+
+    def test_cross_correlation(self):
+        hist, edges = cross_correlation(self.a, self.b, bin_width=100, max_delay=2000, chunk=3000)
+        self.assertEqual(len(hist), 40)
+        self.assertEqual(len(edges), 41)
+        self.assertIn(edges[np.argmax(hist)], (400, 500))  # correlated delays are 450..550
+        delays = (self.b[None, :] - self.a[:2000, None]).ravel()
+        delays = delays[(delays >= -2000) & (delays < 2000)]
+        expected, _ = np.histogram(delays, bins=edges)
+        hist_part, _ = cross_correlation(self.a[:2000], self.b, bin_width=100, max_delay=2000)
+        np.testing.assert_array_equal(hist_part, expected)
+        # the same histogram from a process pool
+        pooled, _ = cross_correlation(self.a, self.b, bin_width=100, max_delay=2000, processes=2, chunk=5000)
+        np.testing.assert_array_equal(pooled, hist)
+
+    def test_acquire(self):
+        context = zmq.Context.instance()
+        senders = {}
+        addresses = {}
+        for channel in (1, 2):
+            sock = context.socket(zmq.PUSH)
+            port = sock.bind_to_random_port('tcp://127.0.0.1')
+            senders[channel] = sock
+            addresses[channel] = f'tcp://127.0.0.1:{port}'
+        stream = TimeTagStream(addresses, capacity=15000, socket_type=zmq.PULL)
+        for batch in np.array_split(self.a, 10):
+            senders[1].send(batch.astype('<i8').tobytes())
+        for batch in np.array_split(self.b[:10000], 3):
+            senders[2].send(batch.astype('<i8').tobytes())
+        tags = stream.acquire(count=10000, timeout=1)
+        np.testing.assert_array_equal(tags[1], self.a[:15000])
+        np.testing.assert_array_equal(tags[2], self.b[:10000])
+        self.assertEqual(stream.overflow[1], 5000)
+        stream.close()
+        for sock in senders.values():
+            sock.close(linger=0)
+
+if __name__ == '__main__':
+    unittest.main()
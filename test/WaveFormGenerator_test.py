@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import socket
+import asyncio
+import threading
+import unittest
+import numpy as np
+from cocina.WaveFormGenerator import WaveFormGenerator, AsyncWaveFormGenerator, wave_command, parse_wave, arb_data, width_scan_data
+
+ARB_POINTS = 1000
+
+def serve(server, received, arbs=None):
+    '''
+    Minimal SDG: welcome banner, *IDN?, and C<n>:BSWV / BTWV key,value commands with their queries.
+    WVDT commands are expected to carry ARB_POINTS points, the data is stored as bytes in received,
+    and the names of the waveforms in arbs (listed by STL? USER).
+    '''
+    arbs = set() if arbs is None else arbs
+    conn, _ = server.accept()
+    conn.sendall(b'\r\nWelcome to the SCPI instrument\r\n>>')
+    waves = {}
+    buf = b''
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            break
+        buf += data
+        while b'\n' in buf:
+            head, sep, _ = buf.partition(b'WAVEDATA,')
+            if sep and b'\n' not in head:
+                end = len(head) + len(sep) + 2*ARB_POINTS
+                if len(buf) <= end:
+                    break
+                received.append(head.decode() + 'WAVEDATA,')
+                arbs.add(head.decode().split(',')[1])
+                received.append(bytes(buf[len(head) + len(sep):end]))
+                buf = buf[end+1:]
+                continue
+            line, buf = buf.split(b'\n', 1)
+            line = line.decode().strip()
+            received.append(line)
+            head, _, body = line.partition(' ')
+            if line == 'STL? USER':
+                conn.sendall(f"STL WVNM,{','.join(sorted(arbs))}\n".encode())
+            elif line == '*IDN?':
+                conn.sendall(b'Siglent Technologies,SDG2042X,SDG2XCA0000000,2.01.01.35R3\n')
+            elif head.endswith('?'):
+                params = waves.get(head[:-1], {})
+                unit = {'FRQ': 'HZ', 'WIDTH': 'S', 'DLY': 'S', 'AMP': 'V', 'OFST': 'V'}
+                body = ','.join(f"{k},{v}{unit.get(k, '')}" for k, v in params.items())
+                conn.sendall(f"{head[:-1]} {body}\n".encode())
+            else:
+                items = body.split(',')
+                waves.setdefault(head, {}).update(zip(items[::2], items[1::2]))
+    conn.close()
+
+class WaveCommandTest(unittest.TestCase):
+
+    def test_parse(self):
+        res = parse_wave("C1:BSWV WVTP,PULSE,FRQ,0.1HZ,PERI,10S,AMP,2.8V,WIDTH,1e-05S,DLY,0S")
+        self.assertEqual(res, {'WVTP': 'PULSE', 'FRQ': 0.1, 'PERI': 10., 'AMP': 2.8, 'WIDTH': 1e-5, 'DLY': 0.})
+
+    def test_command(self):
+        self.assertEqual(wave_command(2, 'BTWV', {'STATE': 'ON', 'TIME': 3}), "C2:BTWV STATE,ON,TIME,3")
+
+class WaveFormGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.received = []
+        self.arbs = set()
+        self.thread = threading.Thread(target=serve, args=(self.server, self.received, self.arbs), daemon=True)
+        self.thread.start()
+        self.wfg = WaveFormGenerator('test', '127.0.0.1', self.server.getsockname()[1], wait=0, cache=True)
+
+    def tearDown(self):
+        self.wfg.close()
+        self.thread.join(1)
+        self.server.close()
+
+    def test_pulse(self):
+        self.wfg.set_pulse(1, freq=0.1, width=1e-5, amplitude=2.8, offset=1.4, verify=True)
+        self.assertEqual(self.received[1:], ["C1:BSWV WVTP,PULSE,FRQ,0.1,WIDTH,1e-05,AMP,2.8,OFST,1.4,DLY,0", "C1:BSWV?"])
+        # only the width changed
+        self.wfg.set_pulse(1, freq=0.1, width=2e-5, amplitude=2.8, offset=1.4)
+        self.wfg.change_pulse_width(1, 2e-5)
+        self.wfg.id()
+        self.assertEqual(self.received[3:], ["C1:BSWV WIDTH,2e-05", "*IDN?"])
+        self.assertEqual(self.wfg.get_wave(1)['WIDTH'], 2e-5)
+
+    def test_verify(self):
+        self.wfg.set_pulse(1, width=10e-9, verify=True)
+        # the generator keeps the old width
+        with self.assertRaises(ValueError):
+            self.wfg.verify_wave(1, 'BSWV', {'WIDTH': 15e-9})
+
+    def test_burst(self):
+        self.wfg.set_burst(2, trigger='EXT', cycles=5, verify=True)
+        self.assertEqual(self.received[1:], ["C2:BTWV STATE,ON,TRSR,EXT,TIME,5,DLAY,0.0", "C2:BTWV?"])
+
+    def test_upload_arb(self):
+        samples = np.sin(np.linspace(0, 2*np.pi, ARB_POINTS))
+        self.assertTrue(self.wfg.upload_arb('sine', samples, freq=1e3))
+        self.wfg.id()
+        self.assertEqual(self.received[1], "C1:WVDT WVNM,sine,FREQ,1000.0,AMPL,1,OFST,0,PHASE,0,WAVEDATA,")
+        self.assertEqual(np.frombuffer(self.received[2], dtype='<i2').tolist(), arb_data(samples).tolist())
+        self.assertEqual(self.received[3], "C1:ARWV NAME,sine")
+        # same waveform, only selected again
+        self.assertFalse(self.wfg.upload_arb('sine', samples, freq=1e3))
+        self.assertEqual(self.received[5], "STL? USER")
+        self.assertTrue(self.wfg.upload_arb('sine', -samples, freq=1e3))
+        self.wfg.id()
+        self.assertEqual(len(self.received), 11)
+
+    def test_upload_arb_stale(self):
+        samples = np.sin(np.linspace(0, 2*np.pi, ARB_POINTS))
+        self.assertTrue(self.wfg.upload_arb('sine', samples, select=False))
+        # deleted on the instrument
+        self.wfg.id()
+        self.arbs.clear()
+        self.assertTrue(self.wfg.upload_arb('sine', samples, select=False))
+        # the hash is forgotten after a reset
+        self.wfg.send('*RST')
+        self.assertTrue(self.wfg.upload_arb('sine', samples, select=False))
+        self.wfg.id()
+        self.assertEqual([msg for msg in self.received if isinstance(msg, str) and 'WVDT' in msg], [self.received[1]]*3)
+
+    def test_sweep(self):
+        self.wfg.set_sweep(1, start=1e3, stop=1e4, time=0.5, verify=True)
+        self.wfg.send_trigger(1, kind='SWWV')
+        self.wfg.id()
+        self.assertEqual(self.received[1:], ["C1:SWWV STATE,ON,TIME,0.5,START,1000.0,STOP,10000.0,SWMD,LINE,DIR,UP,TRSR,INT",
+                                             "C1:SWWV?", "C1:SWWV TRSR,MAN", "C1:SWWV MTRIG", "*IDN?"])
+
+    def test_width_scan(self):
+        samples, widths = width_scan_data([10e-9, 25e-9], period=100e-9, points=40)
+        self.assertEqual(samples.tolist(), ([1.]*2 + [-1.]*18) + ([1.]*5 + [-1.]*15))
+        self.assertTrue(np.allclose(widths, [10e-9, 25e-9]))
+        with self.assertRaises(ValueError):
+            width_scan_data([1e-9], period=100e-9, points=40)
+
+    def test_width_scan_trigger(self):
+        widths = self.wfg.width_scan(1, widths=[10e-9, 20e-9, 40e-9, 50e-9], period=100e-9, points=ARB_POINTS)
+        self.wfg.send_trigger(1)
+        self.wfg.id()
+        self.assertEqual(self.received[3:], ["C1:ARWV NAME,width_scan", "C1:BTWV STATE,ON,TRSR,MAN,TIME,1,DLAY,0.0",
+                                             "C1:BTWV MTRIG", "*IDN?"])
+        # one trigger plays all pulses, one per period, in the order of the widths
+        data = np.frombuffer(self.received[2], dtype='<i2').reshape(4, -1)
+        self.assertEqual((data == 32767).sum(axis=1).tolist(), [25, 50, 100, 125])
+        self.assertTrue(np.all(data[:, 0] == 32767))
+        self.assertTrue(np.allclose(widths, [10e-9, 20e-9, 40e-9, 50e-9]))
+
+    def test_arb_data(self):
+        self.assertEqual(arb_data([-2., -1., 0., 0.5, 1.]).tolist(), [-32767, -32767, 0, 16384, 32767])
+        self.assertEqual(arb_data(np.array([1, -1], dtype='>i2')).dtype.str, '<i2')
+
+class AsyncWaveFormGeneratorTest(unittest.TestCase):
+
+    def test_cache(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+        thread = threading.Thread(target=serve, args=(server, received), daemon=True)
+        thread.start()
+        async def run():
+            async with AsyncWaveFormGenerator('test', '127.0.0.1', server.getsockname()[1], wait=0, cache=True) as wfg:
+                await wfg.set_pulse(1, freq=0.1, width=1e-5, amplitude=2.8, offset=1.4)
+                await wfg.set_pulse(1, freq=0.1, width=2e-5, amplitude=2.8, offset=1.4)
+                await wfg.id()
+        asyncio.run(run())
+        thread.join(1)
+        server.close()
+        # only the changed width is sent again
+        self.assertEqual(received[1:], ["C1:BSWV WVTP,PULSE,FRQ,0.1,WIDTH,1e-05,AMP,2.8,OFST,1.4,DLY,0", "C1:BSWV WIDTH,2e-05", "*IDN?"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import threading
+import unittest
+import zmq
+from cocina.ZeroMQDevice import ZeroMQDevice
+
+def serve(router, received, drop):
+    '''
+    Answer every message with "<message> OK", like a REP socket would, but lose the first `drop` messages
+    '''
+    while True:
+        try:
+            identity, empty, msg = router.recv_multipart()
+        except zmq.ZMQError:
+            return
+        msg = msg.decode()
+        received.append(msg)
+        if len(received) <= drop:
+            continue
+        router.send_multipart([identity, empty, f"{msg} OK".encode()])
+        if msg == 'STOP':
+            return
+
+class ZeroMQDeviceTest(unittest.TestCase):
+
+    def start(self, drop=0):
+        context = zmq.Context.instance()
+        self.router = context.socket(zmq.ROUTER)
+        self.port = self.router.bind_to_random_port('tcp://127.0.0.1')
+        self.received = []
+        self.thread = threading.Thread(target=serve, args=(self.router, self.received, drop), daemon=True)
+        self.thread.start()
+        self.dev = ZeroMQDevice('127.0.0.1', self.port, 'test', timeout=0.2, retries=1)
+
+    def tearDown(self):
+        self.dev.close()
+        self.thread.join(1)
+        self.router.close(linger=0)
+
+    def test_pipeline(self):
+        self.start()
+        first = self.dev.submit('A')
+        second = self.dev.submit('B')
+        self.assertEqual(self.dev.query('C'), 'C OK')
+        self.assertEqual((first.result(), second.result()), ('A OK', 'B OK'))
+        self.assertEqual(self.dev.pipeline([f'GEN{i}:PLAY' for i in range(10)]), [f'GEN{i}:PLAY OK' for i in range(10)])
+        # the echo is not a valid readback
+        self.assertFalse(self.dev.write('INPU1:THRESHOLD', 0.4, strict=False))
+        self.assertEqual(self.received[-2:], ['INPU1:THRESHOLD 0.4', 'INPU1:THRESHOLD?'])
+        self.assertEqual(self.dev.query('STOP'), 'STOP OK')
+
+    def test_send(self):
+        self.start()
+        # the replies to commands are discarded, queries get their own reply
+        self.dev.send('GEN1:PPER 100')
+        self.dev.send('GEN1:PWID 50')
+        self.assertEqual(self.dev.query('GEN1:PPER?'), 'GEN1:PPER? OK')
+        self.dev.send('GEN1:PLAY')
+        self.assertEqual(self.dev.pipeline(['A', 'B']), ['A OK', 'B OK'])
+        self.assertEqual(self.dev.query('STOP'), 'STOP OK')
+
+    def test_no_resend(self):
+        self.start(drop=1)
+        # a command may have been executed, it is not sent again
+        with self.assertRaises(TimeoutError):
+            self.dev.query('GEN1:TRIG:ARM')
+        self.assertEqual(self.received, ['GEN1:TRIG:ARM'])
+        self.dev.query('STOP')
+
+    def test_lazy_pirate(self):
+        self.start(drop=1)
+        # the first request is lost, the query is resent on a new connection
+        self.assertEqual(self.dev.query('*IDN?'), '*IDN? OK')
+        self.assertEqual(self.received, ['*IDN?', '*IDN?'])
+        self.dev.query('STOP')
+
+    def test_timeout(self):
+        self.start(drop=3)
+        with self.assertRaises(TimeoutError):
+            self.dev.query('*IDN?')
+        pending = self.dev.submit('*IDN?')
+        with self.assertRaises(TimeoutError):
+            pending.result()
+        self.dev.timeout = 1
+        self.assertEqual(self.dev.query('STOP'), 'STOP OK')
+
+if __name__ == '__main__':
+    unittest.main()